@@ -2,23 +2,42 @@
 #
 # Script to build and install packages into the Steam runtime
 
+import bz2
 import calendar
+import collections.abc
+import concurrent.futures
+import contextlib
 import errno
+import fcntl
+import functools
 import os
 import re
+import sqlite3
 import sys
 import glob
 import gzip
 import hashlib
+import http.client
+import io
+import json
+import lzma
+import mmap
+import multiprocessing
+import queue
 import shutil
+import socket
+import stat
 import subprocess
 import tarfile
 import tempfile
+import threading
 import time
 from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request, getproxies, pathname2url, proxy_bypass, url2pathname
 
 from debian import deb822
-from debian.debian_support import Version
 import argparse
 
 try:
@@ -29,14 +48,14 @@ else:
 	typing		# noqa
 
 try:
-	from io import BytesIO
+	from urllib.request import urlopen
 except ImportError:
-	from cStringIO import StringIO as BytesIO		# type: ignore
+	from urllib import urlopen		# type: ignore
 
 try:
-	from urllib.request import (urlopen, urlretrieve)
+	import zstandard
 except ImportError:
-	from urllib import (urlopen, urlretrieve)		# type: ignore
+	zstandard = None		# type: ignore
 
 destdir="newpkg"
 
@@ -47,6 +66,31 @@ ONE_MEGABYTE = 1024 * 1024
 SPLIT_MEGABYTES = 50
 MIN_PARTS = 3
 
+# Maximum number of simultaneous connections to any one apt repository
+MAX_CONNECTIONS_PER_HOST = 4
+MAX_FETCH_THREADS = 16
+
+# Give up on a connection if the server sends nothing for this long
+HTTP_TIMEOUT = 60
+
+# Retry downloads that fail with a transient error this many times,
+# waiting DOWNLOAD_BACKOFF seconds before the first retry and twice as
+# long before each one after that
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF = 2.0
+
+# Avoid a mirror for this many seconds after a request to it fails,
+# doubling after each further failure, up to 16 times as long
+MIRROR_RETRY_AFTER = 30.0
+
+# Increment this if the schema or contents of BinarySnapshots change
+SNAPSHOT_FORMAT = 3
+MAX_SNAPSHOTS = 10
+
+# Increment this if the way install_deb() unpacks packages into an
+# UnpackCache changes
+UNPACK_FORMAT = 1
+
 # Order is significant: the first architecture is considered primary
 DEFAULT_ARCHITECTURES = ('amd64', 'i386')
 
@@ -55,11 +99,50 @@ ARCHITECTURES = {
 	'i386': 'i386-linux-gnu',
 }
 
+# Set by main(), so that the functions below can be loaded as a module
+# by the test suite without parsing our own command-line
+args = argparse.Namespace()
+reference_timestamp = 0
+
+
+# From <linux/fs.h>: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def reflink(source, dest):
+	# type: (str, str) -> None
+	"""
+	Create dest as a copy-on-write clone of source, sharing its
+	storage, or raise OSError if the filesystem cannot do that.
+	"""
+	with open(source, 'rb') as reader, open(dest, 'wb') as writer:
+		try:
+			fcntl.ioctl(writer.fileno(), FICLONE, reader.fileno())
+		except OSError:
+			writer.close()
+			os.unlink(dest)
+			raise
+
+
+def reflink_or_copy(source, dest):
+	# type: (str, str) -> None
+	"""
+	Copy source to dest, optimizing by creating a copy-on-write clone
+	instead of a full copy if possible. Unlike a hard-link, dest is
+	not altered if source is later modified in-place.
+	"""
+	try:
+		reflink(source, dest)
+	except OSError:
+		shutil.copyfile(source, dest)
+
 
 def hard_link_or_copy(source, dest):
+	# type: (str, str) -> None
 	"""
-	Copy source to dest, optimizing by creating a hard-link instead
-	of a full copy if possible.
+	Copy source to dest, optimizing by creating a hard-link, or
+	failing that a copy-on-write clone, instead of a full copy if
+	possible.
 	"""
 	try:
 		os.remove(dest)
@@ -70,7 +153,195 @@ def hard_link_or_copy(source, dest):
 	try:
 		os.link(source, dest)
 	except OSError:
-		shutil.copyfile(source, dest)
+		try:
+			reflink(source, dest)
+		except OSError:
+			shutil.copyfile(source, dest)
+
+
+def local_path(url):
+	# type: (str) -> typing.Optional[str]
+	"""
+	If url is a file:// URL, return the path it refers to.
+	"""
+	parts = urlsplit(url)
+
+	if parts.scheme != 'file' or parts.netloc not in ('', 'localhost'):
+		return None
+
+	return url2pathname(parts.path)
+
+
+def link_tree(
+	source,				# type: str
+	dest,				# type: str
+	follow_symlinks=(),		# type: typing.Container[str]
+	link_file=hard_link_or_copy		# type: typing.Callable[[str, str], None]
+):
+	# type: (...) -> None
+	"""
+	Populate dest with hard-links to the files in source, or whatever
+	other copies link_file makes, replacing any that already exist, as
+	though source had been unpacked into dest a second time.
+
+	Symbolic links in dest are replaced by directories, like tar does,
+	unless their path relative to dest is in follow_symlinks.
+	"""
+	for dirpath, dirnames, filenames in os.walk(source):
+		relative_dir = os.path.relpath(dirpath, source)
+		target_dir = os.path.join(dest, relative_dir)
+		os.makedirs(target_dir, exist_ok=True)
+
+		for name in dirnames + filenames:
+			path = os.path.join(dirpath, name)
+			target = os.path.join(target_dir, name)
+
+			if os.path.islink(path):
+				if os.path.lexists(target):
+					os.remove(target)
+
+				os.symlink(os.readlink(path), target)
+			elif name in filenames:
+				link_file(path, target)
+			elif (
+				os.path.islink(target)
+				and os.path.normpath(os.path.join(relative_dir, name))
+				not in follow_symlinks
+			):
+				os.remove(target)
+
+
+class MergedTree:
+	"""
+	The merged multiarch layout of the output directory. Each
+	architecture's packages are unpacked into directories of their own
+	first, and link() walks each of those to put its files into place
+	with link_file: below top, where they are shared by all
+	architectures, except for {usr/,}{s,}bin, which would collide (see
+	templates/scripts/check-runtime-conflicts.sh) and so go below
+	top/ARCH instead.
+
+	Each shared directory that is directly below / or /usr in an
+	architecture's packages is represented by a symlink, such as
+	top/amd64/usr/lib -> ../../usr/lib.
+	"""
+
+	def __init__(
+		self,
+		top,				# type: str
+		link_file=hard_link_or_copy		# type: typing.Callable[[str, str], None]
+	):
+		# type: (...) -> None
+		self.top = top
+		self.link_file = link_file
+		# {relative path: architecture that put it in place}
+		self.owners = {}		# type: typing.Dict[str, str]
+		# {architecture: {relative path of shared directory}}
+		self.shared_dirs = {}		# type: typing.Dict[str, typing.Set[str]]
+
+	@staticmethod
+	def shared_dir(relative_path, is_dir):
+		# type: (str, bool) -> typing.Optional[str]
+		"""
+		Return the directory directly below / or /usr that contains
+		relative_path, or is relative_path, if it is shared between
+		architectures, or None if relative_path is per-architecture.
+		"""
+		parts = relative_path.split('/')
+		depth = 2 if parts[0] == 'usr' else 1
+
+		if (
+			relative_path == '.'
+			or len(parts) < depth
+			or (len(parts) == depth and not is_dir)
+			or parts[depth - 1] in ('bin', 'sbin')
+		):
+			return None
+
+		return '/'.join(parts[:depth])
+
+	def link(self, arch, source):
+		# type: (str, str) -> None
+		"""
+		Put the files in source, a package for arch unpacked by
+		install_deb(), into place. They replace files from an earlier
+		package for the same architecture, as though source had been
+		unpacked into the same place; but a file that is already there
+		for another architecture is kept, with a warning if the two
+		are different.
+		"""
+		shared_dirs = self.shared_dirs.setdefault(arch, set())
+
+		for dirpath, dirnames, filenames in os.walk(source):
+			relative_dir = os.path.relpath(dirpath, source)
+
+			for name in dirnames + filenames:
+				path = os.path.join(dirpath, name)
+				relative_path = os.path.normpath(
+					os.path.join(relative_dir, name))
+				is_dir = name in dirnames and not os.path.islink(path)
+				shared_dir = self.shared_dir(relative_path, is_dir)
+
+				if shared_dir is None:
+					target = os.path.join(self.top, arch, relative_path)
+					owner = arch		# type: typing.Optional[str]
+				else:
+					target = os.path.join(self.top, relative_path)
+					owner = self.owners.get(relative_path)
+					shared_dirs.add(shared_dir)
+
+				if owner != arch and os.path.lexists(target):
+					if not is_dir:
+						self.collide(path, target, relative_path)
+
+					continue
+
+				self.owners[relative_path] = arch
+
+				if os.path.islink(path):
+					if os.path.lexists(target):
+						os.remove(target)
+
+					os.symlink(os.readlink(path), target)
+				elif not is_dir:
+					self.link_file(path, target)
+				else:
+					if os.path.islink(target):
+						# Like tar, replace a symlink with the directory
+						os.remove(target)
+
+					os.makedirs(target, exist_ok=True)
+
+	@staticmethod
+	def collide(path, target, relative_path):
+		# type: (str, str, str) -> None
+		if os.path.islink(path) and os.path.islink(target):
+			if os.readlink(path) == os.readlink(target):
+				return
+
+		try:
+			if os.path.samefile(path, target):
+				# Hard-linked from the same Architecture: all package
+				return
+		except OSError:
+			pass
+
+		if not keep_only_primary_arch(relative_path):
+			warn_if_different(path, target)
+
+	def finish(self, arch):
+		# type: (str) -> None
+		"""
+		Replace the shared directories in top/ARCH with symlinks, once
+		all of arch's packages have been linked into place.
+		"""
+		for shared_dir in sorted(self.shared_dirs.get(arch, ())):
+			path = os.path.join(self.top, arch, shared_dir)
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			os.symlink(
+				os.path.join('../' * (shared_dir.count('/') + 1), shared_dir),
+				path,
+			)
 
 
 def warn_if_different(
@@ -93,6 +364,73 @@ def check_path_traversal(s):
 		raise ValueError('Path traversal detected in %r' % s)
 
 
+# A version number is split into alternating non-digit and digit parts,
+# in the same way as dpkg's verrevcmp()
+VERSION_PART = re.compile(r'(\D*)(\d*)')
+
+# An empty non-digit part followed by a digit part that is 0 compares
+# equal to the end of the string
+VERSION_PART_END = ((0,), 0)
+
+# (weights of non-digit characters, value of digits)
+VersionPart = typing.Tuple[typing.Tuple[int, ...], int]
+
+
+def _version_part_key(s):
+	# type: (str) -> typing.Tuple[VersionPart, ...]
+	parts = []		# type: typing.List[VersionPart]
+
+	for non_digits, digits in VERSION_PART.findall(s):
+		# Skip the empty match at the end, but not if the whole
+		# string is empty: '' is equivalent to '0'
+		if parts and not non_digits and not digits:
+			continue
+
+		# '~' sorts before anything, even the end of the string;
+		# then letters; then everything else. A terminating 0
+		# stands for the end of the string.
+		weights = tuple(
+			-1 if c == '~'
+			else ord(c) if c.isalpha()
+			else ord(c) + 256
+			for c in non_digits
+		) + (0,)
+		parts.append((weights, int(digits or 0)))
+
+	# Only the first part can have an empty non-digit part, so this
+	# terminator compares with the rest of a longer version string in
+	# the same way as dpkg compares the end of the string
+	parts.append(VERSION_PART_END)
+	return tuple(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def version_key(version):
+	# type: (str) -> typing.Tuple[typing.Any, ...]
+	"""
+	Return a key that sorts Debian version strings in the same order
+	as dpkg --compare-versions. Keys are plain tuples, so comparing
+	them is much faster than comparing debian_support.Version objects,
+	and they are remembered because the same versions are compared
+	over and over again.
+	"""
+	epoch, sep, rest = version.partition(':')
+
+	if not sep:
+		epoch, rest = '0', version
+
+	upstream, sep, revision = rest.rpartition('-')
+
+	if not sep:
+		upstream, revision = rest, ''
+
+	return (
+		int(epoch),
+		_version_part_key(upstream),
+		_version_part_key(revision),
+	)
+
+
 class AptSource:
 	def __init__(
 		self,
@@ -102,8 +440,14 @@ class AptSource:
 		components=('main',),
 		trusted=False
 	):
+		if isinstance(url, str):
+			url = [url]
+
 		self.kind = kind
-		self.url = url
+		# Files are identified by their URL on the first of several
+		# equivalent mirrors, but can be downloaded from any of them
+		self.mirrors = [u.rstrip('/') for u in url]
+		self.url = self.mirrors[0]
 		self.suite = suite
 		self.components = components
 		self.trusted = trusted
@@ -148,10 +492,10 @@ class AptSource:
 			if suite == './':
 				suite = ''
 
-			return ['%s/%sSources.gz' % (self.url, suite)]
+			return ['%s/%sSources' % (self.url, suite)]
 
 		return [
-			"%s/dists/%s/%s/source/Sources.gz" % (
+			"%s/dists/%s/%s/source/Sources" % (
 				self.url, self.suite, component)
 			for component in self.components
 		]
@@ -168,20 +512,20 @@ class AptSource:
 			if suite == './':
 				suite = ''
 
-			return ['%s/%sPackages.gz' % (self.url, suite)]
+			return ['%s/%sPackages' % (self.url, suite)]
 
 		ret = []		# type: typing.List[str]
 
 		for component in self.components:
 			ret.append(
-				"%s/dists/%s/%s/binary-%s/Packages.gz" % (
+				"%s/dists/%s/%s/binary-%s/Packages" % (
 					self.url, self.suite, component,
 					arch)
 			)
 
 			if dbgsym:
 				ret.append(
-					"%s/dists/%s/%s/debug/binary-%s/Packages.gz" % (
+					"%s/dists/%s/%s/debug/binary-%s/Packages" % (
 						self.url, self.suite,
 						component, arch)
 				)
@@ -189,242 +533,2328 @@ class AptSource:
 		return ret
 
 
-def parse_args():
-	parser = argparse.ArgumentParser()
-	parser.add_argument(
-		"--templates",
-		help="specify template files to include in runtime",
-		default=os.path.join(top, "templates"))
-	parser.add_argument(
-		"-o", "--output", default=None,
-		help="specify output directory [default: delete after archiving]")
-	parser.add_argument("--suite", help="specify apt suite", default='scout')
-	parser.add_argument("-b", "--beta", help="build beta runtime", dest='suite', action="store_const", const='scout_beta')
-	parser.add_argument("-d", "--debug", help="build debug runtime", action="store_true")
-	parser.add_argument("--source", help="include sources", action="store_true")
-	parser.add_argument("--symbols", help="include debugging symbols", action="store_true")
-	parser.add_argument(
-		"--repo", help="main apt repository URL",
-		default="https://repo.steampowered.com/steamrt",
-	)
-	parser.add_argument(
-		"--upstream-apt-source", dest='upstream_apt_sources',
-		default=[], action='append',
-		help=(
-			"additional apt sources in the form "
-			"'deb https://URL SUITE COMPONENT [COMPONENT...]' "
-			"(may be repeated)"
-		),
-	)
-	parser.add_argument(
-		"--extra-apt-source", dest='extra_apt_sources',
-		default=[], action='append',
-		help=(
-			"additional apt sources in the form "
-			"'deb https://URL SUITE COMPONENT [COMPONENT...]' "
-			"(may be repeated)"
-		),
-	)
-	parser.add_argument("-v", "--verbose", help="verbose", action="store_true")
-	parser.add_argument("--official", help="mark this as an official runtime", action="store_true")
-	parser.add_argument("--set-name", help="set name for this runtime", default=None)
-	parser.add_argument("--set-version", help="set version number for this runtime", default=None)
-	parser.add_argument("--debug-url", help="set URL for debug/source version", default=None)
-	parser.add_argument("--archive", help="pack Steam Runtime into a tarball", default=None)
-	parser.add_argument(
-		"--compression", help="set compression [xz|gx|bz2|none]",
-		choices=('xz', 'gz', 'bz2', 'none'),
-		default='xz')
-	parser.add_argument(
-		'--strict', action="store_true",
-		help='Exit unsuccessfully when something seems wrong')
-	parser.add_argument(
-		'--split', default=None,
-		help='Also generate an archive split into 50M parts')
-	parser.add_argument(
-		'--architecture', '--arch',
-		help='include architecture (the first is assumed to be primary)',
-		action='append', dest='architectures', default=[],
-	)
-	parser.add_argument(
-		'--metapackage',
-		help='Include the given package and its dependencies',
-		action='append', dest='metapackages', default=[],
-	)
-	parser.add_argument(
-		'--packages-from',
-		help='Include packages listed in the given file',
-		action='append', default=[],
-	)
-	parser.add_argument(
-		'--dump-options', action='store_true',
-		help=argparse.SUPPRESS,		# deliberately undocumented
-	)
-
-	args = parser.parse_args()
+def add_repo_mirrors(
+	apt_sources,		# type: typing.List[AptSource]
+	repo,			# type: str
+	mirrors			# type: typing.Sequence[str]
+):
+	# type: (...) -> None
+	"""
+	Add mirrors to each of apt_sources that is for repo.
+	"""
+	repo = repo.rstrip('/')
 
-	if args.output is None and args.archive is None:
-		parser.error(
-			'At least one of --output and --archive is required')
+	for source in apt_sources:
+		if source.url == repo:
+			source.mirrors.extend(m.rstrip('/') for m in mirrors)
 
-	if args.split is not None and args.archive is None:
-		parser.error('--split requires --archive')
 
-	if not os.path.isdir(args.templates):
-		parser.error(
-			'Argument to --templates, %r, must be a directory'
-			% args.templates)
+def parse_apt_source(line):
+	# type: (str) -> typing.List[AptSource]
+	"""
+	Parse a line in the form accepted by --extra-apt-source.
+	Equivalent mirrors can be given as URL|URL|...
+	"""
+	trusted=False
+	tokens = line.split()
 
-	# os.path.exists is false for dangling symlinks, so check for both
-	if args.output is not None and (
-		os.path.exists(args.output)
-		or os.path.islink(args.output)
-	):
-		parser.error(
-			'Argument to --output, %r, must not already exist'
-			% args.output)
+	if len(tokens) < 4:
+		raise ValueError(
+			'--extra-apt-source argument must be in the form '
+			'"deb https://URL SUITE COMPONENT [COMPONENT...]"')
 
-	if not args.architectures:
-		args.architectures = list(DEFAULT_ARCHITECTURES)
+	if tokens[0] not in ('deb', 'deb-src', 'both'):
+		raise ValueError(
+			'--extra-apt-source argument must start with '
+			'"deb ", "deb-src " or "both "')
 
-	if args.suite not in ('scout', 'scout_beta'):
-		parser.error(
-			'This script is only used for the scout LD_LIBRARY_PATH runtime'
-		)
+	if tokens[1] == '[trusted=yes]':
+		trusted=True
+		tokens = [tokens[0]] + tokens[2:]
+	elif tokens[1].startswith('['):
+		raise ValueError(
+			'--extra-apt-source does not support [opt=value] '
+			'syntax, except for [trusted=yes]')
 
-	if not args.packages_from and not args.metapackages:
-		args.metapackages = ['steamrt-ld-library-path', 'steamrt-libs']
+	urls = tokens[1].split('|')
 
-		if args.suite in ('scout', 'scout_beta'):
-			args.metapackages.append('steamrt-legacy')
+	if tokens[0] == 'both':
+		return [
+			AptSource(
+				'deb', urls, tokens[2], tokens[3:],
+				trusted=trusted,
+			),
+			AptSource(
+				'deb-src', urls, tokens[2], tokens[3:],
+				trusted=trusted,
+			),
+		]
+	else:
+		return [
+			AptSource(
+				tokens[0], urls, tokens[2], tokens[3:],
+				trusted=trusted,
+			),
+		]
 
-		if args.debug:
-			args.metapackages.append('steamrt-libdevel')
-			args.metapackages.append('steamrt-libdevel-non-multiarch')
-			# Not really a metapackage, but we want it in the
-			# debug tarball only; container/chroot/Docker
-			# environments get libgl1-mesa-dev instead
-			if args.suite in ('scout', 'scout_beta'):
-				args.metapackages.append('dummygl-dev')
 
-	return args
+# Paragraphs in a deb822 file are separated by one or more blank lines
+PARAGRAPH_SEPARATOR = re.compile(rb'\n(?:[ \t]*\n)+')
+PACKAGE_FIELD = re.compile(rb'^Package:[ \t]*(\S+)', re.M | re.I)
+BINARY_FIELDS = re.compile(
+	rb'^(Architecture|Version|Source):[ \t]*(.*?)[ \t\r]*$', re.M | re.I)
+DEPENDS_FIELDS = re.compile(
+	rb'^(?:Pre-)?Depends:(.*(?:\n[ \t].*)*)', re.M | re.I)
+PROVIDES_FIELD = re.compile(
+	rb'^Provides:(.*(?:\n[ \t].*)*)', re.M | re.I)
 
 
-def download_file(file_url, file_path):
+def map_index(reader):
+	# type: (typing.BinaryIO) -> typing.Union[bytes, mmap.mmap]
+	"""
+	Return the rest of reader as a bytes-like object. If it is a
+	regular file, such as a cached index, it is memory-mapped rather
+	than read. Anything else, such as a decompressing stream, is
+	copied into a temporary file first, so that the whole index is
+	never held in memory.
+	"""
 	try:
-		if os.path.getsize(file_path) > 0:
-			if args.verbose:
-				print("Skipping download of existing file: %s" % file_path)
-			return False
-	except OSError:
-		pass
+		fd = reader.fileno()
+		is_file = stat.S_ISREG(os.fstat(fd).st_mode)
+	except (OSError, ValueError):
+		is_file = False
 
-	try:
-		if args.verbose:
-			print("Downloading %s to %s" % (file_url, file_path))
-		urlretrieve(file_url, file_path)
-	except Exception:
-		sys.stderr.write('Error downloading %s:\n' % file_url)
-		raise
-	return True
+	if not is_file:
+		with tempfile.TemporaryFile() as copy:
+			shutil.copyfileobj(reader, copy, ONE_MEGABYTE)
+			copy.seek(0)
+			return map_index(copy)		# type: ignore
 
+	if reader.tell() != 0 or os.fstat(fd).st_size == 0:
+		return reader.read()
 
-class SourcePackage:
-	def __init__(self, apt_source, stanza):
-		self.apt_source = apt_source
-		self.stanza = stanza
+	return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
 
 
-def install_sources(apt_sources, sourcelist):
-	# Load the Sources files so we can find the location of each source package
-	source_packages = []
+class Deb822Index:
+	"""
+	A decompressed Packages or Sources file, split into paragraphs by
+	byte offset. Nothing is parsed until a subclass is asked for the
+	paragraphs describing particular packages, and even then only the
+	Package field of each paragraph is looked at unless the package
+	is one that the caller wants.
+	"""
 
-	for apt_source in apt_sources:
-		for url in apt_source.sources_urls:
-			print("Downloading sources from %s" % url)
-			sz = urlopen(url)
-			url_file_handle=BytesIO(sz.read())
-			sources = gzip.GzipFile(fileobj=url_file_handle)
-			for stanza in deb822.Sources.iter_paragraphs(sources):
-				source_packages.append(
-					SourcePackage(apt_source, stanza))
+	def __init__(self, buf):
+		# type: (typing.Union[bytes, mmap.mmap]) -> None
+		self.buf = buf
 
-	skipped = 0
-	failed = False
-	included = {}
-	manifest_lines = set()
+	def paragraphs(self):
+		# type: () -> typing.Iterator[typing.Tuple[int, int]]
+		"""
+		Yield (start, end) byte offsets of each paragraph.
+		"""
+		start = 0
 
-	# Walk through the Sources file and process any requested packages.
-	# If a particular source package name appears more than once (for
-	# example in scout and also in an overlay suite), we err on the side
-	# of completeness and download all of them.
-	for sp in source_packages:
-		p = sp.stanza['package']
+		for match in PARAGRAPH_SEPARATOR.finditer(self.buf):
+			if match.start() > start:
+				yield start, match.start() + 1
 
-		# Skip packages with Extra-Source-Only: yes.
-		# These don't necessarily appear in the package pool.
-		if sp.stanza.get('Extra-Source-Only', 'no') == 'yes':
-			continue
+			start = match.end()
 
-		if p in sourcelist:
-			if args.verbose:
-				print("DOWNLOADING SOURCE: %s" % p)
+		if len(self.buf) > start:
+			yield start, len(self.buf)
 
-			#
-			# Create the destination directory if necessary
-			#
-			cache_dir = os.path.join(top, destdir, "source", p)
-			if not os.access(cache_dir, os.W_OK):
-				os.makedirs(cache_dir)
+	def find(
+		self,
+		wanted=None		# type: typing.Optional[typing.Container[str]]
+	):
+		# type: (...) -> typing.Iterator[typing.Tuple[bytes, int, int]]
+		"""
+		Yield (Package, start, end) for each paragraph, or only for
+		the paragraphs whose Package is in wanted.
+		"""
+		for start, end in self.paragraphs():
+			match = PACKAGE_FIELD.search(self.buf, start, end)
+
+			if match is None:
+				continue
 
-			#
-			# Download each file
-			#
-			for file in sp.stanza['files']:
-				check_path_traversal(file['name'])
-				file_path = os.path.join(cache_dir, file['name'])
-				file_url = "%s/%s/%s" % (
-					sp.apt_source.url,
-					sp.stanza['directory'],
-					file['name']
-				)
-				if not download_file(file_url, file_path):
-					skipped += 1
-
-			for file in sp.stanza['files']:
-				if args.strict:
-					hasher = hashlib.md5()
-
-					with open(
-						os.path.join(cache_dir, file['name']),
-						'rb'
-					) as bin_reader:
-						blob = bin_reader.read(4096)
-
-						while blob:
-							hasher.update(blob)
-							blob = bin_reader.read(4096)
-
-						if hasher.hexdigest() != file['md5sum']:
-							print('ERROR: %s has unexpected content' % file['name'])
-							failed = True
-
-				# Copy the source package into the output directory
-				# (optimizing the copy as a hardlink if possible)
-				os.makedirs(os.path.join(args.output, 'source'), exist_ok=True)
-				hard_link_or_copy(
-					os.path.join(cache_dir, file['name']),
-					os.path.join(
-						args.output, 'source', file['name']))
+			package = match.group(1)		# type: bytes
+
+			if wanted is not None and package.decode('utf-8') not in wanted:
+				continue
+
+			yield package, start, end
+
+
+class PackagesIndex(Deb822Index):
+	"""
+	A decompressed Packages file.
+	"""
+
+	def scan(
+		self,
+		wanted=None		# type: typing.Optional[typing.Container[str]]
+	):
+		# type: (...) -> typing.Iterator[typing.Tuple[str, str, str, str, bytes]]
+		"""
+		Yield a tuple (Package, Architecture, Version, Source, raw
+		stanza) for each paragraph, or only for the paragraphs whose
+		Package is in wanted. The rest of each stanza is left
+		unparsed: see Binary.
+		"""
+		buf = self.buf
+
+		for package, start, end in self.find(wanted):
+			fields = {
+				key.lower(): value
+				for key, value in BINARY_FIELDS.findall(
+					buf, start, end)
+			}
+			yield (
+				package.decode('utf-8'),
+				fields[b'architecture'].decode('utf-8'),
+				fields[b'version'].decode('utf-8'),
+				fields.get(b'source', package).decode('utf-8'),
+				buf[start:end],
+			)
+
+
+class SourcesIndex(Deb822Index):
+	"""
+	A decompressed Sources file.
+	"""
+
+	def stanzas(
+		self,
+		wanted=None		# type: typing.Optional[typing.Container[str]]
+	):
+		# type: (...) -> typing.Iterator[deb822.Sources]
+		"""
+		Yield a parsed stanza for each source package, or only for
+		the source packages whose names are in wanted.
+		"""
+		for package, start, end in self.find(wanted):
+			yield deb822.Sources(self.buf[start:end].decode('utf-8'))
+
+
+def parse_packages_index(reader):
+	# type: (typing.BinaryIO) -> PackagesIndex
+	return PackagesIndex(map_index(reader))
+
+
+def parse_sources_index(reader):
+	# type: (typing.BinaryIO) -> SourcesIndex
+	return SourcesIndex(map_index(reader))
+
+
+# Compression formats in which we can download index files, with a
+# function to decompress each one as a stream
+DECOMPRESSORS = {
+	'': lambda reader: reader,
+	'.gz': lambda reader: gzip.GzipFile(fileobj=reader, mode='rb'),
+	'.bz2': lambda reader: bz2.BZ2File(reader),
+	'.xz': lambda reader: lzma.LZMAFile(reader),
+}		# type: typing.Dict[str, typing.Callable[[typing.BinaryIO], typing.Any]]
+
+# (algorithm, hex digest, size) as listed in a Release file
+Checksum = typing.Tuple[str, str, int]
+
+
+class HashingReader(io.RawIOBase):
+	"""
+	Wrap a binary stream, hashing everything that is read through it
+	and optionally copying it to a second file.
+	"""
+
+	def __init__(
+		self,
+		raw,				# type: typing.BinaryIO
+		algorithm='sha256',		# type: str
+		copy_to=None			# type: typing.Optional[typing.BinaryIO]
+	):
+		# type: (...) -> None
+		super(HashingReader, self).__init__()
+		self.raw = raw
+		self.hasher = hashlib.new(algorithm)
+		self.size = 0
+		self.copy_to = copy_to
+
+	def readable(self):
+		# type: () -> bool
+		return True
+
+	def readinto(self, buffer):
+		# type: (typing.Any) -> int
+		blob = self.raw.read(len(buffer))
+		n = len(blob)
+		buffer[:n] = blob
+		self.hasher.update(blob)
+		self.size += n
+
+		if self.copy_to is not None:
+			self.copy_to.write(blob)
+
+		return n
+
+	def matches(self, expected):
+		# type: (typing.Optional[Checksum]) -> bool
+		"""
+		Return True if what was read matches expected, an (algorithm,
+		hex digest, size) tuple as listed in a Release file, or if
+		expected is None.
+		"""
+		if expected is None:
+			return True
+
+		algorithm, digest, size = expected
+		assert algorithm == self.hasher.name
+		return self.size == size and self.hasher.hexdigest() == digest
+
+
+def drain(reader):
+	# type: (typing.BinaryIO) -> None
+	"""
+	Read and discard whatever is left in reader.
+	"""
+	while reader.read(ONE_MEGABYTE):
+		pass
+
+
+def hash_file(
+	path,			# type: str
+	algorithm='sha256'		# type: str
+):
+	# type: (...) -> Checksum
+	with open(path, 'rb') as reader:
+		hasher = HashingReader(reader, algorithm)
+		drain(io.BufferedReader(hasher))
+
+	return (algorithm, hasher.hasher.hexdigest(), hasher.size)
+
+
+def apply_ed_script(
+	lines,		# type: typing.List[bytes]
+	script		# type: typing.Iterable[bytes]
+):
+	# type: (...) -> None
+	"""
+	Apply an ed script in the subset produced by diff --ed, as used
+	for PDiff patches to apt indices, to lines in-place. As with apt's
+	rred, the commands are assumed to be in descending order of line
+	number, so that each one can be applied without renumbering.
+	"""
+	script = iter(script)
+
+	for command in script:
+		match = re.match(rb'^(\d+)(?:,(\d+))?([acd])\n$', command)
+
+		if match is None:
+			raise ValueError('Unsupported ed command %r' % command)
+
+		first = int(match.group(1))
+		last = int(match.group(2) or first)
+		action = match.group(3)
+		text = []		# type: typing.List[bytes]
+
+		if action in (b'a', b'c'):
+			for line in script:
+				if line == b'.\n':
+					break
+
+				text.append(line)
+			else:
+				raise ValueError('Unterminated ed command %r' % command)
+
+		if action == b'a':
+			lines[first:first] = text
+		else:
+			if last > len(lines):
+				raise ValueError('ed command %r out of range' % command)
+
+			lines[first - 1:last] = text
+
+
+class PooledResponse:
+	"""
+	A response from ConnectionPool.urlopen(). When it is closed, its
+	connection goes back to the pool if the whole response was read.
+	"""
+
+	def __init__(
+		self,
+		pool,			# type: ConnectionPool
+		key,			# type: typing.Tuple[str, str]
+		connection,		# type: typing.Optional[http.client.HTTPConnection]
+		response,		# type: typing.Any
+		url			# type: str
+	):
+		# type: (...) -> None
+		self.pool = pool
+		self.key = key
+		self.connection = connection
+		self.response = response
+		self.url = url
+		self.headers = response.headers
+
+	@property
+	def code(self):
+		# type: () -> int
+		return getattr(self.response, 'status', 200)
+
+	def read(self, size=-1):
+		# type: (int) -> bytes
+		if size < 0:
+			return self.response.read()
+
+		return self.response.read(size)
+
+	def close(self):
+		# type: () -> None
+		connection = self.connection
+		self.connection = None
+
+		if connection is None:
+			self.response.close()
+		elif self.response.isclosed() and not self.response.will_close:
+			# We have read the entire response, so the connection
+			# can be used for another request
+			self.pool._release(self.key, connection)
+		else:
+			self.response.close()
+			connection.close()
+
+	def __enter__(self):
+		# type: () -> PooledResponse
+		return self
+
+	def __exit__(self, *exc_info):
+		# type: (...) -> None
+		self.close()
+
+
+class Mirror:
+	"""
+	One of several equivalent URLs for an apt repository, with a
+	running estimate of how quickly it responds.
+	"""
+
+	def __init__(self, url):
+		# type: (str) -> None
+		self.url = url.rstrip('/')
+		# Moving average of the time taken to receive response
+		# headers, or None if no request has succeeded yet
+		self.latency = None		# type: typing.Optional[float]
+		self.active = 0
+		self.requests = 0
+		self.failures = 0
+		# Consecutive failures, and when to stop avoiding the mirror
+		self.errors = 0
+		self.avoid_until = 0.0
+
+	def rank(self, now):
+		# type: (float) -> typing.Tuple[float, float, int]
+		"""
+		Sort key: mirrors that have recently failed last, otherwise
+		whichever is expected to respond soonest given how many
+		requests it is already handling.
+		"""
+		if self.avoid_until > now:
+			return (self.avoid_until, 0.0, self.active)
+
+		return (0.0, (self.latency or 0.0) * (self.active + 1), self.active)
+
+
+class MirrorGroup:
+	"""
+	Equivalent mirrors of one apt repository. The first is the
+	canonical URL by which files are known; requests for them can be
+	sent to any of the mirrors.
+	"""
+
+	# Weight given to each new latency measurement
+	SMOOTHING = 0.3
+
+	def __init__(self, urls):
+		# type: (typing.Sequence[str]) -> None
+		self.mirrors = [Mirror(url) for url in urls]
+		self.url = self.mirrors[0].url
+		self._lock = threading.Lock()
+
+	def __contains__(self, url):
+		# type: (str) -> bool
+		return url == self.url or url.startswith(self.url + '/')
+
+	def add(self, url):
+		# type: (str) -> None
+		with self._lock:
+			if all(m.url != url.rstrip('/') for m in self.mirrors):
+				self.mirrors.append(Mirror(url))
+
+	def translate(self, url, mirror):
+		# type: (str, Mirror) -> str
+		return mirror.url + url[len(self.url):]
+
+	def acquire(self, exclude=()):
+		# type: (typing.Container[Mirror]) -> typing.Optional[Mirror]
+		"""
+		Choose the best mirror that is not in exclude for a new
+		request, or return None if they have all been excluded.
+		"""
+		with self._lock:
+			now = time.monotonic()
+			candidates = [m for m in self.mirrors if m not in exclude]
+
+			if not candidates:
+				return None
+
+			mirror = min(candidates, key=lambda m: m.rank(now))
+			mirror.active += 1
+			mirror.requests += 1
+			return mirror
+
+	def succeeded(self, mirror, elapsed):
+		# type: (Mirror, float) -> None
+		with self._lock:
+			mirror.active -= 1
+			mirror.errors = 0
+			mirror.avoid_until = 0.0
+
+			if mirror.latency is None:
+				mirror.latency = elapsed
+			else:
+				mirror.latency += self.SMOOTHING * (elapsed - mirror.latency)
+
+	def failed(self, mirror):
+		# type: (Mirror) -> None
+		with self._lock:
+			mirror.active -= 1
+			mirror.failures += 1
+			mirror.avoid_until = time.monotonic() + (
+				MIRROR_RETRY_AFTER * 2 ** min(mirror.errors, 4))
+			mirror.errors += 1
+
+
+class ConnectionPool:
+	"""
+	Persistent HTTP and HTTPS connections, shared between threads, so
+	that successive requests to the same repository do not each pay
+	for a new TCP connection and TLS handshake.
+
+	Each connection is used by one thread at a time. Callers are
+	expected to limit how many requests they make to each host at
+	once. Requests via a proxy, and URLs that are not http or https,
+	are passed to urllib instead.
+
+	Requests for a URL in a MirrorGroup are sent to the mirror that
+	is expected to respond soonest, and to the others in turn if it
+	fails. If race_after is not None, a request that has not been
+	answered after that many seconds is also sent to the next mirror,
+	and whichever responds first is used.
+	"""
+
+	MAX_REDIRECTS = 10
+
+	def __init__(
+		self,
+		max_idle_per_host=2 * MAX_CONNECTIONS_PER_HOST,		# type: int
+		timeout=HTTP_TIMEOUT					# type: float
+	):
+		# type: (...) -> None
+		self.max_idle_per_host = max_idle_per_host
+		self.timeout = timeout
+		# {('https', 'repo.steampowered.com'): [connection, ...]}
+		self._idle = {}		# type: typing.Dict[typing.Tuple[str, str], typing.List[http.client.HTTPConnection]]
+		self._lock = threading.Lock()
+		# {'repo.steampowered.com': [requests, connections opened]}
+		self.stats = {}		# type: typing.Dict[str, typing.List[int]]
+		self.unpooled = 0
+		self._proxies = getproxies()
+		self.mirrors = []		# type: typing.List[MirrorGroup]
+		self.race_after = None		# type: typing.Optional[float]
+
+	def add_mirrors(self, urls):
+		# type: (typing.Sequence[str]) -> MirrorGroup
+		"""
+		Declare that urls are equivalent mirrors of the same apt
+		repository, the first being the one by which it is known.
+		"""
+		group = self.mirror_group(urls[0])
+
+		if group is None or group.url != urls[0].rstrip('/'):
+			group = MirrorGroup(urls)
+
+			with self._lock:
+				self.mirrors.append(group)
+		else:
+			for url in urls:
+				group.add(url)
+
+		return group
+
+	def mirror_group(self, url):
+		# type: (str) -> typing.Optional[MirrorGroup]
+		for group in self.mirrors:
+			if url in group:
+				return group
+
+		return None
+
+	def mirror_count(self, url):
+		# type: (str) -> int
+		group = self.mirror_group(url)
+
+		if group is None:
+			return 1
+
+		return len(group.mirrors)
+
+	def _count(self, host, requests, opened):
+		# type: (str, int, int) -> None
+		with self._lock:
+			stats = self.stats.setdefault(host, [0, 0])
+			stats[0] += requests
+			stats[1] += opened
+
+	def _acquire(self, key):
+		# type: (typing.Tuple[str, str]) -> typing.Optional[http.client.HTTPConnection]
+		with self._lock:
+			idle = self._idle.get(key)
+
+			if idle:
+				return idle.pop()
+
+		return None
+
+	def _release(self, key, connection):
+		# type: (typing.Tuple[str, str], http.client.HTTPConnection) -> None
+		with self._lock:
+			idle = self._idle.setdefault(key, [])
+
+			if len(idle) < self.max_idle_per_host:
+				idle.append(connection)
+				return
+
+		connection.close()
+
+	def _use_urllib(self, url):
+		# type: (str) -> bool
+		parts = urlsplit(url)
+
+		if parts.scheme not in ('http', 'https'):
+			return True
+
+		return (
+			parts.scheme in self._proxies
+			and not proxy_bypass(parts.hostname or '')
+		)
+
+	def urlopen(self, request):
+		# type: (typing.Union[str, Request]) -> typing.Any
+		"""
+		Open a URL, like urllib.request.urlopen(). Redirections are
+		followed. An HTTPError is raised for any other response that
+		is not successful, including 304 Not Modified.
+		"""
+		if isinstance(request, str):
+			request = Request(request)
+
+		group = self.mirror_group(request.full_url)
+
+		if group is None:
+			return self._open(request)
+
+		if self.race_after is None or len(group.mirrors) < 2:
+			return self._failover(group, request)
+
+		return self._race(group, request)
+
+	def _attempt(self, group, mirror, request):
+		# type: (MirrorGroup, Mirror, Request) -> typing.Any
+		"""
+		Send request to mirror, which has already been acquired from
+		group, and record how long it took to respond.
+		"""
+		start = time.monotonic()
+
+		try:
+			response = self._open(Request(
+				group.translate(request.full_url, mirror),
+				headers=dict(request.header_items()),
+			))
+		except BaseException as e:
+			# Responses such as 304 Not Modified or 404 Not Found
+			# show that the mirror is working
+			if is_mirror_failure(e):
+				group.failed(mirror)
+			else:
+				group.succeeded(mirror, time.monotonic() - start)
+
+			raise
+
+		group.succeeded(mirror, time.monotonic() - start)
+		return response
+
+	def _failover(self, group, request):
+		# type: (MirrorGroup, Request) -> typing.Any
+		tried = []		# type: typing.List[Mirror]
+
+		while True:
+			mirror = group.acquire(tried)
+			assert mirror is not None
+			tried.append(mirror)
+
+			try:
+				return self._attempt(group, mirror, request)
+			except BaseException as e:
+				if (
+					not is_mirror_failure(e)
+					or len(tried) == len(group.mirrors)
+				):
+					raise
+
+	def _race(self, group, request):
+		# type: (MirrorGroup, Request) -> typing.Any
+		results = queue.Queue()		# type: queue.Queue
+		tried = []		# type: typing.List[Mirror]
+		pending = 0
+		error = None		# type: typing.Optional[BaseException]
+
+		def attempt(mirror):
+			# type: (Mirror) -> None
+			try:
+				results.put((self._attempt(group, mirror, request), None))
+			except BaseException as e:
+				results.put((None, e))
+
+		def discard(n):
+			# type: (int) -> None
+			# Close the responses that lost the race as they arrive
+			for i in range(n):
+				response, e = results.get()
+
+				if response is not None:
+					response.close()
+
+		while True:
+			# Start a request to another mirror, initially or
+			# because every request so far has failed or is slow
+			mirror = group.acquire(tried)
+
+			if mirror is not None:
+				tried.append(mirror)
+				pending += 1
+				threading.Thread(
+					target=attempt, args=(mirror,), daemon=True,
+				).start()
+			elif pending == 0:
+				assert error is not None
+				raise error
+
+			while pending:
+				try:
+					response, e = results.get(
+						timeout=self.race_after if mirror is not None else None)
+				except queue.Empty:
+					break
+
+				pending -= 1
+
+				if e is None or not is_mirror_failure(e):
+					if pending:
+						threading.Thread(
+							target=discard, args=(pending,), daemon=True,
+						).start()
+
+					if e is not None:
+						raise e
+
+					return response
+
+				error = e
+
+				# Fail over to another mirror straight away
+				break
+
+	def _open(self, request):
+		# type: (Request) -> typing.Any
+		url = request.full_url
+
+		if self._use_urllib(url):
+			with self._lock:
+				self.unpooled += 1
+
+			return urlopen(request, timeout=self.timeout)
+
+		headers = dict(request.header_items())
+		headers.setdefault(
+			'User-agent', 'Python-urllib/%d.%d' % sys.version_info[:2])
+
+		for i in range(self.MAX_REDIRECTS + 1):
+			response = self._request(url, headers)
+
+			if response.code in (301, 302, 303, 307, 308):
+				location = response.headers.get('Location')
+				response.read()
+				response.close()
+
+				if location is None or i == self.MAX_REDIRECTS:
+					break
+
+				url = urljoin(url, location)
+				continue
+
+			if 200 <= response.code < 300:
+				return response
+
+			blob = response.read()
+			response.close()
+			raise HTTPError(
+				url, response.code, response.response.reason,
+				response.headers, io.BytesIO(blob))
+
+		raise HTTPError(
+			url, response.code, 'Too many redirects',
+			response.headers, None)
+
+	def _request(self, url, headers):
+		# type: (str, typing.Dict[str, str]) -> PooledResponse
+		parts = urlsplit(url)
+		key = (parts.scheme, parts.netloc)
+		path = parts.path or '/'
+
+		if parts.query:
+			path += '?' + parts.query
+
+		connection = self._acquire(key)
+
+		if connection is not None:
+			try:
+				connection.request('GET', path, headers=headers)
+				response = connection.getresponse()
+			except (http.client.HTTPException, OSError):
+				# The server probably closed the idle
+				# connection: try again with a new one
+				connection.close()
+			else:
+				self._count(parts.netloc, 1, 0)
+				return PooledResponse(
+					self, key, connection, response, url)
+
+		if parts.scheme == 'https':
+			connection = http.client.HTTPSConnection(
+				parts.netloc, timeout=self.timeout)
+		else:
+			connection = http.client.HTTPConnection(
+				parts.netloc, timeout=self.timeout)
+
+		try:
+			connection.request('GET', path, headers=headers)
+			response = connection.getresponse()
+		except OSError as e:
+			connection.close()
+			raise URLError(e)
+		except BaseException:
+			connection.close()
+			raise
+
+		self._count(parts.netloc, 1, 1)
+		return PooledResponse(self, key, connection, response, url)
+
+	def close(self):
+		# type: () -> None
+		with self._lock:
+			idle = self._idle
+			self._idle = {}
+
+		for connections in idle.values():
+			for connection in connections:
+				connection.close()
+
+	def report(self):
+		# type: () -> None
+		for host, (requests, opened) in sorted(self.stats.items()):
+			print(
+				"Made %d HTTP request(s) to %s using %d connection(s)"
+				% (requests, host, opened))
+
+		for group in self.mirrors:
+			for mirror in group.mirrors:
+				if mirror.latency is None:
+					latency = 'unknown'
+				else:
+					latency = '%.0fms' % (mirror.latency * 1000)
+
+				print(
+					"Mirror %s: %d request(s), %d failed, latency %s"
+					% (
+						mirror.url, mirror.requests, mirror.failures,
+						latency,
+					))
+
+
+# All network access goes through this pool
+http_pool = ConnectionPool()
+
+
+class IndexCache:
+	"""
+	Persistent cache of decompressed repository metadata, keyed by the
+	URL of the uncompressed file and stored in the same flat layout as
+	apt's /var/lib/apt/lists. Each file has a .headers file alongside
+	it, recording the URL it was actually downloaded from, the checksum
+	listed for that URL in the Release file if any, and the ETag and
+	Last-Modified headers it was served with.
+	"""
+
+	def __init__(self, path):
+		# type: (str) -> None
+		# The directory is created by create(), so that merely
+		# looking for cached files has no side-effects
+		self.path = path
+
+	def filename(self, url):
+		# type: (str) -> str
+		parts = urlsplit(url)
+		return os.path.join(
+			self.path,
+			(parts.netloc + parts.path).replace('/', '_'),
+		)
+
+	def open(self, url):
+		# type: (str) -> typing.Optional[typing.BinaryIO]
+		"""
+		Return the cached copy of url, opened for reading, or None.
+		"""
+		try:
+			return open(self.filename(url), 'rb')
+		except FileNotFoundError:
+			return None
+
+	def checksum(
+		self,
+		url,			# type: str
+		algorithm='sha256'		# type: str
+	):
+		# type: (...) -> typing.Optional[Checksum]
+		"""
+		Return the checksum of the cached copy of url, or None.
+		"""
+		try:
+			return hash_file(self.filename(url), algorithm)
+		except FileNotFoundError:
+			return None
+
+	def metadata(self, url):
+		# type: (str) -> typing.Dict[str, typing.Any]
+		filename = self.filename(url)
+
+		if not os.path.exists(filename):
+			return {}
+
+		try:
+			with open(filename + '.headers') as reader:
+				return json.load(reader)
+		except (OSError, ValueError):
+			return {}
+
+	def create(self):
+		# type: () -> typing.BinaryIO
+		"""
+		Return a new temporary file to be passed to commit() or
+		discard().
+		"""
+		os.makedirs(self.path, exist_ok=True)
+		return tempfile.NamedTemporaryFile(		# type: ignore
+			dir=self.path, prefix='.tmp', delete=False,
+		)
+
+	def discard(self, writer):
+		# type: (typing.BinaryIO) -> None
+		writer.close()
+		os.unlink(writer.name)
+
+	def commit(
+		self,
+		url,		# type: str
+		writer,		# type: typing.BinaryIO
+		metadata		# type: typing.Dict[str, typing.Any]
+	):
+		# type: (...) -> None
+		"""
+		Store writer, as returned by create(), as the cached copy of
+		url. Temporary files are renamed into place so that
+		concurrent or interrupted builds never see a partially-written
+		file.
+		"""
+		filename = self.filename(url)
+		writer.close()
+		os.replace(writer.name, filename)
+
+		with self.create() as metadata_writer:
+			metadata_writer.write(json.dumps(metadata).encode('utf-8'))
+
+		os.replace(metadata_writer.name, filename + '.headers')
+
+
+class IndexFetcher:
+	"""
+	Download and parse repository metadata (Release, Packages and
+	Sources files) in a pool of worker threads, opening at most
+	max_per_host simultaneous connections to any one host.
+
+	Each index is identified by the URL of its uncompressed form, and
+	only fetched once. Results are retrieved by URL, so callers can
+	consume them in the same deterministic order in which they would
+	previously have downloaded them one at a time.
+
+	If a Release file has been added with add_release(), the smallest
+	compressed form of each index that it lists is downloaded, from a
+	by-hash URL if the repository supports that, and verified against
+	its checksum. Files are decompressed while they are downloaded,
+	but only parsed once they have been verified: if a file does not
+	match the Release file, the next form of it is tried instead.
+
+	If cache is not None, decompressed indices are kept there. A cached
+	index that still matches the Release file is not downloaded again.
+	One that has changed is brought up to date with PDiff patches if
+	possible, and otherwise downloaded in full. Files that are not
+	listed in any Release file are revalidated with a conditional
+	request.
+	"""
+
+	def __init__(
+		self,
+		cache=None,					# type: typing.Optional[IndexCache]
+		max_per_host=MAX_CONNECTIONS_PER_HOST,		# type: int
+		max_workers=MAX_FETCH_THREADS			# type: int
+	):
+		# type: (...) -> None
+		self.cache = cache
+		self.checksums = {}		# type: typing.Dict[str, Checksum]
+		self.by_hash = set()		# type: typing.Set[str]
+		self.reused = 0
+		self.patched = 0
+		self.max_per_host = max_per_host
+		self._executor = concurrent.futures.ThreadPoolExecutor(
+			max_workers=max_workers,
+			thread_name_prefix='fetch',
+		)
+		self._futures = {}		# type: typing.Dict[str, concurrent.futures.Future]
+		self._hosts = {}		# type: typing.Dict[str, threading.BoundedSemaphore]
+		self._lock = threading.Lock()
+
+	def _host_slot(self, url):
+		# type: (str) -> threading.BoundedSemaphore
+		host = urlsplit(url).netloc
+
+		with self._lock:
+			if host not in self._hosts:
+				# Requests for a repository with several mirrors
+				# are spread between them
+				self._hosts[host] = threading.BoundedSemaphore(
+					self.max_per_host * http_pool.mirror_count(url))
+
+			return self._hosts[host]
+
+	def add_release(
+		self,
+		release_url,		# type: str
+		release			# type: deb822.Release
+	):
+		# type: (...) -> None
+		"""
+		Record the checksums of the files listed in a Release file, so
+		that they can be verified, and cached copies of them can be
+		used without revalidation.
+		"""
+		assert release_url.endswith('Release')
+		base = release_url[:-len('Release')]
+
+		if str2bool(release.get('Acquire-By-Hash', 'no')):
+			self.by_hash.add(base)
+
+		for field, algorithm in (('SHA256', 'sha256'), ('MD5Sum', 'md5sum')):
+			if field not in release:
+				continue
+
+			for entry in release[field]:
+				self.checksums[base + entry['name']] = (
+					algorithm.replace('sum', ''),
+					entry[algorithm],
+					int(entry['size']),
+				)
+
+			break
+
+	def index_checksum(self, url):
+		# type: (str) -> typing.Optional[Checksum]
+		"""
+		Return a checksum that identifies the current content of the
+		index url, in any of its compressed forms, or None if no
+		Release file lists it.
+		"""
+		for suffix in sorted(DECOMPRESSORS):
+			if url + suffix in self.checksums:
+				return self.checksums[url + suffix]
+
+		return None
+
+	def _candidates(
+		self,
+		url,			# type: str
+		compression		# type: str
+	):
+		# type: (...) -> typing.List[typing.Tuple[str, str, typing.Optional[Checksum]]]
+		"""
+		Return a list of (suffix, download URL, expected checksum) for
+		the forms of url that we could download, best first.
+		"""
+		listed = [
+			(self.checksums[url + suffix][2], suffix)
+			for suffix in DECOMPRESSORS
+			if url + suffix in self.checksums
+		]
+
+		if not listed:
+			return [(compression, url + compression, None)]
+
+		ret = []		# type: typing.List[typing.Tuple[str, str, typing.Optional[Checksum]]]
+
+		for size, suffix in sorted(listed):
+			expected = self.checksums[url + suffix]
+
+			if (
+				expected[0] == 'sha256'
+				and any(url.startswith(base) for base in self.by_hash)
+			):
+				ret.append((
+					suffix,
+					'%s/by-hash/SHA256/%s' % (
+						url.rsplit('/', 1)[0], expected[1]),
+					expected,
+				))
+
+			ret.append((suffix, url + suffix, expected))
+
+		return ret
+
+	def _reuse(
+		self,
+		url,		# type: str
+		reader,		# type: typing.BinaryIO
+		parse,		# type: typing.Callable[[typing.BinaryIO], typing.Any]
+		how		# type: str
+	):
+		# type: (...) -> typing.Any
+		with self._lock:
+			self.reused += 1
+
+		if args.verbose:
+			print("Using %s copy of %s" % (how, url))
+
+		with reader:
+			return parse(reader)
+
+	def _open_cached(
+		self,
+		url,			# type: str
+		candidates		# type: typing.List[typing.Tuple[str, str, typing.Optional[Checksum]]]
+	):
+		# type: (...) -> typing.Optional[typing.BinaryIO]
+		"""
+		Return the cached copy of url if it is known to be up to date.
+		"""
+		assert self.cache is not None
+		expected = self.checksums.get(url)
+
+		if expected is not None:
+			if self.cache.checksum(url, expected[0]) != expected:
+				return None
+		else:
+			# The Release file only lists compressed forms, so
+			# compare with the one we downloaded last time
+			checksum = self.cache.metadata(url).get('checksum')
+
+			if checksum is None or not any(
+				tuple(checksum) == c[2] for c in candidates
+			):
+				return None
+
+		return self.cache.open(url)
+
+	def _download(self, url):
+		# type: (str) -> bytes
+		"""
+		Download a small file such as a PDiff patch into memory,
+		verifying it against a Release file if possible.
+		"""
+		with http_pool.urlopen(url) as response:
+			blob = response.read()
+
+		expected = self.checksums.get(url)
+
+		if expected is not None and (
+			len(blob) != expected[2]
+			or hashlib.new(expected[0], blob).hexdigest() != expected[1]
+		):
+			raise ValueError('%s does not match its Release file' % url)
+
+		return blob
+
+	def _patch(self, url):
+		# type: (str) -> bool
+		"""
+		Try to bring the cached copy of url up to date by applying
+		PDiff patches listed in url.diff/Index. Return True on success.
+		"""
+		assert self.cache is not None
+		index_url = url + '.diff/Index'
+
+		if index_url not in self.checksums:
+			return False
+
+		cached = self.cache.checksum(url)
+
+		if cached is None:
+			return False
+
+		try:
+			index = deb822.Deb822(self._download(index_url))
+			history = [
+				line.split() for line in
+				index['SHA256-History'].strip().splitlines()
+			]
+			patches = {
+				name: (digest, int(size))
+				for digest, size, name in (
+					line.split() for line in
+					index['SHA256-Patches'].strip().splitlines()
+				)
+			}
+			downloads = {
+				name: ('sha256', digest, int(size))
+				for digest, size, name in (
+					line.split() for line in
+					index.get('SHA256-Download', '').strip().splitlines()
+				)
+			}
+			current_digest, current_size = index['SHA256-Current'].split()
+		except (KeyError, ValueError, URLError) as e:
+			if args.verbose:
+				print("Unable to use PDiffs for %s: %s" % (url, e))
+
+			return False
+
+		for i, (digest, size, name) in enumerate(history):
+			if (digest, int(size)) == cached[1:]:
+				break
+		else:
+			return False
+
+		if index.get('X-Patch-Precedence') == 'merged':
+			# Each patch goes directly to the current version
+			names = [name]
+		else:
+			names = [entry[2] for entry in history[i:]]
+
+		with self.cache.open(url) as reader:		# type: ignore
+			lines = reader.readlines()
+
+		try:
+			for name in names:
+				patch_url = '%s.diff/%s.gz' % (url, name)
+
+				if name + '.gz' in downloads:
+					self.checksums[patch_url] = downloads[name + '.gz']
+
+				patch = gzip.decompress(self._download(patch_url))
+
+				if (
+					(hashlib.sha256(patch).hexdigest(), len(patch))
+					!= patches[name]
+				):
+					raise ValueError(
+						'%s does not match Index' % patch_url)
+
+				apply_ed_script(lines, patch.splitlines(keepends=True))
+		except (KeyError, ValueError, OSError) as e:
+			if args.verbose:
+				print("Unable to apply PDiffs to %s: %s" % (url, e))
+
+			return False
+
+		writer = self.cache.create()
+		hasher = hashlib.sha256()
+
+		for line in lines:
+			writer.write(line)
+			hasher.update(line)
+
+		expected = self.checksums.get(url)
+
+		if (
+			hasher.hexdigest() != current_digest
+			or writer.tell() != int(current_size)
+			or (expected is not None and (
+				expected[0] != 'sha256'
+				or expected[1] != current_digest
+			))
+		):
+			if args.verbose:
+				print("PDiffs for %s did not produce the expected result" % url)
+
+			self.cache.discard(writer)
+			return False
+
+		self.cache.commit(url, writer, {
+			'checksum': self.index_checksum(url),
+		})
+
+		with self._lock:
+			self.patched += 1
+
+		if args.verbose:
+			print("Updated %s with %d PDiff patch(es)" % (url, len(names)))
+
+		return True
+
+	def _fetch(
+		self,
+		url,		# type: str
+		parse,		# type: typing.Callable[[typing.BinaryIO], typing.Any]
+		compression		# type: str
+	):
+		# type: (...) -> typing.Any
+		cache = self.cache
+		candidates = self._candidates(url, compression)
+		local = local_path(url)
+
+		if local is not None and os.path.isfile(local):
+			# A local mirror with uncompressed indices: they can
+			# be memory-mapped in place, without being copied, if
+			# they match the Release file. If it only lists other
+			# forms, they are verified below instead.
+			expected = self.checksums.get(url)
+
+			if expected is not None or candidates[0][2] is None:
+				with open(local, 'rb') as mirrored:
+					if expected is not None:
+						hasher = HashingReader(mirrored, expected[0])
+						drain(io.BufferedReader(hasher))
+						actual = (
+							expected[0], hasher.hasher.hexdigest(),
+							hasher.size)
+						mirrored.seek(0)
+
+					if expected is None or actual == expected:
+						return parse(mirrored)
+
+				sys.stderr.write(
+					'WARNING: %s does not match its Release file\n' % (
+						local))
+
+		if cache is not None:
+			reader = self._open_cached(url, candidates)
+
+			if reader is not None:
+				return self._reuse(url, reader, parse, 'cached')
+
+		with self._host_slot(url):
+			if cache is not None and self._patch(url):
+				reader = cache.open(url)
+
+				if reader is not None:
+					with reader:
+						return parse(reader)
+
+			error = None		# type: typing.Optional[Exception]
+
+			for suffix, download_url, expected in candidates:
+				request = Request(download_url)
+
+				if cache is not None and expected is None:
+					metadata = cache.metadata(url)
+
+					if metadata.get('url') == download_url:
+						if metadata.get('etag'):
+							request.add_header(
+								'If-None-Match',
+								metadata['etag'])
+
+						if metadata.get('last-modified'):
+							request.add_header(
+								'If-Modified-Since',
+								metadata['last-modified'])
+
+				try:
+					response = http_pool.urlopen(request)
+				except HTTPError as e:
+					if e.code == 304 and cache is not None:
+						reader = cache.open(url)
+
+						if reader is not None:
+							return self._reuse(
+								url, reader, parse,
+								'revalidated')
+
+					# Try the next candidate, if any: for
+					# example a by-hash URL might have been
+					# garbage-collected already
+					error = e
+					continue
+
+				# Decompress into a file and verify it before
+				# parsing anything, so that the result never
+				# comes from a corrupt or truncated download,
+				# and so that the index can be memory-mapped
+				if cache is not None:
+					copy = cache.create()
+				else:
+					copy = tempfile.TemporaryFile()		# type: ignore
+
+				try:
+					with response:
+						compressed = HashingReader(
+							response,
+							expected[0] if expected is not None else 'sha256',
+						)
+						uncompressed = HashingReader(
+							DECOMPRESSORS[suffix](
+								io.BufferedReader(compressed)),
+							self.checksums.get(url, ('sha256', '', 0))[0],
+							copy_to=copy,
+						)
+						drain(io.BufferedReader(uncompressed))
+						drain(io.BufferedReader(compressed))
+
+					if not (
+						compressed.matches(expected)
+						and uncompressed.matches(self.checksums.get(url))
+					):
+						raise ValueError(
+							'%s does not match its Release file'
+							% download_url)
+				except Exception as e:
+					if cache is not None:
+						cache.discard(copy)
+					else:
+						copy.close()
+
+					sys.stderr.write(
+						'WARNING: Unable to use %s: %s\n'
+						% (download_url, e))
+					error = e
+					continue
+				except BaseException:
+					if cache is not None:
+						cache.discard(copy)
+					else:
+						copy.close()
+
+					raise
+
+				break
+			else:
+				assert error is not None
+				raise error
+
+		if cache is not None:
+			cache.commit(url, copy, {
+				'url': download_url,
+				'checksum': expected,
+				'etag': response.headers.get('ETag'),
+				'last-modified': response.headers.get('Last-Modified'),
+			})
+			reader = cache.open(url)
+
+			if reader is None:
+				raise FileNotFoundError(cache.filename(url))
+
+			copy = reader
+
+		with copy:
+			copy.seek(0)
+			return parse(copy)
+
+	def submit(
+		self,
+		url,			# type: str
+		parse,			# type: typing.Callable[[typing.BinaryIO], typing.Any]
+		compression=''		# type: str
+	):
+		# type: (...) -> concurrent.futures.Future
+		"""
+		Start downloading url in the background, if not already done,
+		and parse its uncompressed content with parse(reader) while it
+		is downloaded. If no Release file lists url, download it with
+		the given compression suffix.
+		"""
+		with self._lock:
+			if url not in self._futures:
+				self._futures[url] = self._executor.submit(
+					self._fetch, url, parse, compression)
+
+			return self._futures[url]
+
+	def result(self, url):
+		# type: (str) -> typing.Any
+		"""
+		Wait for url to have been downloaded and parsed, and return
+		the parsed result, or raise the exception that was raised
+		while fetching it.
+		"""
+		return self._futures[url].result()
+
+	def shutdown(self):
+		# type: () -> None
+		self._executor.shutdown(wait=True)
+
+
+def queue_index_downloads(
+	fetcher,		# type: IndexFetcher
+	apt_sources,		# type: typing.List[AptSource]
+	snapshots=None		# type: typing.Optional[BinarySnapshots]
+):
+	# type: (...) -> None
+	"""
+	Start downloading all the Packages and Sources files that this
+	build is going to need, so that list_binaries() and install_sources()
+	do not have to wait for them one at a time. Packages files are not
+	needed if list_binaries() will be able to use a snapshot.
+	"""
+	for dbgsym in ((False, True) if args.symbols else (False,)):
+		if snapshots is not None and snapshots.has(
+			packages_snapshot_key(apt_sources, fetcher, dbgsym)
+		):
+			continue
+
+		for arch in args.architectures:
+			for apt_source in apt_sources:
+				for url in apt_source.get_packages_urls(
+					arch,
+					dbgsym=dbgsym,
+				):
+					fetcher.submit(url, parse_packages_index, '.gz')
+
+	if args.source:
+		for apt_source in apt_sources:
+			for url in apt_source.sources_urls:
+				fetcher.submit(url, parse_sources_index, '.gz')
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		"--templates",
+		help="specify template files to include in runtime",
+		default=os.path.join(top, "templates"))
+	parser.add_argument(
+		"-o", "--output", default=None,
+		help="specify output directory [default: delete after archiving]")
+	parser.add_argument("--suite", help="specify apt suite", default='scout')
+	parser.add_argument("-b", "--beta", help="build beta runtime", dest='suite', action="store_const", const='scout_beta')
+	parser.add_argument("-d", "--debug", help="build debug runtime", action="store_true")
+	parser.add_argument("--source", help="include sources", action="store_true")
+	parser.add_argument("--symbols", help="include debugging symbols", action="store_true")
+	parser.add_argument(
+		"--repo", help=(
+			"main apt repository URL, or the path to a local mirror "
+			"directory to use its files in-place"
+		),
+		default="https://repo.steampowered.com/steamrt",
+	)
+	parser.add_argument(
+		"--mirror", dest='mirrors', metavar='URL',
+		default=[], action='append',
+		help=(
+			"download from URL, an equivalent mirror of --repo, as "
+			"well as from --repo itself (may be repeated)"
+		),
+	)
+	parser.add_argument(
+		"--race-after", metavar='SECONDS', type=float, default=None,
+		help=(
+			"if a mirror has not responded to a request after "
+			"SECONDS, send the request to another mirror too"
+		),
+	)
+	parser.add_argument(
+		"--upstream-apt-source", dest='upstream_apt_sources',
+		default=[], action='append',
+		help=(
+			"additional apt sources in the form "
+			"'deb https://URL SUITE COMPONENT [COMPONENT...]' "
+			"(may be repeated)"
+		),
+	)
+	parser.add_argument(
+		"--extra-apt-source", dest='extra_apt_sources',
+		default=[], action='append',
+		help=(
+			"additional apt sources in the form "
+			"'deb https://URL SUITE COMPONENT [COMPONENT...]' "
+			"(may be repeated)"
+		),
+	)
+	parser.add_argument(
+		"--cache-dir", default=os.path.join(top, destdir),
+		help=(
+			"directory in which to cache downloaded packages and "
+			"repository metadata [default: %(default)s]"
+		),
+	)
+	parser.add_argument(
+		"--cache-size", metavar="SIZE", type=parse_size, default=None,
+		help=(
+			"delete the least recently used packages from the cache "
+			"directory when it is larger than SIZE, for example "
+			"20G [default: no limit]"
+		),
+	)
+	parser.add_argument(
+		"--link-unpacked", action="store_true",
+		help=(
+			"hard-link files from the cache directory into the "
+			"output instead of cloning or copying them. This is "
+			"faster on filesystems that cannot clone files, but "
+			"modifying an output file in-place, for example with "
+			"sed -i, strip or chmod, would also corrupt the cache "
+			"for later builds"
+		),
+	)
+	parser.add_argument(
+		"--gc", action="store_true",
+		help=(
+			"delete partial downloads, packages beyond --cache-size, "
+			"and unpacked copies of packages that are no longer "
+			"downloaded, from the cache directory and exit"
+		),
+	)
+	parser.add_argument(
+		"-j", "--jobs", metavar="N", type=int,
+		default=len(os.sched_getaffinity(0)),
+		help=(
+			"unpack up to N packages at the same time "
+			"[default: number of CPUs, %(default)s]"
+		),
+	)
+	parser.add_argument("-v", "--verbose", help="verbose", action="store_true")
+	parser.add_argument("--official", help="mark this as an official runtime", action="store_true")
+	parser.add_argument("--set-name", help="set name for this runtime", default=None)
+	parser.add_argument("--set-version", help="set version number for this runtime", default=None)
+	parser.add_argument("--debug-url", help="set URL for debug/source version", default=None)
+	parser.add_argument("--archive", help="pack Steam Runtime into a tarball", default=None)
+	parser.add_argument(
+		"--compression", help="set compression [xz|gx|bz2|none]",
+		choices=('xz', 'gz', 'bz2', 'none'),
+		default='xz')
+	parser.add_argument(
+		'--strict', action="store_true",
+		help='Exit unsuccessfully when something seems wrong')
+	parser.add_argument(
+		'--split', default=None,
+		help='Also generate an archive split into 50M parts')
+	parser.add_argument(
+		'--architecture', '--arch',
+		help='include architecture (the first is assumed to be primary)',
+		action='append', dest='architectures', default=[],
+	)
+	parser.add_argument(
+		'--metapackage',
+		help='Include the given package and its dependencies',
+		action='append', dest='metapackages', default=[],
+	)
+	parser.add_argument(
+		'--packages-from',
+		help='Include packages listed in the given file',
+		action='append', default=[],
+	)
+	parser.add_argument(
+		'--plan', metavar='FILE', default=None,
+		help=(
+			'resolve dependencies, write a JSON description of what '
+			'would be downloaded and unpacked to FILE ("-" for '
+			'standard output), and exit without building a runtime'
+		),
+	)
+	parser.add_argument(
+		'--write-lockfile', metavar='FILE', default=None,
+		help=(
+			'write the exact set of packages that were included '
+			'to FILE, for use with --lockfile'
+		),
+	)
+	parser.add_argument(
+		'--lockfile', metavar='FILE', default=None,
+		help=(
+			'include exactly the packages listed in FILE, which '
+			'was written by --write-lockfile, instead of resolving '
+			'dependencies from the Packages files. --repo, --suite, '
+			'--arch and the options that add apt sources are ignored'
+		),
+	)
+	parser.add_argument(
+		'--dump-options', action='store_true',
+		help=argparse.SUPPRESS,		# deliberately undocumented
+	)
+
+	args = parser.parse_args()
+
+	if args.gc:
+		return args
+
+	if args.output is None and args.archive is None and args.plan is None:
+		parser.error(
+			'At least one of --output, --archive and --plan is required')
+
+	if args.lockfile is not None and args.plan is not None:
+		parser.error('--plan cannot be combined with --lockfile')
+
+	if args.split is not None and args.archive is None:
+		parser.error('--split requires --archive')
+
+	if args.jobs < 1:
+		parser.error('Argument to --jobs must be at least 1')
+
+	# A local mirror: refer to it by URL, so that it can be used
+	# like any other apt source, but without copying its files
+	if os.path.isdir(args.repo):
+		args.repo = 'file://' + pathname2url(os.path.abspath(args.repo))
+
+	args.mirrors = [
+		'file://' + pathname2url(os.path.abspath(m))
+		if os.path.isdir(m) else m
+		for m in args.mirrors
+	]
+
+	if not os.path.isdir(args.templates):
+		parser.error(
+			'Argument to --templates, %r, must be a directory'
+			% args.templates)
+
+	# os.path.exists is false for dangling symlinks, so check for both
+	if args.output is not None and (
+		os.path.exists(args.output)
+		or os.path.islink(args.output)
+	):
+		parser.error(
+			'Argument to --output, %r, must not already exist'
+			% args.output)
+
+	if not args.architectures:
+		args.architectures = list(DEFAULT_ARCHITECTURES)
+
+	if args.suite not in ('scout', 'scout_beta'):
+		parser.error(
+			'This script is only used for the scout LD_LIBRARY_PATH runtime'
+		)
+
+	if not args.packages_from and not args.metapackages:
+		args.metapackages = ['steamrt-ld-library-path', 'steamrt-libs']
+
+		if args.suite in ('scout', 'scout_beta'):
+			args.metapackages.append('steamrt-legacy')
+
+		if args.debug:
+			args.metapackages.append('steamrt-libdevel')
+			args.metapackages.append('steamrt-libdevel-non-multiarch')
+			# Not really a metapackage, but we want it in the
+			# debug tarball only; container/chroot/Docker
+			# environments get libgl1-mesa-dev instead
+			if args.suite in ('scout', 'scout_beta'):
+				args.metapackages.append('dummygl-dev')
+
+	return args
+
+
+def is_transient_error(e):
+	# type: (BaseException) -> bool
+	"""
+	Return True if a download that failed with e might succeed if
+	it is tried again: the server timed out, dropped the connection
+	or said it was temporarily unavailable. Other errors, such as a
+	host name that cannot be resolved, a refused connection or a
+	local file that cannot be written, are not retried.
+	"""
+	if isinstance(e, HTTPError):
+		return e.code in (408, 429) or e.code >= 500
+
+	if isinstance(e, URLError):
+		e = e.reason		# type: ignore
+
+	return isinstance(e, (
+		socket.timeout,
+		ConnectionResetError,
+		ConnectionAbortedError,
+		BrokenPipeError,
+		http.client.IncompleteRead,
+		http.client.RemoteDisconnected,
+	))
+
+
+def is_mirror_failure(e):
+	# type: (BaseException) -> bool
+	"""
+	Return True if a request to a mirror that failed with e might
+	succeed on another mirror: as well as transient errors, this
+	includes failing to connect to the mirror at all.
+	"""
+	if is_transient_error(e):
+		return True
+
+	if isinstance(e, HTTPError):
+		return False
+
+	return isinstance(e, (URLError, ConnectionError))
+
+
+def continue_download(
+	file_url,		# type: str
+	writer,			# type: typing.BinaryIO
+	algorithm,		# type: str
+	expected_size=None		# type: typing.Optional[int]
+):
+	# type: (...) -> typing.Any
+	"""
+	Download file_url, appending to whatever was already written to
+	writer by an earlier attempt if the server supports ranged
+	requests. Return a hash object for the complete file.
+	"""
+	hasher = hashlib.new(algorithm)
+	writer.flush()
+
+	with open(writer.name, 'rb') as reader:
+		while True:
+			blob = reader.read(ONE_MEGABYTE)
+
+			if not blob:
+				break
+
+			hasher.update(blob)
+
+	offset = os.fstat(writer.fileno()).st_size
+
+	if expected_size is not None and offset >= expected_size:
+		if offset == expected_size:
+			# An earlier download finished but was not verified
+			return hasher
+
+		offset = 0
+
+	if offset == 0:
+		writer.truncate(0)
+		hasher = hashlib.new(algorithm)
+		request = Request(file_url)
+	else:
+		if args.verbose:
+			print("Resuming download of %s at byte %d" % (file_url, offset))
+		request = Request(file_url, headers={
+			'Range': 'bytes=%d-' % offset,
+		})
+
+	try:
+		response = http_pool.urlopen(request)
+	except HTTPError as e:
+		if e.code == 416 and offset > 0:
+			# The partial file is not a prefix of the current one:
+			# start again
+			writer.truncate(0)
+			return continue_download(file_url, writer, algorithm, expected_size)
+
+		raise
+
+	with response:
+		if offset > 0 and response.code != 206:
+			# The server sent the whole file instead
+			writer.truncate(0)
+			hasher = hashlib.new(algorithm)
+		elif offset > 0 and not response.headers.get(
+			'Content-Range', ''
+		).startswith('bytes %d-' % offset):
+			# Unexpected Content-Range: start again
+			writer.truncate(0)
+			return continue_download(file_url, writer, algorithm, expected_size)
+
+		received = 0
+
+		while True:
+			blob = response.read(ONE_MEGABYTE)
+
+			if not blob:
+				break
+
+			writer.write(blob)
+			hasher.update(blob)
+			received += len(blob)
+
+		# http.client does not treat a connection that is closed
+		# too soon as an error
+		length = response.headers.get('Content-Length')
+
+		if length is not None and received < int(length):
+			raise http.client.IncompleteRead(b'', int(length) - received)
+
+	writer.flush()
+	return hasher
+
+
+def link_local_file(
+	source,			# type: str
+	file_path,		# type: str
+	expected=None		# type: typing.Optional[Checksum]
+):
+	# type: (...) -> bool
+	"""
+	Add a file from a local mirror to the cache as a copy-on-write
+	clone if possible, so that its data is not copied. It is not
+	hard-linked, so that changing the mirror in-place cannot alter
+	the cache. The copy is verified, like a downloaded file.
+	"""
+	if args.verbose:
+		print("Cloning %s to %s" % (source, file_path))
+
+	partial = file_path + '.part'
+
+	try:
+		os.remove(partial)
+	except FileNotFoundError:
+		pass
+
+	reflink_or_copy(source, partial)
+
+	if expected is not None:
+		actual = hash_file(partial, expected[0])
+
+		if actual != expected:
+			os.remove(partial)
+			raise ValueError(
+				'%s has unexpected content: expected %s %s, %d '
+				'bytes, got %s, %d bytes' % (
+					source, expected[0], expected[1], expected[2],
+					actual[1], actual[2]))
+
+	os.rename(partial, file_path)
+	return True
+
+
+def download_file(
+	file_url,		# type: str
+	file_path,		# type: str
+	expected=None		# type: typing.Optional[Checksum]
+):
+	# type: (...) -> bool
+	"""
+	Download file_url to file_path, unless it already exists.
+
+	The file is downloaded to a temporary name, and moved to
+	file_path when it is complete. If the download is interrupted,
+	a later attempt continues from where it stopped. Transient errors
+	are retried with exponential backoff.
+
+	If expected is not None, the file is hashed while it is downloaded,
+	and only moved into place if it matches, so a file that exists
+	has already been verified and does not need to be hashed again.
+	"""
+	if os.path.exists(file_path):
+		if args.verbose:
+			print("Skipping download of existing file: %s" % file_path)
+		return False
+
+	local = local_path(file_url)
+
+	if local is not None:
+		return link_local_file(local, file_path, expected)
+
+	partial = file_path + '.part'
+	algorithm = expected[0] if expected is not None else 'sha256'
+
+	if args.verbose:
+		print("Downloading %s to %s" % (file_url, file_path))
+
+	with open(partial, 'ab') as writer:
+		# Another process using the same cache directory might be
+		# downloading the same file
+		fcntl.flock(writer.fileno(), fcntl.LOCK_EX)
+
+		if os.path.exists(file_path):
+			return False
+
+		attempt = 0
+
+		while True:
+			resumed = os.fstat(writer.fileno()).st_size > 0
 
-			included[(p, sp.stanza['Version'])] = sp.stanza
-			manifest_lines.add(
-				'%s\t%s\t%s\n' % (
-					p, sp.stanza['Version'],
-					sp.stanza['files'][0]['name']))
+			try:
+				hasher = continue_download(
+					file_url, writer, algorithm,
+					expected[2] if expected is not None else None,
+				)
+				size = os.fstat(writer.fileno()).st_size
 
-	if failed:
-		sys.exit(1)
+				if expected is not None and (
+					size != expected[2]
+					or hasher.hexdigest() != expected[1]
+				):
+					writer.truncate(0)
+
+					if resumed:
+						# Perhaps the partial download was
+						# corrupt: try once more from the start
+						resumed = False
+						continue
+
+					raise ValueError(
+						'%s has unexpected content: expected %s %s, '
+						'%d bytes, got %s, %d bytes' % (
+							file_url, expected[0], expected[1],
+							expected[2], hasher.hexdigest(), size))
+			except Exception as e:
+				if attempt >= DOWNLOAD_RETRIES or not is_transient_error(e):
+					sys.stderr.write('Error downloading %s:\n' % file_url)
+
+					# Keep a partial download for next time, but
+					# not an empty file
+					writer.flush()
+
+					if os.fstat(writer.fileno()).st_size == 0:
+						os.unlink(partial)
+
+					raise
+
+				delay = DOWNLOAD_BACKOFF * 2 ** attempt
+				attempt += 1
+				sys.stderr.write(
+					'Retrying download of %s in %g seconds: %s\n'
+					% (file_url, delay, e))
+				time.sleep(delay)
+			else:
+				break
+
+		os.rename(partial, file_path)
+
+	return True
+
+
+def parse_size(size):
+	# type: (str) -> int
+	"""
+	Parse a size in bytes with an optional K, M, G or T suffix,
+	for example '500M'.
+	"""
+	match = re.match(r'^([0-9]+)([KMGT]?)i?B?$', size.strip(), re.IGNORECASE)
+
+	if match is None:
+		raise argparse.ArgumentTypeError('Invalid size %r' % size)
+
+	return int(match.group(1)) * 1024 ** ' KMGT'.index(
+		match.group(2).upper() or ' ')
+
+
+def format_size(size):
+	# type: (int) -> str
+	for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+		if size < 1024 or unit == 'GiB':
+			break
+
+		size //= 1024
+
+	return '%d %s' % (size, unit)
+
+
+class PackagePool:
+	"""
+	A directory of downloaded packages and source files, each named
+	after its checksum in the Packages or Sources file rather than
+	its filename. Release, debug and symbols builds share one copy of
+	each file, as do apt sources that contain the same file, even if
+	they give it a different Filename.
+
+	Files are only added to the pool after they have been verified
+	against that checksum while downloading, so a file in the pool
+	never needs to be hashed again.
+
+	Using a file sets its access time, so that the least recently
+	used files can be deleted to keep the pool below a size limit.
+	"""
+
+	def __init__(self, path):
+		# type: (str) -> None
+		self.path = path
+		self.started = time.time()
+		os.makedirs(path, exist_ok=True)
+
+	def path_for(self, checksum):
+		# type: (Checksum) -> str
+		algorithm, digest, size = checksum
+
+		if not re.match(r'^[0-9a-f]+$', digest):
+			raise ValueError('Invalid %s checksum %r' % (algorithm, digest))
+
+		return os.path.join(self.path, algorithm, digest[:2], digest)
+
+	def has(self, checksum):
+		# type: (Checksum) -> bool
+		return os.path.exists(self.path_for(checksum))
+
+	def use(self, checksum):
+		# type: (Checksum) -> str
+		"""
+		Record that the file with this checksum is still wanted, and
+		return its path.
+		"""
+		path = self.path_for(checksum)
+		os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+		return path
+
+	def trim(self, max_size, keep_since=None):
+		# type: (int, typing.Optional[float]) -> typing.Tuple[int, int]
+		"""
+		Delete the least recently used files until the pool is no
+		larger than max_size bytes, except for files that have been
+		used since the time keep_since. Partial downloads are always
+		deleted. Return the number of files and bytes deleted.
+		"""
+		entries = []
+		total = 0
+		removed = 0
+		freed = 0
+
+		for dir_path, dirs, files in os.walk(self.path):
+			for name in files:
+				path = os.path.join(dir_path, name)
+				stat = os.stat(path)
+
+				if name.endswith('.part'):
+					if keep_since is None or stat.st_mtime < keep_since:
+						os.unlink(path)
+						removed += 1
+						freed += stat.st_size
+
+					continue
+
+				entries.append((stat.st_atime, path, stat.st_size))
+				total += stat.st_size
+
+		for atime, path, size in sorted(entries):
+			if total <= max_size:
+				break
+
+			if keep_since is not None and atime >= keep_since:
+				break
+
+			os.unlink(path)
+			total -= size
+			removed += 1
+			freed += size
+
+		return removed, freed
+
+
+class PackageDownloader:
+	"""
+	Download packages into a PackagePool with download_file() in a
+	pool of worker threads, opening at most max_per_host simultaneous
+	connections to any one host.
+
+	Each batch of downloads is started in order of decreasing size, so
+	that the largest files, which take longest, are not left until the
+	end. Callers wait for each file with result() in whatever order
+	they want to unpack them, and can unpack one file while the rest
+	are still downloading.
+	"""
+
+	def __init__(
+		self,
+		pool,						# type: PackagePool
+		max_per_host=MAX_CONNECTIONS_PER_HOST,		# type: int
+		max_workers=MAX_FETCH_THREADS			# type: int
+	):
+		# type: (...) -> None
+		self.pool = pool
+		self.max_per_host = max_per_host
+		self._executor = concurrent.futures.ThreadPoolExecutor(
+			max_workers=max_workers,
+			thread_name_prefix='download',
+		)
+		self._futures = {}		# type: typing.Dict[str, concurrent.futures.Future]
+		self._hosts = {}		# type: typing.Dict[str, threading.BoundedSemaphore]
+		self._lock = threading.Lock()
+
+	def _host_slot(self, url):
+		# type: (str) -> threading.BoundedSemaphore
+		host = urlsplit(url).netloc
+
+		with self._lock:
+			if host not in self._hosts:
+				# Requests for a repository with several mirrors
+				# are spread between them
+				self._hosts[host] = threading.BoundedSemaphore(
+					self.max_per_host * http_pool.mirror_count(url))
+
+			return self._hosts[host]
+
+	def _download(self, url, checksum):
+		# type: (str, Checksum) -> bool
+		path = self.pool.path_for(checksum)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		with self._host_slot(url):
+			return download_file(url, path, checksum)
+
+	def download(self, files):
+		# type: (typing.Iterable[typing.Tuple[str, Checksum]]) -> None
+		"""
+		Start downloading each (url, checksum) in files into the
+		pool, largest first, unless a file with the same checksum is
+		already being downloaded.
+		"""
+		with self._lock:
+			for url, checksum in sorted(
+				files, key=lambda f: (-f[1][2], f[1])
+			):
+				path = self.pool.path_for(checksum)
+
+				if path not in self._futures:
+					self._futures[path] = self._executor.submit(
+						self._download, url, checksum)
+
+	def result(self, checksum):
+		# type: (Checksum) -> bool
+		"""
+		Wait for the file with this checksum to be in the pool. Return
+		True if it was downloaded, or False if it was already present.
+		If the download failed, cancel the downloads that have not
+		started yet and raise the exception.
+		"""
+		try:
+			ret = self._futures[self.pool.path_for(checksum)].result()
+		except Exception:
+			with self._lock:
+				for future in self._futures.values():
+					future.cancel()
+
+			raise
+
+		self.pool.use(checksum)
+		return ret
+
+	def shutdown(self):
+		# type: () -> None
+		self._executor.shutdown(wait=True)
+
+
+class SourcePackage:
+	def __init__(self, apt_source, stanza):
+		self.apt_source = apt_source
+		self.stanza = stanza
+
+	def checksums(self):
+		# type: () -> typing.Dict[str, Checksum]
+		"""
+		Return {'foo_1.dsc': ('sha256', '0123...', 1234), ...} for
+		each file, using the strongest checksum that is available.
+		"""
+		ret = {}		# type: typing.Dict[str, Checksum]
+
+		for f in self.stanza['files']:
+			ret[f['name']] = ('md5', f['md5sum'], int(f['size']))
+
+		for f in self.stanza.get('Checksums-Sha256', []):
+			ret[f['name']] = ('sha256', f['sha256'], int(f['size']))
+
+		return ret
+
+	def file_url(self, name):
+		# type: (str) -> str
+		check_path_traversal(name)
+		return '%s/%s/%s' % (
+			self.apt_source.url,
+			self.stanza['directory'],
+			name,
+		)
+
+
+def list_sources(apt_sources, sourcelist, fetcher):
+	# type: (typing.List[AptSource], typing.Set[str], IndexFetcher) -> typing.Dict[str, typing.List[SourcePackage]]
+	"""
+	Load the Sources files so we can find the location of each
+	requested source package, returning {'glib2.0': [<SourcePackage>,
+	...]}. Stanzas for other source packages are never parsed.
+	"""
+	source_packages = {}		# type: typing.Dict[str, typing.List[SourcePackage]]
+
+	for apt_source in apt_sources:
+		for url in apt_source.sources_urls:
+			print("Downloading sources from %s" % url)
+			fetcher.submit(url, parse_sources_index, '.gz')
+			for stanza in fetcher.result(url).stanzas(sourcelist):
+				source_packages.setdefault(
+					stanza['package'], []
+				).append(SourcePackage(apt_source, stanza))
+
+	return source_packages
+
+
+def install_sources(
+	source_packages,		# type: typing.Dict[str, typing.List[SourcePackage]]
+	downloader		# type: PackageDownloader
+):
+	# type: (...) -> None
+	skipped = 0
+	included = {}
+	manifest_lines = set()
+
+	# Skip packages with Extra-Source-Only: yes.
+	# These don't necessarily appear in the package pool.
+	wanted = [
+		(p, sp)
+		for p, candidates in sorted(source_packages.items())
+		for sp in candidates
+		if sp.stanza.get('Extra-Source-Only', 'no') != 'yes'
+	]
+
+	downloader.download(
+		(sp.file_url(name), checksum)
+		for p, sp in wanted
+		for name, checksum in sp.checksums().items()
+	)
+
+	# Process the requested packages. If a particular source package
+	# name appears more than once (for example in scout and also in an
+	# overlay suite), we err on the side of completeness and download
+	# all of them.
+	for p, sp in wanted:
+		if args.verbose:
+			print("DOWNLOADING SOURCE: %s" % p)
+
+		checksums = sp.checksums()
+
+		#
+		# Wait for each file to be downloaded
+		#
+		for file in sp.stanza['files']:
+			if not downloader.result(checksums[file['name']]):
+				skipped += 1
+
+		for file in sp.stanza['files']:
+			file_path = downloader.pool.path_for(
+				checksums[file['name']])
+
+			# Copy the source package into the output directory
+			# (optimizing the copy as a hardlink if possible)
+			os.makedirs(os.path.join(args.output, 'source'), exist_ok=True)
+			hard_link_or_copy(
+				file_path,
+				os.path.join(
+					args.output, 'source', file['name']))
+
+		included[(p, sp.stanza['Version'])] = sp.stanza
+		manifest_lines.add(
+			'%s\t%s\t%s\n' % (
+				p, sp.stanza['Version'],
+				sp.stanza['files'][0]['name']))
 
 	# sources.txt: Tab-separated table of source packages, their
 	# versions, and the corresponding .dsc file.
@@ -455,14 +2885,112 @@ def install_sources(apt_sources, sourcelist):
 		print("Skipped downloading %i deb source file(s) that were already present." % skipped)
 
 
+# One alternative in a relationship field, as returned by
+# deb822.PkgRelation.parse_relations(), for example
+# {'name': 'libc6', 'version': ('>=', '2.15'), ...}
+Relation = typing.Dict[str, typing.Any]
+
+
+def parse_relations(
+	pattern,		# type: typing.Pattern[bytes]
+	raw			# type: bytes
+):
+	# type: (...) -> typing.List[typing.List[Relation]]
+	ret = []		# type: typing.List[typing.List[Relation]]
+
+	for value in pattern.findall(raw):
+		value = value.decode('utf-8').strip()
+
+		if value:
+			ret.extend(deb822.PkgRelation.parse_relations(value))
+
+	return ret
+
+
+def version_satisfies(
+	version,		# type: str
+	constraint		# type: typing.Optional[typing.Tuple[str, str]]
+):
+	# type: (...) -> bool
+	"""
+	Return True if version satisfies a constraint such as ('>=', '1.0'),
+	or if constraint is None.
+	"""
+	if constraint is None:
+		return True
+
+	op, other = constraint
+	a = version_key(version)
+	b = version_key(other)
+
+	if op == '<<':
+		return a < b
+	elif op in ('<=', '<'):		# '<' is an obsolete spelling of '<='
+		return a <= b
+	elif op == '=':
+		return a == b
+	elif op in ('>=', '>'):		# '>' is an obsolete spelling of '>='
+		return a >= b
+	elif op == '>>':
+		return a > b
+
+	raise ValueError('Unknown version relation %r' % op)
+
+
+def format_relations(group):
+	# type: (typing.List[Relation]) -> str
+	return ' | '.join(
+		'%s (%s %s)' % (
+			(r['name'],) + r['version']) if r['version'] else r['name']
+		for r in group
+	)
+
+
 class Binary:
-	def __init__(self, apt_source, stanza):
+	"""
+	A binary package listed in a Packages file.
+
+	Only the fields needed to choose which packages to install are
+	parsed up front. The full stanza and the dependency fields are
+	parsed from the raw bytes of the stanza on first use, because most
+	of the packages in the repository will never be installed.
+	"""
+
+	__slots__ = (
+		'apt_source',
+		'name',
+		'arch',
+		'version',
+		'source',
+		'source_version',
+		'source_field',
+		'raw',
+		'_stanza',
+		'_dependency_names',
+		'_relations',
+		'_provides',
+	)
+
+	def __init__(
+		self,
+		apt_source,		# type: AptSource
+		name,			# type: str
+		arch,			# type: str
+		version,		# type: str
+		source,			# type: str
+		raw			# type: bytes
+	):
+		# type: (...) -> None
 		self.apt_source = apt_source
-		self.stanza = stanza
-		self.name = stanza['Package']
-		self.arch = stanza['Architecture']
-		self.version = stanza['Version']
-		source = stanza.get('Source', self.name)
+		self.name = name
+		self.arch = arch
+		self.version = version
+		self.source_field = source
+		self.raw = raw
+		self._stanza = None		# type: typing.Optional[deb822.Packages]
+		self._dependency_names = None		# type: typing.Optional[typing.Set[str]]
+		self._relations = None		# type: typing.Optional[typing.List[typing.List[Relation]]]
+		self._provides = None		# type: typing.Optional[typing.List[Relation]]
 
 		if ' (' in source:
 			self.source, tmp = source.split(' (', 1)
@@ -471,31 +2999,366 @@ class Binary:
 			self.source = source
 			self.source_version = self.version
 
-		self.dependency_names = set()
+	@property
+	def stanza(self):
+		# type: () -> deb822.Packages
+		if self._stanza is None:
+			self._stanza = deb822.Packages(self.raw.decode('utf-8'))
+
+		return self._stanza
+
+	@property
+	def dependency_names(self):
+		# type: () -> typing.Set[str]
+		if self._dependency_names is None:
+			self._dependency_names = set()
+
+			for value in DEPENDS_FIELDS.findall(self.raw):
+				deps = value.decode('utf-8').split(',')
+
+				for d in deps:
+					# ignore alternatives
+					d = d.split('|')[0]
+					# ignore version number
+					d = d.split('(')[0]
+					d = d.strip()
+
+					if d:
+						self._dependency_names.add(d)
+
+		return self._dependency_names
+
+	@property
+	def relations(self):
+		# type: () -> typing.List[typing.List[Relation]]
+		"""
+		The Depends and Pre-Depends fields, as a list of groups of
+		alternatives.
+		"""
+		if self._relations is None:
+			self._relations = parse_relations(DEPENDS_FIELDS, self.raw)
+
+		return self._relations
+
+	@property
+	def provides(self):
+		# type: () -> typing.List[Relation]
+		"""
+		The virtual packages listed in the Provides field.
+		"""
+		if self._provides is None:
+			self._provides = [
+				relation
+				for group in parse_relations(PROVIDES_FIELD, self.raw)
+				for relation in group
+			]
+
+		return self._provides
+
+
+def share_binary(
+	shared,		# type: typing.Dict[typing.Tuple[AptSource, bytes], Binary]
+	binary		# type: Binary
+):
+	# type: (...) -> Binary
+	"""
+	If binary is an Architecture: all package that has already been
+	seen in another architecture's Packages file from the same apt
+	source, return the Binary that was already created for it, so that
+	it is only parsed and resolved once. Otherwise return binary.
+	"""
+	if binary.arch != 'all':
+		return binary
+
+	return shared.setdefault((binary.apt_source, binary.raw), binary)
 
-		for field in ('Depends', 'Pre-Depends'):
-			value = stanza.get(field, '')
-			deps = value.split(',')
 
-			for d in deps:
-				# ignore alternatives
-				d = d.split('|')[0]
-				# ignore version number
-				d = d.split('(')[0]
-				d = d.strip()
+def index_provides(by_name):
+	# type: (typing.Mapping[str, typing.List[Binary]]) -> typing.Dict[str, typing.Set[str]]
+	"""
+	Return {'virtual': {'real', ...}}, the names of the packages in
+	by_name that provide each virtual package in any of their versions.
+	"""
+	provided = {}		# type: typing.Dict[str, typing.Set[str]]
+
+	for name, binaries in by_name.items():
+		for binary in binaries:
+			for relation in binary.provides:
+				provided.setdefault(relation['name'], set()).add(name)
 
-				if d:
-					self.dependency_names.add(d)
+	return provided
 
 
-def list_binaries(
+class SnapshotPackages(collections.abc.Mapping):
+	"""
+	A read-only {'libc6': [<Binary>, ...]} mapping for one architecture,
+	backed by a BinarySnapshots database and loaded one name at a time.
+	"""
+
+	def __init__(
+		self,
+		db,			# type: sqlite3.Connection
+		arch,			# type: str
+		apt_sources,		# type: typing.List[AptSource]
+		shared			# type: typing.Dict[typing.Tuple[AptSource, bytes], Binary]
+	):
+		# type: (...) -> None
+		self._db = db
+		self._arch = arch
+		self._apt_sources = apt_sources
+		self._shared = shared
+		self._loaded = {}		# type: typing.Dict[str, typing.List[Binary]]
+		self._names = None		# type: typing.Optional[typing.List[str]]
+
+	def __getitem__(self, name):
+		# type: (str) -> typing.List[Binary]
+		if name not in self._loaded:
+			binaries = [
+				share_binary(
+					self._shared,
+					Binary(self._apt_sources[i], name, *row))
+				for i, *row in self._db.execute(
+					'SELECT apt_source, stanza_arch, version, '
+					'source, raw FROM binaries '
+					'WHERE arch = ? AND name = ? ORDER BY seq',
+					(self._arch, name),
+				)
+			]
+
+			if not binaries:
+				raise KeyError(name)
+
+			self._loaded[name] = binaries
+
+		return self._loaded[name]
+
+	def __iter__(self):
+		# type: () -> typing.Iterator[str]
+		if self._names is None:
+			self._names = [
+				name for name, in self._db.execute(
+					'SELECT DISTINCT name FROM binaries '
+					'WHERE arch = ? ORDER BY name',
+					(self._arch,),
+				)
+			]
+
+		return iter(self._names)
+
+	def __len__(self):
+		# type: () -> int
+		return len(list(iter(self)))
+
+	def provided_by(self, virtual):
+		# type: (str) -> typing.Set[str]
+		"""
+		Return the names of the packages that provide virtual in any
+		of their versions, without loading any packages.
+		"""
+		return {
+			name for name, in self._db.execute(
+				'SELECT name FROM provides '
+				'WHERE arch = ? AND virtual = ?',
+				(self._arch, virtual),
+			)
+		}
+
+
+class BinarySnapshots:
+	"""
+	A directory of SQLite databases, each containing the result of
+	list_binaries() for one set of Packages files, keyed by the
+	checksums of those Packages files in their Release files. Loading
+	a snapshot is much faster than downloading and parsing the Packages
+	files, which helps when building several variants of a runtime
+	from the same repository snapshot.
+	"""
+
+	def __init__(self, path):
+		# type: (str) -> None
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+
+	def _filename(self, key):
+		# type: (str) -> str
+		return os.path.join(self.path, key + '.sqlite')
+
+	def has(self, key):
+		# type: (typing.Optional[str]) -> bool
+		return key is not None and os.path.exists(self._filename(key))
+
+	def load(
+		self,
+		key,			# type: str
+		apt_sources		# type: typing.List[AptSource]
+	):
+		# type: (...) -> typing.Optional[typing.Dict[str, SnapshotPackages]]
+		filename = self._filename(key)
+
+		try:
+			db = sqlite3.connect('file:%s?mode=ro' % filename, uri=True)
+			architectures = [
+				arch for arch, in db.execute(
+					'SELECT arch FROM architectures ORDER BY seq')
+			]
+		except sqlite3.Error:
+			return None
+
+		# Record that this snapshot is still in use
+		os.utime(filename)
+		shared = {}		# type: typing.Dict[typing.Tuple[AptSource, bytes], Binary]
+
+		return {
+			arch: SnapshotPackages(db, arch, apt_sources, shared)
+			for arch in architectures
+		}
+
+	def save(
+		self,
+		key,			# type: str
+		by_arch,		# type: typing.Dict[str, typing.Dict[str, typing.List[Binary]]]
+		apt_sources		# type: typing.List[AptSource]
+	):
+		# type: (...) -> None
+		with tempfile.NamedTemporaryFile(
+			dir=self.path, prefix='.tmp', delete=False,
+		) as writer:
+			pass
+
+		db = sqlite3.connect(writer.name)
+
+		with db:
+			db.execute(
+				'CREATE TABLE architectures '
+				'(seq INTEGER, arch TEXT)')
+			db.execute(
+				'CREATE TABLE binaries '
+				'(arch TEXT, name TEXT, seq INTEGER, '
+				'apt_source INTEGER, stanza_arch TEXT, '
+				'version TEXT, source TEXT, raw BLOB)')
+			db.execute(
+				'CREATE TABLE provides '
+				'(arch TEXT, virtual TEXT, name TEXT)')
+			db.executemany(
+				'INSERT INTO architectures VALUES (?, ?)',
+				enumerate(by_arch),
+			)
+
+			for arch, by_name in by_arch.items():
+				db.executemany(
+					'INSERT INTO binaries VALUES '
+					'(?, ?, ?, ?, ?, ?, ?, ?)',
+					(
+						(
+							arch, name, seq,
+							apt_sources.index(b.apt_source),
+							b.arch, b.version,
+							b.source_field, b.raw,
+						)
+						for name, binaries in by_name.items()
+						for seq, b in enumerate(binaries)
+					),
+				)
+
+				db.executemany(
+					'INSERT INTO provides VALUES (?, ?, ?)',
+					(
+						(arch, virtual, name)
+						for virtual, names in index_provides(
+							by_name).items()
+						for name in names
+					),
+				)
+
+			db.execute(
+				'CREATE INDEX binaries_by_name '
+				'ON binaries (arch, name)')
+			db.execute(
+				'CREATE INDEX provides_by_virtual '
+				'ON provides (arch, virtual)')
+
+		db.close()
+		os.replace(writer.name, self._filename(key))
+		self.expire()
+
+	def expire(self, keep=MAX_SNAPSHOTS):
+		# type: (int) -> None
+		"""
+		Delete all but the keep most recently used snapshots.
+		"""
+		snapshots = sorted(
+			glob.glob(os.path.join(self.path, '*.sqlite')),
+			key=os.path.getmtime,
+			reverse=True,
+		)
+
+		for filename in snapshots[keep:]:
+			os.unlink(filename)
+
+
+def packages_snapshot_key(
 	apt_sources,		# type: typing.List[AptSource]
+	fetcher,		# type: IndexFetcher
 	dbgsym=False		# type: bool
 ):
-	# type: (...) -> typing.Dict[str, typing.Dict[str, typing.List[Binary]]]
+	# type: (...) -> typing.Optional[str]
+	"""
+	Return a key for the result of list_binaries(), based on the
+	checksums of the Packages files from the Release files, or None if
+	the Release files don't list all of them.
+	"""
+	hasher = hashlib.sha256()
+	hasher.update(repr((SNAPSHOT_FORMAT, dbgsym)).encode('utf-8'))
+
+	for arch in args.architectures:
+		for apt_source in apt_sources:
+			for url in apt_source.get_packages_urls(
+				arch,
+				dbgsym=dbgsym,
+			):
+				checksum = fetcher.index_checksum(url)
+
+				if checksum is None:
+					return None
+
+				hasher.update(repr((
+					arch, str(apt_source), url, checksum,
+				)).encode('utf-8'))
+
+	return hasher.hexdigest()
+
+
+def list_binaries(
+	apt_sources,		# type: typing.List[AptSource]
+	fetcher,		# type: IndexFetcher
+	dbgsym=False,		# type: bool
+	snapshots=None		# type: typing.Optional[BinarySnapshots]
+):
+	# type: (...) -> typing.Mapping[str, typing.Mapping[str, typing.List[Binary]]]
+	"""
+	Return the binary packages available for each architecture, as
+	{'amd64': {'libc6': [<Binary>, ...]}}.
+	"""
+
+	key = None		# type: typing.Optional[str]
+
+	if snapshots is not None:
+		key = packages_snapshot_key(apt_sources, fetcher, dbgsym)
+
+		if key is not None:
+			loaded = snapshots.load(key, apt_sources)
+
+			if loaded is not None:
+				print("Loaded %s from snapshot %s" % (
+					'debug symbols' if dbgsym else 'binaries',
+					key,
+				))
+				return loaded
 
 	# {'amd64': {'libc6': [<Binary>, ...]}}
 	by_arch = {}		# type: typing.Dict[str, typing.Dict[str, typing.List[Binary]]]
+	shared = {}		# type: typing.Dict[typing.Tuple[AptSource, bytes], Binary]
+	failed = False
 
 	if dbgsym:
 		description = 'debug symbols'
@@ -515,41 +3378,99 @@ def list_binaries(
 				print("Downloading %s %s from %s" % (
 					arch, description, url))
 
+				fetcher.submit(url, parse_packages_index, '.gz')
+
 				try:
-					# Python 2 does not catch a 404 here
-					url_file_handle = gzip.GzipFile(
-						fileobj=BytesIO(
-							urlopen(url).read()
-						),
-						mode='rb',
-					)
+					index = fetcher.result(url)
 				except Exception as e:
 					if dbgsym:
 						print(e)
+						failed = True
 						continue
 					else:
 						raise
 
-				for stanza in deb822.Packages.iter_paragraphs(
-					url_file_handle
-				):
-					if stanza['Architecture'] not in ('all', arch):
+				for p, stanza_arch, version, source, raw in index.scan():
+					if stanza_arch not in ('all', arch):
 						print('Found %s package %s in %s Packages file' % (
-							stanza['Architecture'],
-							stanza['Package'],
+							stanza_arch,
+							p,
 							arch,
 						))
 						continue
-					p = stanza['Package']
-					binary = Binary(apt_source, stanza)
+					binary = share_binary(shared, Binary(
+						apt_source, p, stanza_arch, version,
+						source, raw))
 					by_name.setdefault(p, []).append(
 						binary)
 
 		by_arch[arch] = by_name
 
+	if (
+		snapshots is not None
+		and key is not None
+		and not failed
+	):
+		snapshots.save(key, by_arch, apt_sources)
+
 	return by_arch
 
 
+class NewestBinaries(collections.abc.Mapping):
+	"""
+	A read-only {'libc6': <Binary>} mapping for one architecture,
+	giving the newest version of each package in a mapping returned
+	by list_binaries(). The newest version of each package is found
+	the first time it is looked up, and then remembered.
+	"""
+
+	def __init__(self, by_name):
+		# type: (typing.Mapping[str, typing.List[Binary]]) -> None
+		self._by_name = by_name
+		self._newest = {}		# type: typing.Dict[str, Binary]
+		self._provided = None		# type: typing.Optional[typing.Dict[str, typing.Set[str]]]
+
+	def __getitem__(self, name):
+		# type: (str) -> Binary
+		try:
+			return self._newest[name]
+		except KeyError:
+			pass
+
+		newest = max(
+			self._by_name[name],
+			key=lambda b: version_key(b.version))
+		self._newest[name] = newest
+		return newest
+
+	def __iter__(self):
+		# type: () -> typing.Iterator[str]
+		return iter(self._by_name)
+
+	def __len__(self):
+		# type: () -> int
+		return len(self._by_name)
+
+	def __contains__(self, name):
+		# type: (typing.Any) -> bool
+		return name in self._by_name
+
+	def provided_by(self, virtual):
+		# type: (str) -> typing.Set[str]
+		"""
+		Return the names of the packages that provide virtual in any
+		of their versions. A snapshot is queried by name, so that the
+		packages that were not asked for are never loaded.
+		"""
+		if isinstance(self._by_name, SnapshotPackages):
+			return self._by_name.provided_by(virtual)
+
+		if self._provided is None:
+			self._provided = index_provides(self._by_name)
+
+		return self._provided.get(virtual, set())
+
+
 def ignore_metapackage_dependency(name):
 	"""
 	Return True if @name should not be installed in Steam Runtime
@@ -668,14 +3589,17 @@ def ignore_transitive_dependency(name):
 	)
 
 
-def expand_metapackages(architectures, binaries_by_arch, metapackages):
+def expand_metapackages(architectures, newest_by_arch, metapackages):
 	sources_from_apt = set()
 	binaries_from_apt = {}
+	# {'amd64': {'libfoo1': 'dependency of steamrt-libs'}}
+	reasons = {}		# type: typing.Dict[str, typing.Dict[str, str]]
 	error = False
 
 	for arch in architectures:
-		arch_binaries = binaries_by_arch[arch]
+		arch_binaries = newest_by_arch[arch]
 		binaries_from_apt[arch] = set()
+		reasons[arch] = {}
 
 		for metapackage in metapackages:
 			if metapackage not in arch_binaries:
@@ -683,81 +3607,211 @@ def expand_metapackages(architectures, binaries_by_arch, metapackages):
 				error = True
 				continue
 
-			binary = max(
-				arch_binaries[metapackage],
-				key=lambda b: Version(b.stanza['Version']))
+			binary = arch_binaries[metapackage]
 			sources_from_apt.add(binary.source)
 			binaries_from_apt[arch].add(metapackage)
+			reasons[arch].setdefault(metapackage, 'metapackage')
 
 			for d in binary.dependency_names:
 				if not ignore_metapackage_dependency(d):
 					binaries_from_apt[arch].add(d)
+					reasons[arch].setdefault(
+						d, 'dependency of %s' % metapackage)
+
+	for arch, arch_binaries in sorted(newest_by_arch.items()):
+		resolver = DependencyResolver(
+			arch_binaries,
+			binaries_from_apt[arch],
+			sources_from_apt,
+			reasons[arch],
+		)
+
+		if not resolver.resolve(sorted(binaries_from_apt[arch])):
+			error = True
+
+	if error and args.strict:
+		sys.exit(1)
+
+	return sources_from_apt, binaries_from_apt, reasons
+
+
+class DependencyResolver:
+	"""
+	Check that the dependencies of the binary packages to be installed
+	for one architecture are satisfied, either by other packages that
+	are to be installed or by the host system. Missing dependencies
+	that accept_transitive_dependency() allows are added to installset;
+	anything else is reported as an error.
+
+	Each package is visited at most once, using a worklist rather than
+	recursion, so the time taken is proportional to the size of the
+	closure. Alternatives, version constraints and Provides are taken
+	into account. The reason why each package was added is recorded
+	in reasons.
+	"""
+
+	def __init__(
+		self,
+		arch_binaries,		# type: NewestBinaries
+		installset,		# type: typing.Set[str]
+		sources,		# type: typing.Set[str]
+		reasons			# type: typing.Dict[str, str]
+	):
+		# type: (...) -> None
+		self.arch_binaries = arch_binaries
+		self.installset = installset
+		self.sources = sources
+		self.reasons = reasons
+		self.visited = set()		# type: typing.Set[str]
+		# {'virtual': [(<Binary>, ('=', '1.0') or None), ...]}
+		self._providers = {}		# type: typing.Dict[str, typing.List[typing.Tuple[Binary, typing.Any]]]
+
+	def providers(self, name):
+		# type: (str) -> typing.List[typing.Tuple[Binary, typing.Any]]
+		"""
+		Return the packages that provide the virtual package name,
+		with the version they provide if any. Only the newest version
+		of each package is considered, and only the packages that
+		provide name in some version are looked at.
+		"""
+		if name not in self._providers:
+			providers = []		# type: typing.List[typing.Tuple[Binary, typing.Any]]
+
+			for real in sorted(self.arch_binaries.provided_by(name)):
+				binary = self.arch_binaries[real]
+
+				for relation in binary.provides:
+					if relation['name'] == name:
+						providers.append((binary, relation['version']))
+
+			self._providers[name] = providers
+
+		return self._providers[name]
+
+	def _installed(self, relation):
+		# type: (Relation) -> bool
+		name = relation['name']
+
+		if name not in self.installset:
+			return False
+
+		if name not in self.arch_binaries:
+			# It will be reported when we visit it
+			return True
+
+		return version_satisfies(
+			self.arch_binaries[name].version,
+			relation['version'])
+
+	def _provided(self, relation):
+		# type: (Relation) -> bool
+		for binary, provided in self.providers(relation['name']):
+			if binary.name not in self.installset:
+				continue
+
+			if relation['version'] is None:
+				return True
+
+			# Only versioned Provides can satisfy a versioned
+			# dependency
+			if (
+				provided is not None
+				and provided[0] == '='
+				and version_satisfies(provided[1], relation['version'])
+			):
+				return True
+
+		return False
+
+	def _check(
+		self,
+		library,		# type: str
+		group,			# type: typing.List[Relation]
+		worklist		# type: typing.Deque[str]
+	):
+		# type: (...) -> bool
+		"""
+		Check one dependency of library, which is satisfied by any
+		of the alternatives in group. Return False if it is not.
+		"""
+		for relation in group:
+			name = relation['name']
+
+			if (
+				self._installed(relation)
+				or ignore_metapackage_dependency(name)
+				or ignore_transitive_dependency(name)
+			):
+				return True
+
+		for relation in group:
+			name = relation['name']
+
+			if (
+				accept_transitive_dependency(name)
+				and name not in self.installset
+			):
+				self.installset.add(name)
+				self.reasons.setdefault(
+					name, 'dependency of %s' % library)
+				worklist.append(name)
+				return True
+
+		if library.endswith(('-dev', '-dbg', '-multidev')):
+			# When building a -debug runtime we
+			# disregard transitive dependencies of
+			# development-only packages
+			return True
+
+		if any(self._provided(relation) for relation in group):
+			return True
+
+		for relation in group:
+			name = relation['name']
+
+			if name in self.installset:
+				print('ERROR: %s depends on %s but %s is version %s' % (
+					library, format_relations(group), name,
+					self.arch_binaries[name].version))
+				return False
+
+		print('ERROR: %s depends on %s but the metapackages do not' % (
+			library, format_relations(group)))
+		# Carry on to report any further problems with the first
+		# alternative's dependencies
+		worklist.append(group[0]['name'])
+		return False
 
-	for arch, arch_binaries in sorted(binaries_by_arch.items()):
-		for library in sorted(binaries_from_apt[arch]):
-			if not _recurse_dependency(
-				arch_binaries,
-				library,
-				binaries_from_apt[arch],
-				sources_from_apt,
-			):
-				error = True
+	def resolve(self, names):
+		# type: (typing.Iterable[str]) -> bool
+		"""
+		Visit names and everything that they pull in. Return False
+		if there were errors.
+		"""
+		worklist = collections.deque(names)
+		error = False
 
-	if error and args.strict:
-		sys.exit(1)
+		while worklist:
+			library = worklist.popleft()
 
-	return sources_from_apt, binaries_from_apt
+			if library in self.visited:
+				continue
 
+			self.visited.add(library)
 
-def _recurse_dependency(
-	arch_binaries,			# type: typing.Dict[str, typing.List[Binary]]
-	library,			# type: str
-	binaries_from_apt,		# type: typing.Set[str]
-	sources_from_apt		# type: typing.Set[str]
-):
-	if library not in arch_binaries:
-		print('ERROR: Package %s not found in Packages files' % library)
-		return False
+			if library not in self.arch_binaries:
+				print('ERROR: Package %s not found in Packages files' % library)
+				error = True
+				continue
 
-	binary = max(
-		arch_binaries[library],
-		key=lambda b: Version(b.stanza['Version']))
-	sources_from_apt.add(binary.source)
-	error = False
+			binary = self.arch_binaries[library]
+			self.sources.add(binary.source)
 
-	for d in binary.dependency_names:
-		if accept_transitive_dependency(d):
-			if d not in binaries_from_apt:
-				binaries_from_apt.add(d)
-				if not _recurse_dependency(
-					arch_binaries,
-					d,
-					binaries_from_apt,
-					sources_from_apt,
-				):
+			for group in binary.relations:
+				if not self._check(library, group, worklist):
 					error = True
-		elif library.endswith(('-dev', '-dbg', '-multidev')):
-			# When building a -debug runtime we
-			# disregard transitive dependencies of
-			# development-only packages
-			pass
-		elif d in binaries_from_apt:
-			pass
-		elif ignore_metapackage_dependency(d):
-			pass
-		elif ignore_transitive_dependency(d):
-			pass
-		else:
-			print('ERROR: %s depends on %s but the metapackages do not' % (library, d))
-			_recurse_dependency(
-				arch_binaries,
-				d,
-				binaries_from_apt,
-				sources_from_apt,
-			)
-			error = True
 
-	return not error
+		return not error
 
 
 def check_consistency(
@@ -807,310 +3861,1040 @@ def keep_only_primary_arch(relative_path: str) -> bool:
 	))
 
 
-def install_binaries(architectures, binaries_by_arch, binarylists, manifest):
-	skipped = 0
+def deb_checksum(binary):
+	# type: (Binary) -> Checksum
+	"""
+	Return the strongest checksum of the .deb for binary that its
+	Packages stanza lists.
+	"""
+	stanza = binary.stanza
+	size = int(stanza.get('Size', 0))
 
-	for arch, arch_binaries in sorted(binaries_by_arch.items()):
-		installset = binarylists[arch].copy()
+	if 'SHA256' in stanza:
+		return ('sha256', stanza['SHA256'], size)
 
-		#
-		# Create the destination directory if necessary
-		#
-		dir = os.path.join(top,destdir,"binary" if not args.debug else "debug", arch)
-		if not os.access(dir, os.W_OK):
-			os.makedirs(dir)
+	return ('md5', stanza['MD5sum'], size)
 
-		out_dir = get_output_dir_for_arch(arch)
 
-		for p, binaries in sorted(arch_binaries.items()):
-			if p in installset:
-				if args.verbose:
-					print("DOWNLOADING BINARY: %s" % p)
+def deb_download(binary):
+	# type: (Binary) -> typing.Tuple[str, Checksum]
+	"""
+	Return (url, checksum) for downloading binary into the pool.
+	"""
+	check_path_traversal(binary.stanza['Filename'])
+	return (
+		'%s/%s' % (binary.apt_source.url, binary.stanza['Filename']),
+		deb_checksum(binary),
+	)
+
+
+def install_binaries(
+	architectures,
+	newest_by_arch,
+	binarylists,
+	manifest,
+	downloader,		# type: PackageDownloader
+	unpacker		# type: PackageUnpacker
+):
+	skipped = 0
 
-				newest = max(
-					binaries,
-					key=lambda b:
-						Version(b.stanza['Version']))
-				manifest[(p, arch)] = newest
+	# Each package is unpacked into a directory of its own below here,
+	# unless it was already in the UnpackCache, and then put into place
+	# in its architecture's output directory with unpacker.link_file.
+	# Architecture: all packages are the same for every architecture,
+	# so each one is only downloaded and unpacked once.
+	unpack_dir = tempfile.mkdtemp(prefix='.unpack-', dir=args.output)
+
+	try:
+		# Download everything in parallel
+		downloader.download(
+			deb_download(arch_binaries[p])
+			for arch, arch_binaries in sorted(newest_by_arch.items())
+			for p in sorted(binarylists[arch])
+			if p in arch_binaries
+		)
 
+		# Unpack packages in parallel as they become available
+		unpacked = {}		# type: typing.Dict[str, concurrent.futures.Future]
+
+		for arch, arch_binaries in sorted(newest_by_arch.items()):
+			for p in sorted(binarylists[arch]):
+				if p in arch_binaries:
+					newest = arch_binaries[p]
+					check_path_traversal(newest.stanza['Filename'])
+					basename = os.path.splitext(
+						os.path.basename(newest.stanza['Filename'])
+					)[0]
+
+					if basename not in unpacked:
+						#
+						# Wait for the package to be downloaded and install it
+						#
+						checksum = deb_checksum(newest)
+						if not downloader.result(checksum):
+							skipped += 1
+						dest_deb = downloader.pool.path_for(checksum)
+						unpacked[basename] = unpacker.unpack(
+							basename, dest_deb,
+							os.path.join(unpack_dir, basename),
+							newest.stanza.get('MD5sum'), checksum)
+
+		# Then put them in place one at a time, in a predictable order
+		merged = MergedTree(args.output, unpacker.link_file)
+
+		for arch, arch_binaries in sorted(newest_by_arch.items()):
+			installset = binarylists[arch].copy()
+
+			out_dir = get_output_dir_for_arch(arch)
+			out_dir.mkdir(exist_ok=True)
+
+			for p in sorted(installset):
+				if p in arch_binaries:
+					if args.verbose:
+						print("INSTALLING BINARY: %s" % p)
+
+					newest = arch_binaries[p]
+					manifest[(p, arch)] = newest
+					basename = os.path.splitext(
+						os.path.basename(newest.stanza['Filename'])
+					)[0]
+					merged.link(arch, unpacked[basename].result()[0])
+					installset.remove(p)
+
+			for p in installset:
 				#
-				# Download the package and install it
+				# There was a binary package in the list to be installed that is not in the repo
 				#
-				check_path_traversal(newest.stanza['Filename'])
-				file_url = "%s/%s" % (
-					newest.apt_source.url,
-					newest.stanza['Filename'],
-				)
-				dest_deb = os.path.join(
-					dir,
-					os.path.basename(newest.stanza['Filename']),
-				)
-				if not download_file(file_url, dest_deb):
-					skipped += 1
-				install_deb(
-					os.path.splitext(
-						os.path.basename(
-							newest.stanza['Filename']
+				e = "ERROR: Package %s not found in Packages files\n" % p
+				sys.stderr.write(e)
+
+			if installset and args.strict:
+				raise SystemExit('Not all binary packages were found')
+
+			merged.finish(arch)
+
+			for pattern in ('bin/{}-*', 'usr/bin/{}-*'):
+				for exe in glob.glob(str(out_dir / pattern.format(ARCHITECTURES[arch]))):
+					# Populate OUTPUT/usr/bin with symlinks
+					# to OUTPUT/amd64/[usr/]bin/x86_64-linux-gnu-*
+					# and OUTPUT/i386/[usr/]bin/i386-linux-gnu-*
+					os.makedirs(os.path.join(args.output, 'usr', 'bin'), exist_ok=True)
+					relative_path = os.path.relpath(exe, args.output)
+					os.symlink(
+						os.path.join('..', '..', relative_path),
+						os.path.join(
+							args.output, 'usr', 'bin',
+							os.path.basename(exe),
 						)
-					)[0],
-					dest_deb,
-					str(out_dir)
-				)
-				installset.remove(p)
+					)
+	finally:
+		shutil.rmtree(unpack_dir, ignore_errors=True)
 
-		prune_files(out_dir)
+	out_dir = Path(args.output)
 
-		for p in installset:
-			#
-			# There was a binary package in the list to be installed that is not in the repo
-			#
-			e = "ERROR: Package %s not found in Packages files\n" % p
-			sys.stderr.write(e)
-
-		if installset and args.strict:
-			raise SystemExit('Not all binary packages were found')
-
-		# Combine basically all directories, except for {usr/,}{s,}bin
-		# which collides (see
-		# templates/scripts/check-runtime-conflicts.sh) and installed
-		# which is only metadata anyway
-		for pattern in ('*', 'usr/*'):
-			for dir in glob.glob(str(out_dir / pattern)):
-				if dir.endswith(('/bin', '/sbin', '/usr')):
-					# Don't merge bin, sbin - they
-					# will definitely collide.
-					# Don't merge all of usr - we merge its
-					# subdirectories instead, because we
-					# want to skip usr/bin and usr/sbin.
+	# We want some executables to be in the PATH for apps/games, but not
+	# for Steam components, to avoid a cyclic dependency.
+	(out_dir / 'game-bin').mkdir(exist_ok=True, mode=0o755, parents=True)
+
+	for exe, name in (
+		('usr/bin/steam-runtime-steam-remote', 'steam'),
+		('usr/bin/steam-runtime-urlopen', 'xdg-open'),
+		# TODO: Maybe consider this too?
+		# ('usr/libexec/flatpak-xdg-utils/xdg-email', 'xdg-email'),
+	):
+		if (out_dir / exe).exists():
+			(out_dir / 'game-bin' / name).symlink_to('../' + exe)
+		elif (out_dir / architectures[0] / exe).exists():
+			(out_dir / 'game-bin' / name).symlink_to(
+				'../%s/%s' % (architectures[0], exe)
+			)
+
+	if skipped > 0:
+		print("Skipped downloading %i file(s) that were already present." % skipped)
+
+	report_pruned(unpacked.values())
+
+
+def report_pruned(unpacked):
+	# type: (typing.Iterable[concurrent.futures.Future]) -> None
+	pruned = sum(future.result()[1] for future in unpacked)
+
+	if pruned > 0:
+		print("Skipped unpacking %s of unnecessary files." % format_size(pruned))
+
+
+# Files that are considered to be unnecessary, and are not unpacked.
+# Each rule is a path relative to the root directory, in which * and ?
+# match within a path component and **/ matches any number of
+# directories; everything below a matching directory is also excluded.
+# A rule starting with ! keeps paths that another rule would exclude.
+PRUNE_RULES = (
+	# Nvidia cg toolkit manuals, tutorials and documentation
+	'usr/share/doc/nvidia-cg-toolkit/html',
+	'usr/share/doc/nvidia-cg-toolkit/*.pdf.gz',
+	# Sample code
+	'usr/share/doc/**/examples',
+	# Debian bug reporting scripts
+	'usr/share/bug',
+	# Debian documentation metadata
+	'usr/share/doc-base',
+	# Debian QA metadata
+	'usr/share/lintian',
+	# Programs and utilities manuals
+	'usr/share/man',
+	# Remove the localized messages that are likely never going to be used.
+	# Keep only "en", because that's the default language we are using.
+	'usr/share/locale/*',
+	'!usr/share/locale/en',
+)
+
+
+def compile_path_rules(rules):
+	# type: (typing.Iterable[str]) -> typing.Pattern[str]
+	"""
+	Compile rules in the format of PRUNE_RULES, ignoring any ! prefix,
+	into a regular expression matching a normalized relative path.
+	"""
+	alternatives = []
+
+	for rule in rules:
+		regex = ''
+
+		for token in re.split(r'(\*\*/|\*|\?)', rule.lstrip('!')):
+			if token == '**/':
+				regex += '(?:[^/]+/)*'
+			elif token == '*':
+				regex += '[^/]*'
+			elif token == '?':
+				regex += '[^/]'
+			else:
+				regex += re.escape(token)
+
+		alternatives.append(regex)
+
+	return re.compile('(?:%s)(?:/|$)' % '|'.join(alternatives))
+
+
+class PruneRules:
+	"""
+	A matcher for paths that should not be unpacked, compiled from
+	rules in the format of PRUNE_RULES.
+	"""
+
+	def __init__(self, rules=PRUNE_RULES):
+		# type: (typing.Sequence[str]) -> None
+		# Packages unpacked with different rules are cached separately
+		self.version = hashlib.sha256(
+			'\n'.join(rules).encode('utf-8')).hexdigest()[:16]
+		self.exclude = compile_path_rules(
+			r for r in rules if not r.startswith('!'))
+		self.keep = compile_path_rules(
+			r for r in rules if r.startswith('!'))
+
+	def __call__(self, path):
+		# type: (str) -> bool
+		"""
+		Return True if path, relative to the root directory and
+		normalized by os.path.normpath(), should not be unpacked.
+		"""
+		return (
+			self.exclude.match(path) is not None
+			and self.keep.match(path) is None
+		)
+
+
+def prune_tree(
+	directory,		# type: str
+	prune			# type: PruneRules
+):
+	# type: (...) -> int
+	"""
+	Remove the files below directory that prune matches, for packages
+	that could not be filtered while they were unpacked. Return the
+	number of bytes removed.
+	"""
+	removed = 0
+
+	for dirpath, dirnames, filenames in os.walk(directory):
+		relative_dir = os.path.relpath(dirpath, directory)
+
+		for name in dirnames[:]:
+			path = os.path.join(dirpath, name)
+
+			if prune(os.path.normpath(os.path.join(relative_dir, name))):
+				dirnames.remove(name)
+
+				if os.path.islink(path):
+					os.unlink(path)
 					continue
 
-				for (dirpath, dirnames, filenames) in os.walk(dir):
-					relative_path = os.path.relpath(
-						dirpath,
-						str(out_dir),
-					)
+				for subdir, _, subfiles in os.walk(path):
+					for subfile in subfiles:
+						removed += os.lstat(
+							os.path.join(subdir, subfile)).st_size
 
-					for member in dirnames:
-						merged = os.path.join(
-							args.output,
-							relative_path,
-							member,
-						)
-						os.makedirs(merged, exist_ok=True)
+				shutil.rmtree(path)
 
-					for member in filenames:
-						source = os.path.join(
-							dirpath,
-							member,
-						)
-						merged = os.path.join(
-							args.output,
-							relative_path,
-							member,
-						)
-						if os.path.exists(merged):
-							if not keep_only_primary_arch(relative_path):
-								warn_if_different(source, merged)
-						else:
-							os.makedirs(os.path.dirname(merged), exist_ok=True)
-							shutil.move(source, merged)
-
-				# Replace amd64/usr/lib with a symlink to
-				# ../usr/lib, etc.
-				relative_path = os.path.relpath(
-					dir,
-					str(out_dir),
-				)
-				merged = os.path.join(
-					args.output,
-					relative_path,
-				)
-				shutil.rmtree(dir)
-				os.symlink(
-					os.path.join(
-						'../' * (relative_path.count('/') + 1),
-						relative_path,
-					),
-					dir,
-				)
+		for name in filenames:
+			path = os.path.join(dirpath, name)
 
-		for pattern in ('bin/{}-*', 'usr/bin/{}-*'):
-			for exe in glob.glob(str(out_dir / pattern.format(ARCHITECTURES[arch]))):
-				# Populate OUTPUT/usr/bin with symlinks
-				# to OUTPUT/amd64/[usr/]bin/x86_64-linux-gnu-*
-				# and OUTPUT/i386/[usr/]bin/i386-linux-gnu-*
-				os.makedirs(os.path.join(args.output, 'usr', 'bin'), exist_ok=True)
-				relative_path = os.path.relpath(exe, args.output)
-				os.symlink(
-					os.path.join('..', '..', relative_path),
-					os.path.join(
-						args.output, 'usr', 'bin',
-						os.path.basename(exe),
-					)
-				)
+			if prune(os.path.normpath(os.path.join(relative_dir, name))):
+				removed += os.lstat(path).st_size
+				os.unlink(path)
+
+	return removed
+
+
+class BoundedReader(io.RawIOBase):
+	"""
+	Read at most size bytes from raw, such as one member of an ar
+	archive.
+	"""
+
+	def __init__(self, raw, size):
+		# type: (typing.BinaryIO, int) -> None
+		super(BoundedReader, self).__init__()
+		self.raw = raw
+		self.remaining = size
+
+	def readable(self):
+		# type: () -> bool
+		return True
+
+	def readinto(self, buffer):
+		# type: (typing.Any) -> int
+		if self.remaining <= 0:
+			return 0
+
+		blob = self.raw.read(min(len(buffer), self.remaining))
+
+		if not blob:
+			raise EOFError('Unexpected end of ar archive')
+
+		n = len(blob)
+		buffer[:n] = blob
+		self.remaining -= n
+		return n
+
+
+# tarfile stream modes for each compression of a .deb's data.tar
+DEB_DATA_COMPRESSION = {		# type: typing.Dict[str, typing.Any]
+	'': 'r|',
+	'.gz': 'r|gz',
+	'.xz': 'r|xz',
+	'.bz2': 'r|bz2',
+	'.zst': 'r|',			# decompressed by zstandard, if available
+}
+
+# The type character at the beginning of each line of tar -tv output
+TAR_LIST_TYPES = {
+	tarfile.DIRTYPE: 'd',
+	tarfile.SYMTYPE: 'l',
+	tarfile.LNKTYPE: 'h',
+	tarfile.CHRTYPE: 'c',
+	tarfile.BLKTYPE: 'b',
+	tarfile.FIFOTYPE: 'p',
+}
+
+
+# Characters that GNU tar escapes in listings
+TAR_UNQUOTED = re.compile(r'[^ -\[\]-~]')
+
+
+def tar_quote(name):
+	# type: (str) -> str
+	"""
+	Quote a filename the way GNU tar does in its listings, with
+	C-style escapes for backslashes and unprintable characters.
+	"""
+	if TAR_UNQUOTED.search(name) is None:
+		return name
+
+	quoted = []
+
+	for b in os.fsencode(name):
+		if b == 0x5c:
+			quoted.append('\\\\')
+		elif 0x20 <= b < 0x7f:
+			quoted.append(chr(b))
+		elif b in b'\a\b\f\n\r\t\v':
+			quoted.append('\\' + 'abtnvfr'[b - 7])
+		else:
+			quoted.append('\\%03o' % b)
+
+	return ''.join(quoted)
+
+
+class TarLister:
+	"""
+	Format tar members in the same way as "tar -tv" (and therefore
+	"dpkg-deb -c") from GNU tar, which widens the owner and size
+	column as necessary but never narrows it again.
+	"""
+
+	def __init__(self):
+		# type: () -> None
+		self.width = 19
+		# Members of a package usually all have the same mtime
+		self.timestamps = {}		# type: typing.Dict[float, str]
+
+	def line(self, member):
+		# type: (tarfile.TarInfo) -> str
+		mode = TAR_LIST_TYPES.get(member.type, '-') + stat.filemode(
+			member.mode)[1:]
+		user = member.uname or str(member.uid)
+		group = member.gname or str(member.gid)
+
+		if member.ischr() or member.isblk():
+			size = '%d,%d' % (member.devmajor, member.devminor)
+		else:
+			size = str(member.size)
+
+		owner = '%s/%s' % (user, group)
+		self.width = max(self.width, len(owner) + 1 + len(size))
+		name = member.name
+
+		if member.isdir():
+			# tarfile removes the trailing slash
+			name += '/'
+
+		timestamp = self.timestamps.get(member.mtime)
+
+		if timestamp is None:
+			timestamp = time.strftime(
+				'%Y-%m-%d %H:%M', time.localtime(member.mtime))
+			self.timestamps[member.mtime] = timestamp
+
+		line = '%s %s %*s %s %s' % (
+			mode,
+			owner,
+			self.width - len(owner) - 1,
+			size,
+			timestamp,
+			tar_quote(name),
+		)
+
+		if member.issym():
+			line += ' -> %s' % tar_quote(member.linkname)
+		elif member.islnk():
+			line += ' link to %s' % tar_quote(member.linkname)
+
+		return line + '\n'
+
+
+def remove_existing(path):
+	# type: (str) -> None
+	"""
+	Remove path if it exists and is not a directory, like tar does
+	before extracting a file. This means that extracting into a tree
+	of hard-links does not alter the files they are linked to.
+	"""
+	try:
+		os.unlink(path)
+	except OSError as e:
+		if e.errno not in (errno.ENOENT, errno.EISDIR):
+			raise
+
+
+class UnsupportedPackage(Exception):
+	"""
+	Raised when a .deb cannot be unpacked in-process, so that it must
+	be unpacked with dpkg-deb instead.
+	"""
+
+
+def member_path(name, dest_dir):
+	# type: (str, str) -> str
+	"""
+	Return the tar member name, normalized, as a path relative to
+	dest_dir. Raise ValueError if it would be outside dest_dir.
+	"""
+	rel = os.path.normpath(name)
+
+	if os.path.isabs(rel) or rel == '..' or rel.startswith('../'):
+		raise ValueError(
+			'Refusing to extract %r outside %s' % (name, dest_dir))
+
+	return rel
+
+
+def check_parents(dest_dir, rel, create=False):
+	# type: (str, str, bool) -> None
+	"""
+	Check that none of the parent directories of rel below dest_dir
+	is a symbolic link, creating them if create is true. Raise
+	ValueError if one is, so that a symbolic link extracted from
+	an earlier member cannot be used to write outside dest_dir.
+	"""
+	path = dest_dir
+
+	if create:
+		os.makedirs(dest_dir, exist_ok=True)
+
+	for component in rel.split(os.sep)[:-1]:
+		path = os.path.join(path, component)
+
+		try:
+			st = os.lstat(path)
+		except FileNotFoundError:
+			if not create:
+				raise
+
+			os.mkdir(path)
+			continue
+
+		if stat.S_ISLNK(st.st_mode):
+			raise ValueError(
+				'Refusing to extract %r through symbolic link %s' % (
+					rel, path))
+
+
+def extract_tar_stream(
+	tar,			# type: tarfile.TarFile
+	dest_dir,		# type: str
+	prune=None		# type: typing.Optional[PruneRules]
+):
+	# type: (...) -> typing.Tuple[typing.List[str], int]
+	"""
+	Extract each member of tar, which is being read sequentially, into
+	dest_dir, in the same way as "dpkg-deb -x", except for members
+	that prune matches. Return a listing of all its contents in the
+	format of "dpkg-deb -c", and the number of bytes that were not
+	written because of prune.
+
+	Raise UnsupportedPackage if a hard link refers to a file that
+	was not written because of prune, or ValueError if a member or
+	the target of a hard link would be outside dest_dir, including
+	by way of a symbolic link.
+	"""
+	lister = TarLister()
+	listing = []		# type: typing.List[str]
+	directories = []		# type: typing.List[tarfile.TarInfo]
+	pruned = set()		# type: typing.Set[str]
+	pruned_size = 0
+
+	for member in tar:
+		listing.append(lister.line(member))
+		rel = member_path(member.name, dest_dir)
+
+		if prune is not None and prune(rel):
+			pruned.add(rel)
+			pruned_size += member.size
+			continue
+
+		check_parents(dest_dir, rel, create=True)
+		path = os.path.join(dest_dir, rel)
+
+		if member.isdir():
+			if os.path.islink(path):
+				os.unlink(path)
+
+			if not os.path.isdir(path):
+				os.mkdir(path)
+
+			# Set the mode and timestamp after the contents have
+			# been extracted, as tar does
+			directories.append(member)
+			continue
+
+		remove_existing(path)
+
+		if member.isreg():
+			source = tar.extractfile(member)
+			assert source is not None
+
+			with open(path, 'xb') as writer:
+				shutil.copyfileobj(source, writer, 1024 * 1024)
+
+			os.chmod(path, member.mode)
+		elif member.issym():
+			os.symlink(member.linkname, path)
+		elif member.islnk():
+			target = member_path(member.linkname, dest_dir)
+
+			if target in pruned:
+				raise UnsupportedPackage(
+					'Cannot hard-link %s to %s, which was pruned' % (
+						member.name, member.linkname))
+
+			check_parents(dest_dir, target)
+			os.link(
+				os.path.join(dest_dir, target), path,
+				follow_symlinks=False)
+			continue
+		else:
+			raise ValueError(
+				'Unsupported member type %r: %s' % (
+					member.type, member.name))
+
+		os.utime(
+			path, (member.mtime, member.mtime), follow_symlinks=False)
+
+	for member in reversed(directories):
+		path = os.path.join(dest_dir, os.path.normpath(member.name))
+		os.chmod(path, member.mode)
+		os.utime(path, (member.mtime, member.mtime))
+
+	return listing, pruned_size
+
+
+def unpack_deb(
+	deb,			# type: str
+	dest_dir,		# type: str
+	algorithm=None,		# type: typing.Optional[str]
+	prune=None		# type: typing.Optional[PruneRules]
+):
+	# type: (...) -> typing.Tuple[typing.List[str], typing.Optional[str], int]
+	"""
+	Extract the contents of the .deb at path deb into dest_dir in a
+	single pass, without needing dpkg-deb, except for files that prune
+	matches. Return a listing of its contents in the format of
+	"dpkg-deb -c", the hex digest of the .deb itself if algorithm is
+	not None, and the number of bytes that were pruned.
+
+	Raise UnsupportedPackage if the data.tar member is compressed in
+	a way that we cannot decompress, or cannot be pruned.
+	"""
+	listing = None		# type: typing.Optional[typing.List[str]]
+	pruned = 0
+
+	with open(deb, 'rb') as raw:
+		if algorithm is None:
+			hasher = None
+			reader = raw		# type: typing.BinaryIO
+		else:
+			hasher = HashingReader(raw, algorithm)
+			reader = io.BufferedReader(hasher, 1024 * 1024)		# type: ignore
+
+		if reader.read(8) != b'!<arch>\n':
+			raise ValueError('%s is not an ar archive' % deb)
+
+		while True:
+			header = reader.read(60)
+
+			if not header:
+				break
+
+			if len(header) < 60 or header[58:60] != b'`\n':
+				raise ValueError('%s: malformed ar header' % deb)
+
+			name = header[:16].rstrip(b' ').rstrip(b'/').decode('ascii')
+			size = int(header[48:58])
+			member = io.BufferedReader(
+				BoundedReader(reader, size), 1024 * 1024)
+
+			if name.startswith('data.tar') and listing is None:
+				suffix = name[len('data.tar'):]
+
+				if suffix not in DEB_DATA_COMPRESSION or (
+					suffix == '.zst' and zstandard is None
+				):
+					raise UnsupportedPackage(
+						'%s: cannot decompress %s' % (deb, name))
+
+				if suffix == '.zst':
+					data = zstandard.ZstdDecompressor().stream_reader(
+						member)
+				else:
+					data = member
+
+				with tarfile.open(
+					fileobj=data, mode=DEB_DATA_COMPRESSION[suffix],
+				) as tar:
+					listing, pruned = extract_tar_stream(
+						tar, dest_dir, prune)
+
+			drain(member)
+
+			# Members are aligned to an even offset
+			if size % 2:
+				reader.read(1)
+
+		if listing is None:
+			raise ValueError('%s has no data.tar member' % deb)
+
+		if hasher is None:
+			return listing, None, pruned
+
+		drain(reader)
+		return listing, hasher.hasher.hexdigest(), pruned
+
+
+def install_deb (basename, deb, dest_dir, md5=None, prune=None):
+	# This runs in worker processes, so it must not use args.
+	# Return the number of bytes that were not unpacked because of prune
+	check_path_traversal(basename)
+	installtag_dir=os.path.join(dest_dir, "installed")
+	if not os.access(installtag_dir, os.W_OK):
+		os.makedirs(installtag_dir)
+
+	#
+	# Unpack the package into the dest_dir, and write the tag file
+	# to the 'installed' subdirectory. The cached .deb is only
+	# hashed if its Packages stanza did not tell us its MD5: it was
+	# verified while it was downloaded.
+	#
+	listing_path = os.path.join(installtag_dir, basename)
+
+	try:
+		listing, digest, pruned = unpack_deb(
+			deb, dest_dir, 'md5' if md5 is None else None, prune)
+	except UnsupportedPackage:
+		# Fall back to dpkg-deb, for example for a data.tar.zst
+		# if the zstandard module is not available
+		with open(listing_path, "w") as f:
+			subprocess.check_call(['dpkg-deb', '-c', deb], stdout=f)
+
+		subprocess.check_call(['dpkg-deb', '-x', deb, dest_dir])
+		pruned = 0
+
+		if prune is not None:
+			pruned = prune_tree(dest_dir, prune)
+
+		if md5 is None:
+			md5 = hash_file(deb, 'md5')[1]
+	else:
+		with open(listing_path, "w") as f:
+			f.writelines(listing)
+
+		if md5 is None:
+			md5 = digest
+
+	# The cached .deb is named after its checksum, so record the
+	# name it had in the repository, in the format used by md5sum.
+	with open(os.path.join(installtag_dir, basename + ".md5"), "w") as f:
+		f.write('%s  %s.deb\n' % (md5, basename))
+
+	return pruned
+
+
+def unpack_package(
+	basename,		# type: str
+	deb,			# type: str
+	dest_dir,		# type: str
+	md5=None,		# type: typing.Optional[str]
+	prune=None,		# type: typing.Optional[PruneRules]
+	cached=None		# type: typing.Optional[str]
+):
+	# type: (...) -> typing.Tuple[str, int]
+	"""
+	Unpack deb with install_deb() into dest_dir, or if cached is not
+	None, into that directory in an UnpackCache. Return the directory
+	and the number of bytes that were pruned.
+	"""
+	if cached is None:
+		return dest_dir, install_deb(basename, deb, dest_dir, md5, prune)
+
+	# Unpack next to the cache entry and then rename it into place,
+	# so that a partially unpacked package is never used
+	parent = os.path.dirname(cached)
+	os.makedirs(parent, exist_ok=True)
+	temp = tempfile.mkdtemp(prefix='.unpack-', dir=parent)
+
+	try:
+		pruned = install_deb(basename, deb, temp, md5, prune)
+	except BaseException:
+		shutil.rmtree(temp)
+		raise
+
+	try:
+		os.rename(temp, cached)
+	except OSError:
+		# Another build unpacked the same package at the same time
+		shutil.rmtree(temp)
+
+		if not os.path.isdir(cached):
+			raise
+
+	return cached, pruned
+
+
+class UnpackCache:
+	"""
+	A directory of packages that have already been unpacked, each named
+	after the SHA256 checksum of its .deb and the rules that were used
+	to prune it. Release, debug and symbols builds can clone (or
+	failing that, copy) the files from here into place, instead of
+	unpacking the same .deb files again.
+
+	With --link-unpacked, files are hard-linked into place instead, so
+	files in the output directory must then always be replaced rather
+	than modified in-place, or the cache would be modified too.
+	"""
+
+	def __init__(
+		self,
+		path,			# type: str
+		prune=None		# type: typing.Optional[PruneRules]
+	):
+		# type: (...) -> None
+		self.path = path
+		self.version = '%d-%s' % (
+			UNPACK_FORMAT, prune.version if prune is not None else 'all')
+
+	def path_for(self, checksum, basename):
+		# type: (Checksum, str) -> typing.Optional[str]
+		"""
+		Return the directory into which the .deb with this checksum,
+		named basename.deb, is unpacked, or None if it cannot be
+		cached because we do not know its SHA256.
+		"""
+		algorithm, digest, size = checksum
+
+		if algorithm != 'sha256':
+			return None
+
+		if not re.match(r'^[0-9a-f]+$', digest):
+			raise ValueError('Invalid %s checksum %r' % (algorithm, digest))
+
+		check_path_traversal(basename)
+		return os.path.join(
+			self.path, self.version, digest[:2], digest, basename)
+
+	def trim(self, pool):
+		# type: (PackagePool) -> int
+		"""
+		Delete packages that were unpacked with different rules, or
+		whose .deb is no longer in pool. Return the number deleted.
+		"""
+		removed = 0
+
+		if not os.path.isdir(self.path):
+			return removed
+
+		for version in os.listdir(self.path):
+			for prefix in os.listdir(os.path.join(self.path, version)):
+				for digest in os.listdir(
+					os.path.join(self.path, version, prefix)
+				):
+					if (
+						version == self.version
+						and pool.has(('sha256', digest, 0))
+					):
+						continue
+
+					shutil.rmtree(
+						os.path.join(self.path, version, prefix, digest))
+					removed += 1
+
+			if version != self.version:
+				shutil.rmtree(os.path.join(self.path, version))
 
-	out_dir = Path(args.output)
+		return removed
 
-	# We want some executables to be in the PATH for apps/games, but not
-	# for Steam components, to avoid a cyclic dependency.
-	(out_dir / 'game-bin').mkdir(exist_ok=True, mode=0o755, parents=True)
 
-	for exe, name in (
-		('usr/bin/steam-runtime-steam-remote', 'steam'),
-		('usr/bin/steam-runtime-urlopen', 'xdg-open'),
-		# TODO: Maybe consider this too?
-		# ('usr/libexec/flatpak-xdg-utils/xdg-email', 'xdg-email'),
+class PackageUnpacker:
+	"""
+	Unpack .deb files with install_deb(), each into a directory of its
+	own, using a pool of jobs worker processes. Each package's files
+	can then be put into place with link_tree() or MergedTree, using
+	self.link_file, in the same order in which they would have been
+	unpacked one at a time, so that the result does not depend on
+	which worker finished first.
+
+	Files that prune matches are not unpacked. If cache is not None,
+	packages that have already been unpacked into it are not unpacked
+	again, and packages that have not are unpacked into it. Files from
+	the cache are then cloned or copied into place, so that modifying
+	them cannot alter the cache, unless link_cached is true.
+
+	If jobs is 1, packages are unpacked immediately, in this process.
+	"""
+
+	def __init__(
+		self,
+		jobs,				# type: int
+		prune=None,			# type: typing.Optional[PruneRules]
+		cache=None,			# type: typing.Optional[UnpackCache]
+		mp_context=None,		# type: typing.Any
+		link_cached=False		# type: bool
 	):
-		if (out_dir / exe).exists():
-			(out_dir / 'game-bin' / name).symlink_to('../' + exe)
-		elif (out_dir / architectures[0] / exe).exists():
-			(out_dir / 'game-bin' / name).symlink_to(
-				'../%s/%s' % (architectures[0], exe)
+		# type: (...) -> None
+		self.prune = prune
+		self.cache = cache
+
+		if cache is None or link_cached:
+			self.link_file = hard_link_or_copy		# type: typing.Callable[[str, str], None]
+		else:
+			self.link_file = reflink_or_copy
+
+		self.reused = 0
+		self._executor = None		# type: typing.Optional[concurrent.futures.ProcessPoolExecutor]
+
+		if jobs > 1:
+			if mp_context is None:
+				# Don't fork a process that has download threads
+				mp_context = multiprocessing.get_context('forkserver')
+
+			self._executor = concurrent.futures.ProcessPoolExecutor(
+				max_workers=jobs,
+				mp_context=mp_context,
 			)
 
-	if skipped > 0:
-		print("Skipped downloading %i file(s) that were already present." % skipped)
+	def unpack(
+		self,
+		basename,		# type: str
+		deb,			# type: str
+		dest_dir,		# type: str
+		md5=None,		# type: typing.Optional[str]
+		checksum=None		# type: typing.Optional[Checksum]
+	):
+		# type: (...) -> concurrent.futures.Future
+		"""
+		Start unpacking deb, with the given checksum, into the cache
+		or into dest_dir, which should not be shared with any other
+		package. The result is a tuple: the directory containing the
+		unpacked files, and the number of bytes that were pruned.
+		"""
+		future = concurrent.futures.Future()		# type: concurrent.futures.Future
+		cached = None
+
+		if self.cache is not None and checksum is not None:
+			cached = self.cache.path_for(checksum, basename)
+
+		if cached is not None and os.path.isdir(cached):
+			self.reused += 1
+			future.set_result((cached, 0))
+			return future
 
+		if args.verbose:
+			print('Unpacking %s into %s' % (deb, cached or dest_dir))
 
-def prune_files(directory: Path) -> None:
-	"""Remove files that are considered to be unnecessary"""
-
-	usr_share = directory / 'usr' / 'share'
-	doc = usr_share / 'doc'
-	paths: list[Path] = [
-		# Nvidia cg toolkit manuals, tutorials and documentation
-		doc / 'nvidia-cg-toolkit' / 'html',
-		*doc.glob('nvidia-cg-toolkit/*.pdf.gz'),
-		# Sample code
-		*doc.glob('**/examples'),
-		# Debian bug reporting scripts
-		usr_share / 'bug',
-		# Debian documentation metadata
-		usr_share / 'doc-base',
-		# Debian QA metadata
-		usr_share / 'lintian',
-		# Programs and utilities manuals
-		usr_share / 'man',
-		# Remove the localized messages that are likely never going to be used.
-		# Keep only "en", because that's the default language we are using.
-		*[x for x in usr_share.glob('locale/*') if x.name != 'en'],
-	]
+		if self._executor is not None:
+			return self._executor.submit(
+				unpack_package, basename, deb, dest_dir, md5, self.prune,
+				cached)
 
-	for path in paths:
-		if path.is_dir():
-			shutil.rmtree(path)
+		try:
+			result = unpack_package(
+				basename, deb, dest_dir, md5, self.prune, cached)
+		except Exception as e:
+			future.set_exception(e)
 		else:
-			path.unlink(missing_ok=True)
+			future.set_result(result)
 
+		return future
 
-def install_deb (basename, deb, dest_dir):
-	if args.verbose:
-		print('Unpacking %s into %s' % (deb, dest_dir))
-	check_path_traversal(basename)
-	installtag_dir=os.path.join(dest_dir, "installed")
-	if not os.access(installtag_dir, os.W_OK):
-		os.makedirs(installtag_dir)
+	def shutdown(self):
+		# type: () -> None
+		if self._executor is not None:
+			self._executor.shutdown()
 
-	#
-	# Write the tag file and checksum to the 'installed' subdirectory
-	#
-	with open(os.path.join(installtag_dir, basename), "w") as f:
-		subprocess.check_call(['dpkg-deb', '-c', deb], stdout=f)
-	with open(os.path.join(installtag_dir, basename + ".md5"), "w") as f:
-		os.chdir(os.path.dirname(deb))
-		subprocess.check_call(['md5sum', os.path.basename(deb)], stdout=f)
 
-	#
-	# Unpack the package into the dest_dir
-	#
-	os.chdir(top)
-	subprocess.check_call(['dpkg-deb', '-x', deb, dest_dir])
+def select_symbols(dbgsym_by_arch, manifest):
+	# type: (typing.Mapping[str, typing.Mapping[str, typing.List[Binary]]], typing.Dict[typing.Tuple[str, str], Binary]) -> typing.Dict[typing.Tuple[str, str], Binary]
+	"""
+	Return the detached debug symbols packages that match the
+	packages in manifest, as {('libfoo2-dbgsym', 'amd64'): Binary}.
+	"""
+	selected = {}		# type: typing.Dict[typing.Tuple[str, str], Binary]
 
+	# We only download detached debug symbols for packages that we
+	# already installed for the corresponding architecture, so look
+	# them up by name rather than looking at every one
+	for (parent_name, arch), parent in sorted(
+		manifest.items(), key=lambda item: (item[0][1], item[0][0])
+	):
+		arch_binaries = dbgsym_by_arch.get(arch)
 
-def install_symbols(dbgsym_by_arch, binarylist, manifest):
-	skipped = 0
-	for arch, arch_binaries in sorted(dbgsym_by_arch.items()):
+		if arch_binaries is None:
+			continue
 
-		#
-		# Create the destination directory if necessary
-		#
-		dir = os.path.join(top,destdir, "symbols", arch)
-		if not os.access(dir, os.W_OK):
-			os.makedirs(dir)
+		# If parent_name is libfoo2, then p is libfoo2-dbgsym.
+		p = parent_name + '-dbgsym'
+		binaries = arch_binaries.get(p)
 
-		out_dir = get_output_dir_for_arch(arch)
+		if binaries is None:
+			continue
 
-		for p, binaries in sorted(arch_binaries.items()):
-			if not p.endswith('-dbgsym'):
-				# not a detached debug symbol package
-				continue
+		# Find a matching version if we can
+		tried = []
 
-			# If p is libfoo2-dbgsym, then parent_name is libfoo2.
-			parent_name = p[:-len('-dbgsym')]
-			parent = manifest.get((parent_name, arch))
+		for b in binaries:
+			if b.version == parent.version:
+				selected[(p, arch)] = b
+				break
+			else:
+				tried.append(b.version)
+		else:
+			# There's no point in installing detached debug
+			# symbols if they don't match
+			tried.sort()
+			sys.stderr.write(
+				'WARNING: Debug symbol package '
+				'%s not found at version %s '
+				'(available: %s)\n' % (
+					p,
+					parent.version,
+					', '.join(tried),
+				)
+			)
 
-			# We only download detached debug symbols for
-			# packages that we already installed for the
-			# corresponding architecture
-			if parent is not None:
-				# Find a matching version if we can
-				tried = []
+	return selected
 
-				for b in binaries:
-					if b.version == parent.version:
-						dbgsym = b
-						break
-					else:
-						tried.append(b.version)
-				else:
-					# There's no point in installing
-					# detached debug symbols if they don't
-					# match
-					tried.sort()
-					sys.stderr.write(
-						'WARNING: Debug symbol package '
-						'%s not found at version %s '
-						'(available: %s)\n' % (
-							p,
-							parent.version,
-							', '.join(tried),
-						)
-					)
+
+def install_symbols(
+	dbgsym_by_arch,
+	binarylist,
+	manifest,
+	downloader,		# type: PackageDownloader
+	unpacker		# type: PackageUnpacker
+):
+	skipped = 0
+	selected = select_symbols(dbgsym_by_arch, manifest)
+	downloader.download(
+		deb_download(dbgsym)
+		for dbgsym in selected.values()
+	)
+	unpack_dir = tempfile.mkdtemp(prefix='.unpack-', dir=args.output)
+
+	try:
+		unpacked = {}		# type: typing.Dict[typing.Tuple[str, str], concurrent.futures.Future]
+
+		for (p, arch), dbgsym in sorted(selected.items()):
+			#
+			# Wait for the package to be downloaded and install it
+			#
+			check_path_traversal(dbgsym.stanza['Filename'])
+			basename = os.path.splitext(
+				os.path.basename(dbgsym.stanza['Filename'])
+			)[0]
+			checksum = deb_checksum(dbgsym)
+			if not downloader.result(checksum):
+				skipped += 1
+			dest_deb = downloader.pool.path_for(checksum)
+			unpacked[(p, arch)] = unpacker.unpack(
+				basename, dest_deb, os.path.join(unpack_dir, basename),
+				dbgsym.stanza.get('MD5sum'), checksum)
+
+		for arch in sorted(dbgsym_by_arch):
+			out_dir = get_output_dir_for_arch(arch)
+
+			for (p, dbgsym_arch), dbgsym in sorted(selected.items()):
+				if dbgsym_arch != arch:
 					continue
 
 				manifest[(p, arch)] = dbgsym
 
 				if args.verbose:
-					print("DOWNLOADING SYMBOLS: %s" % p)
-				#
-				# Download the package and install it
-				#
-				check_path_traversal(dbgsym.stanza['Filename'])
-				file_url = "%s/%s" % (
-					dbgsym.apt_source.url,
-					dbgsym.stanza['Filename'],
-				)
-				dest_deb = os.path.join(
-					dir,
-					os.path.basename(
-						dbgsym.stanza['Filename'])
-				)
-				if not download_file(file_url, dest_deb):
-					skipped += 1
-				install_deb(
-					os.path.splitext(
-						os.path.basename(
-							dbgsym.stanza['Filename'])
-					)[0],
-					dest_deb,
-					str(out_dir)
-				)
+					print("INSTALLING SYMBOLS: %s" % p)
 
-		prune_files(out_dir)
+				# OUTPUT/ARCH/installed has already been merged into
+				# OUTPUT/installed
+				link_tree(
+					unpacked[(p, arch)].result()[0], str(out_dir),
+					follow_symlinks={'installed'},
+					link_file=unpacker.link_file)
+	finally:
+		shutil.rmtree(unpack_dir, ignore_errors=True)
 
 	if skipped > 0:
 		print("Skipped downloading %i symbol deb(s) that were already present." % skipped)
 
+	report_pruned(unpacked.values())
+
+	return selected
+
 
 # Walks through the files in the output directory and converts any absolute symlinks
 # to their relative equivalent
@@ -1275,430 +5059,949 @@ def normalize_tar_entry(entry):
 	return entry
 
 
-# Create files u=rwX,go=rX by default
-os.umask(0o022)
+class Lockfile:
+	"""
+	The exact set of packages chosen by a build, so that the same
+	runtime can be built again without downloading the Packages and
+	Sources files or resolving dependencies.
+	"""
 
-args = parse_args()
-if args.verbose:
-	for property, value in sorted(vars(args).items()):
-		print("\t", property, ": ", value)
+	FORMAT = 1
 
-apt_sources = [
-	AptSource('deb', args.repo, args.suite, ('main',)),
-	AptSource('deb-src', args.repo, args.suite, ('main',)),
-]
-seen_apt_lines = set()		# type: typing.Set[str]
+	def __init__(
+		self,
+		apt_sources,		# type: typing.List[AptSource]
+		timestamps,		# type: typing.Dict[AptSource, int]
+		binaries,		# type: typing.Dict[str, typing.Dict[str, Binary]]
+		symbols=None,		# type: typing.Optional[typing.Dict[str, typing.Dict[str, Binary]]]
+		sources=None,		# type: typing.Optional[typing.Dict[str, typing.List[SourcePackage]]]
+		architectures=None		# type: typing.Optional[typing.List[str]]
+	):
+		# type: (...) -> None
+		if architectures is None:
+			architectures = list(binaries)
+
+		self.apt_sources = apt_sources
+		self.timestamps = timestamps
+		# {'amd64': {'libfoo2': <Binary>}}
+		self.binaries = binaries
+		# ['amd64', 'i386']: order is significant, as for
+		# --architecture, so it is not taken from binaries
+		self.architectures = architectures
+		# {'amd64': {'libfoo2-dbgsym': <Binary>}}, or None if the
+		# build did not include detached debug symbols
+		self.symbols = symbols
+		# {'glib2.0': [<SourcePackage>, ...]}, or None if the build
+		# did not include source code
+		self.sources = sources
+
+	def _binary_to_json(self, binary):
+		# type: (Binary) -> typing.Dict[str, typing.Any]
+		stanza = binary.stanza
+		ret = {
+			'apt_source': self.apt_sources.index(binary.apt_source),
+			'version': binary.version,
+			'filename': stanza['Filename'],
+			'stanza': binary.raw.decode('utf-8'),
+		}		# type: typing.Dict[str, typing.Any]
+
+		for key in ('SHA256', 'MD5sum'):
+			if key in stanza:
+				ret[key.lower()] = stanza[key]
 
-for line in list(args.upstream_apt_sources) + list(args.extra_apt_sources):
-	if line in seen_apt_lines:
-		continue
+		return ret
 
-	seen_apt_lines.add(line)
-	trusted=False
-	tokens = line.split()
+	def _binary_from_json(self, data):
+		# type: (typing.Dict[str, typing.Any]) -> Binary
+		raw = data['stanza'].encode('utf-8')
 
-	if len(tokens) < 4:
-		raise ValueError(
-			'--extra-apt-source argument must be in the form '
-			'"deb https://URL SUITE COMPONENT [COMPONENT...]"')
+		for name, arch, version, source, raw in PackagesIndex(raw).scan():
+			return Binary(
+				self.apt_sources[data['apt_source']],
+				name, arch, version, source, raw,
+			)
 
-	if tokens[0] not in ('deb', 'deb-src', 'both'):
-		raise ValueError(
-			'--extra-apt-source argument must start with '
-			'"deb ", "deb-src " or "both "')
+		raise ValueError('Lockfile entry has no Package field')
+
+	def save(self, path):
+		# type: (str) -> None
+		data = {
+			'format': self.FORMAT,
+			'architectures': self.architectures,
+			'apt_sources': [
+				{
+					'line': str(apt_source),
+					'date': self.timestamps.get(apt_source, 0),
+				}
+				for apt_source in self.apt_sources
+			],
+			'binaries': {
+				arch: {
+					p: self._binary_to_json(binary)
+					for p, binary in by_name.items()
+				}
+				for arch, by_name in self.binaries.items()
+			},
+		}		# type: typing.Dict[str, typing.Any]
+
+		if self.symbols is not None:
+			data['symbols'] = {
+				arch: {
+					p: self._binary_to_json(binary)
+					for p, binary in by_name.items()
+				}
+				for arch, by_name in self.symbols.items()
+			}
+
+		if self.sources is not None:
+			data['sources'] = {
+				p: [
+					{
+						'apt_source': self.apt_sources.index(
+							sp.apt_source),
+						'version': sp.stanza['Version'],
+						'urls': [
+							'%s/%s/%s' % (
+								sp.apt_source.url,
+								sp.stanza['directory'],
+								f['name'],
+							)
+							for f in sp.stanza['files']
+						],
+						'stanza': sp.stanza.dump(),
+					}
+					for sp in candidates
+				]
+				for p, candidates in self.sources.items()
+			}
+
+		with open(path + '.tmp', 'w') as writer:
+			json.dump(data, writer, indent=4, sort_keys=True)
+			writer.write('\n')
+
+		os.rename(path + '.tmp', path)
+
+	@classmethod
+	def load(cls, path):
+		# type: (str) -> Lockfile
+		with open(path) as reader:
+			data = json.load(reader)
+
+		if data.get('format') != cls.FORMAT:
+			raise ValueError(
+				'%s: unsupported lockfile format %r' % (
+					path, data.get('format')))
+
+		apt_sources = []		# type: typing.List[AptSource]
+		timestamps = {}		# type: typing.Dict[AptSource, int]
+
+		for entry in data['apt_sources']:
+			apt_source, = parse_apt_source(entry['line'])
+			apt_sources.append(apt_source)
+			timestamps[apt_source] = entry['date']
+
+		# Older lockfiles did not record the order
+		self = cls(
+			apt_sources, timestamps, {},
+			architectures=data.get(
+				'architectures', sorted(data['binaries'])),
+		)
 
-	if tokens[1] == '[trusted=yes]':
-		trusted=True
-		tokens = [tokens[0]] + tokens[2:]
-	elif tokens[1].startswith('['):
-		raise ValueError(
-			'--extra-apt-source does not support [opt=value] '
-			'syntax, except for [trusted=yes]')
+		for arch, by_name in data['binaries'].items():
+			self.binaries[arch] = {
+				p: self._binary_from_json(entry)
+				for p, entry in by_name.items()
+			}
+
+		if 'symbols' in data:
+			self.symbols = {
+				arch: {
+					p: self._binary_from_json(entry)
+					for p, entry in by_name.items()
+				}
+				for arch, by_name in data['symbols'].items()
+			}
+
+		if 'sources' in data:
+			self.sources = {
+				p: [
+					SourcePackage(
+						apt_sources[entry['apt_source']],
+						deb822.Sources(entry['stanza']),
+					)
+					for entry in candidates
+				]
+				for p, candidates in data['sources'].items()
+			}
 
-	if tokens[0] == 'both':
-		apt_sources.append(
-			AptSource(
-				'deb', tokens[1], tokens[2], tokens[3:],
-				trusted=trusted,
-			)
-		)
-		apt_sources.append(
-			AptSource(
-				'deb-src', tokens[1], tokens[2], tokens[3:],
-				trusted=trusted,
-			)
-		)
-	else:
-		apt_sources.append(
-			AptSource(
-				tokens[0], tokens[1], tokens[2], tokens[3:],
-				trusted=trusted,
-			)
-		)
+		return self
 
-timestamps = {}
 
-for source in apt_sources:
-	with urlopen(source.release_url) as release_file:
-		release_info = deb822.Deb822(release_file)
-		try:
-			timestamps[source] = calendar.timegm(time.strptime(
-				release_info['date'],
-				'%a, %d %b %Y %H:%M:%S %Z',
-			))
-		except (KeyError, ValueError):
-			timestamps[source] = 0
+def resolve_packages(
+	apt_sources,		# type: typing.List[AptSource]
+	fetcher,		# type: IndexFetcher
+	snapshots		# type: BinarySnapshots
+):
+	# type: (...) -> typing.Tuple[typing.Dict[str, NewestBinaries], typing.Dict[str, typing.Set[str]], typing.Set[str], typing.Dict[str, typing.Dict[str, str]]]
+	"""
+	Work out which binary and source packages are to be included.
+	Return a tuple (newest_by_arch, binary_pkgs, source_pkgs, reasons)
+	where newest_by_arch is {'amd64': NewestBinaries}, binary_pkgs is
+	{'amd64': {'libc6', ...}}, source_pkgs is {'glibc', ...} and
+	reasons is {'amd64': {'libc6': 'why it was included'}}.
+	"""
+	# Process packages.txt to get the list of source and binary packages
+	sources_from_lists = set()		# type: typing.Set[str]
+	binaries_from_lists = set()		# type: typing.Set[str]
+
+	for packages_from in args.packages_from:
+		with open(packages_from) as f:
+			for line in f:
+				if line[0] != '#':
+					toks = line.split()
+					if len(toks) > 1:
+						sources_from_lists.add(toks[0])
+						binaries_from_lists.update(toks[1:])
+
+	# remove development packages for end-user runtime
+	if not args.debug:
+		binaries_from_lists -= {x for x in binaries_from_lists if re.search('-dbg$|-dev$|-multidev$',x)}
+
+	binaries_by_arch = list_binaries(
+		apt_sources, fetcher, snapshots=snapshots)
+	newest_by_arch = {
+		arch: NewestBinaries(by_name)
+		for arch, by_name in binaries_by_arch.items()
+	}
+
+	sources_from_apt, binaries_from_apt, reasons = expand_metapackages(
+		args.architectures,
+		newest_by_arch,
+		args.metapackages,
+	)
 
-if 'SOURCE_DATE_EPOCH' in os.environ:
-	reference_timestamp = int(os.environ['SOURCE_DATE_EPOCH'])
-else:
-	reference_timestamp = max(timestamps.values())
+	if args.packages_from and args.metapackages:
+		check_consistency(binaries_from_apt, binaries_from_lists)
 
-if args.set_name is not None:
-	name = args.set_name
-else:
-	name = 'steam-runtime'
+	binary_pkgs = {}
+	source_pkgs = set(sources_from_lists)
 
-	if not args.official:
-		name = 'unofficial-' + name
+	for arch in newest_by_arch:
+		binary_pkgs[arch] = binaries_from_apt[arch] | binaries_from_lists
+		source_pkgs |= sources_from_apt
 
-	if apt_sources[0].suite == 'scout_beta':
-		name = '%s-beta' % name
-	elif apt_sources[0].suite != 'scout':
-		name = '%s-%s' % (name, apt_sources[0].suite)
+		for p in binaries_from_lists:
+			reasons[arch].setdefault(p, 'listed in --packages-from')
+
+		if args.verbose:
+			for p in sorted(binary_pkgs[arch]):
+				print("Including %s:%s: %s" % (
+					p, arch, reasons[arch].get(p, 'unknown')))
+
+	return newest_by_arch, binary_pkgs, source_pkgs, reasons
+
+
+def plan_file(
+	pool,			# type: PackagePool
+	url,			# type: str
+	checksum,		# type: Checksum
+	checksums		# type: typing.Dict[str, str]
+):
+	# type: (...) -> typing.Dict[str, typing.Any]
+	ret = {
+		'url': url,
+		'size': checksum[2],
+		'cached': pool.has(checksum),
+		'pool_path': pool.path_for(checksum),
+	}		# type: typing.Dict[str, typing.Any]
+	ret.update(checksums)
+	return ret
+
+
+def make_plan(
+	apt_sources,		# type: typing.List[AptSource]
+	fetcher,		# type: IndexFetcher
+	snapshots,		# type: BinarySnapshots
+	pool			# type: PackagePool
+):
+	# type: (...) -> typing.Dict[str, typing.Any]
+	"""
+	Resolve dependencies and describe what would be downloaded and
+	unpacked, without doing it.
+	"""
+	newest_by_arch, binary_pkgs, source_pkgs, reasons = resolve_packages(
+		apt_sources, fetcher, snapshots)
+	manifest = {}		# type: typing.Dict[typing.Tuple[str, str], Binary]
+	missing = []		# type: typing.List[str]
+	binaries = []		# type: typing.List[typing.Dict[str, typing.Any]]
+
+	for arch, arch_binaries in sorted(newest_by_arch.items()):
+		for p in sorted(binary_pkgs[arch]):
+			if p in arch_binaries:
+				manifest[(p, arch)] = arch_binaries[p]
+			else:
+				missing.append('%s:%s' % (p, arch))
+
+	symbols = {}		# type: typing.Dict[typing.Tuple[str, str], Binary]
 
 	if args.symbols:
-		name += '-sym'
+		symbols = select_symbols(
+			list_binaries(
+				apt_sources, fetcher, dbgsym=True,
+				snapshots=snapshots,
+			),
+			manifest,
+		)
+
+	selected = [
+		(key, binary, False)
+		for key, binary in sorted(manifest.items())
+	] + [
+		(key, binary, True)
+		for key, binary in sorted(symbols.items())
+	]
+
+	for (p, arch), binary, is_symbols in selected:
+		stanza = binary.stanza
+
+		if is_symbols:
+			reason = 'debug symbols for %s' % p[:-len('-dbgsym')]
+		else:
+			reason = reasons[arch].get(p, 'unknown')
+
+		entry = plan_file(
+			pool,
+			*deb_download(binary),
+			{
+				key.lower(): stanza[key]
+				for key in ('SHA256', 'MD5sum')
+				if key in stanza
+			},
+		)
+		entry.update({
+			'package': p,
+			'architecture': arch,
+			'package_architecture': binary.arch,
+			'version': binary.version,
+			'source': binary.source,
+			'source_version': binary.source_version,
+			'filename': stanza['Filename'],
+			'installed_size': int(stanza.get('Installed-Size', 0)) * 1024,
+			'reason': reason,
+		})
+		binaries.append(entry)
+
+	sources = []		# type: typing.List[typing.Dict[str, typing.Any]]
 
 	if args.source:
-		name += '-src'
+		for p, candidates in sorted(
+			list_sources(apt_sources, source_pkgs, fetcher).items()
+		):
+			for sp in candidates:
+				if sp.stanza.get('Extra-Source-Only', 'no') == 'yes':
+					continue
+
+				sha256 = {
+					f['name']: f['sha256']
+					for f in sp.stanza.get('Checksums-Sha256', [])
+				}
+				best = sp.checksums()
+				files = []
+
+				for f in sp.stanza['files']:
+					checksums = {'md5sum': f['md5sum']}
+
+					if f['name'] in sha256:
+						checksums['sha256'] = sha256[f['name']]
 
-	if args.debug:
-		name += '-debug'
+					entry = plan_file(
+						pool,
+						sp.file_url(f['name']),
+						best[f['name']],
+						checksums,
+					)
+					entry['filename'] = f['name']
+					files.append(entry)
+
+				sources.append({
+					'package': p,
+					'version': sp.stanza['Version'],
+					'files': files,
+				})
+
+	# Count each file once, even if it is an Architecture: all package
+	# that is included for more than one architecture, or the same
+	# file is available from more than one apt source
+	unique = {}		# type: typing.Dict[str, typing.Dict[str, typing.Any]]
+
+	for entry in binaries:
+		unique[entry['pool_path']] = entry
+
+	for source in sources:
+		for entry in source['files']:
+			unique[entry['pool_path']] = entry
+
+	return {
+		'apt_sources': [str(source) for source in apt_sources],
+		'architectures': args.architectures,
+		'binaries': binaries,
+		'sources': sources,
+		'missing': missing,
+		'download_size': sum(
+			e['size'] for e in unique.values() if not e['cached']),
+		'cached_size': sum(
+			e['size'] for e in unique.values() if e['cached']),
+		'installed_size': sum(
+			e.get('installed_size', 0) for e in unique.values()),
+	}
+
+
+def main():
+	global args
+	global reference_timestamp
+
+	# Create files u=rwX,go=rX by default
+	os.umask(0o022)
+
+	args = parse_args()
+	if args.verbose:
+		for property, value in sorted(vars(args).items()):
+			print("\t", property, ": ", value)
+
+	if args.gc:
+		pool = PackagePool(os.path.join(args.cache_dir, 'pool'))
+		removed, freed = pool.trim(
+			args.cache_size if args.cache_size is not None else sys.maxsize
+		)
+		print("Removed %d file(s) (%s) from package pool." % (
+			removed, format_size(freed)))
+		removed = UnpackCache(
+			os.path.join(args.cache_dir, 'unpacked'), PruneRules(),
+		).trim(pool)
+		print("Removed %d unpacked package(s) from cache." % removed)
+		sys.exit(0)
+
+	if args.dump_options:
+		# Only the Release files are needed, and --dump-options
+		# should not write to the cache directory
+		cache = None		# type: typing.Optional[IndexCache]
 	else:
-		name += '-release'
+		cache = IndexCache(os.path.join(args.cache_dir, 'indices'))
 
-if args.set_version is not None:
-	version = args.set_version
-else:
-	version = time.strftime('snapshot-%Y%m%d-%H%M%SZ', time.gmtime())
+	fetcher = IndexFetcher(cache=cache)
+
+	if args.lockfile is not None:
+		# Everything we need to know about the apt sources was
+		# recorded when the lockfile was written
+		lockfile = Lockfile.load(args.lockfile)		# type: typing.Optional[Lockfile]
+		apt_sources = lockfile.apt_sources
+		timestamps = lockfile.timestamps
+		args.architectures = lockfile.architectures
+
+		if args.symbols and lockfile.symbols is None:
+			raise SystemExit(
+				'%s does not list debug symbols' % args.lockfile)
+
+		if args.source and lockfile.sources is None:
+			raise SystemExit(
+				'%s does not list source packages' % args.lockfile)
+	else:
+		lockfile = None
+		apt_sources = [
+			AptSource('deb', args.repo, args.suite, ('main',)),
+			AptSource('deb-src', args.repo, args.suite, ('main',)),
+		]
+		seen_apt_lines = set()		# type: typing.Set[str]
+
+		for line in list(args.upstream_apt_sources) + list(args.extra_apt_sources):
+			if line in seen_apt_lines:
+				continue
 
-name_version = '%s_%s' % (name, version)
+			seen_apt_lines.add(line)
+			apt_sources.extend(parse_apt_source(line))
+
+	http_pool.race_after = args.race_after
+
+	# Mirrors are not recorded in lockfiles, so they need to be
+	# added whether the apt sources came from one or not
+	add_repo_mirrors(apt_sources, args.repo, args.mirrors)
 
-if args.dump_options:
-	dump = vars(args)
-	dump['name'] = name
-	dump['version'] = version
-	dump['name_version'] = name_version
-	dump['reference_timestamp'] = reference_timestamp
-	dump['apt_sources'] = []
 	for source in apt_sources:
-		dump['apt_sources'].append(str(source))
-	import json
-	json.dump(dump, sys.stdout, indent=4, sort_keys=True)
-	sys.stdout.write('\n')
-	sys.exit(0)
+		if len(source.mirrors) > 1:
+			http_pool.add_mirrors(source.mirrors)
+
+	if lockfile is None:
+		timestamps = {}
+
+		for source in apt_sources:
+			fetcher.submit(source.release_url, deb822.Release)
+
+		for source in apt_sources:
+			release_info = fetcher.result(source.release_url)
+			fetcher.add_release(source.release_url, release_info)
+			try:
+				timestamps[source] = calendar.timegm(time.strptime(
+					release_info['date'],
+					'%a, %d %b %Y %H:%M:%S %Z',
+				))
+			except (KeyError, ValueError):
+				timestamps[source] = 0
+
+	if 'SOURCE_DATE_EPOCH' in os.environ:
+		reference_timestamp = int(os.environ['SOURCE_DATE_EPOCH'])
+	else:
+		reference_timestamp = max(timestamps.values())
+
+	if args.set_name is not None:
+		name = args.set_name
+	else:
+		name = 'steam-runtime'
 
-tmpdir = tempfile.mkdtemp(prefix='build-runtime-')
+		if not args.official:
+			name = 'unofficial-' + name
 
-if args.output is None:
-	args.output = os.path.join(tmpdir, 'root')
+		if apt_sources[0].suite == 'scout_beta':
+			name = '%s-beta' % name
+		elif apt_sources[0].suite != 'scout':
+			name = '%s-%s' % (name, apt_sources[0].suite)
 
-# Populate runtime from template
-shutil.copytree(args.templates, args.output, symlinks=True)
+		if args.symbols:
+			name += '-sym'
 
-with open(os.path.join(args.output, 'version.txt'), 'w') as writer:
-	writer.write('%s\n' % name_version)
+		if args.source:
+			name += '-src'
 
-if args.debug_url is None:
-	if args.suite in ('scout', 'scout_beta'):
-		args.debug_url = 'https://repo.steampowered.com/steamrt-images-scout/snapshots/'
+		if args.debug:
+			name += '-debug'
+		else:
+			name += '-release'
 
-if args.debug_url:
-	# Note where people can get the debug version of this runtime
-	for base in ('README.txt', 'COPYING'):
-		with open(
-			os.path.join(args.templates, base)
-		) as reader:
-			with open(
-				os.path.join(args.output, base + '.new'), 'w'
-			) as writer:
-				for line in reader:
-					line = re.sub(
-						r'https?://repo\.steampowered\.com/PLACEHOLDER.*$',
-						args.debug_url, line)
-					writer.write(line)
-
-		os.rename(
-			os.path.join(args.output, base + '.new'),
-			os.path.join(args.output, base),
-		)
+	if args.set_version is not None:
+		version = args.set_version
+	else:
+		version = time.strftime('snapshot-%Y%m%d-%H%M%SZ', time.gmtime())
+
+	name_version = '%s_%s' % (name, version)
+
+	if args.dump_options:
+		dump = vars(args)
+		dump['name'] = name
+		dump['version'] = version
+		dump['name_version'] = name_version
+		dump['reference_timestamp'] = reference_timestamp
+		dump['apt_sources'] = []
+		for source in apt_sources:
+			dump['apt_sources'].append(str(source))
+		json.dump(dump, sys.stdout, indent=4, sort_keys=True)
+		sys.stdout.write('\n')
+		sys.exit(0)
+
+	# Download Packages and Sources files in the background while we
+	# set up the output directory
+	snapshots = BinarySnapshots(os.path.join(args.cache_dir, 'snapshots'))
+	pool = PackagePool(os.path.join(args.cache_dir, 'pool'))
+
+	if lockfile is None:
+		queue_index_downloads(fetcher, apt_sources, snapshots)
+
+	if args.plan is not None:
+		# Keep standard output for the plan itself
+		with contextlib.redirect_stdout(sys.stderr):
+			plan = make_plan(apt_sources, fetcher, snapshots, pool)
+			fetcher.shutdown()
+
+		plan['name_version'] = name_version
+		plan['reference_timestamp'] = reference_timestamp
+
+		if args.plan == '-':
+			json.dump(plan, sys.stdout, indent=4, sort_keys=True)
+			sys.stdout.write('\n')
+		else:
+			with open(args.plan, 'w') as writer:
+				json.dump(plan, writer, indent=4, sort_keys=True)
+				writer.write('\n')
 
-# Process packages.txt to get the list of source and binary packages
-sources_from_lists = set()		# type: typing.Set[str]
-binaries_from_lists = set()		# type: typing.Set[str]
+		sys.exit(0)
 
-print("Creating Steam Runtime in %s" % args.output)
+	tmpdir = tempfile.mkdtemp(prefix='build-runtime-')
 
-for packages_from in args.packages_from:
-	with open(packages_from) as f:
-		for line in f:
-			if line[0] != '#':
-				toks = line.split()
-				if len(toks) > 1:
-					sources_from_lists.add(toks[0])
-					binaries_from_lists.update(toks[1:])
+	if args.output is None:
+		args.output = os.path.join(tmpdir, 'root')
 
-# remove development packages for end-user runtime
-if not args.debug:
-	binaries_from_lists -= {x for x in binaries_from_lists if re.search('-dbg$|-dev$|-multidev$',x)}
+	# Populate runtime from template
+	shutil.copytree(args.templates, args.output, symlinks=True)
 
-# {('libfoo2', 'amd64'): Binary for libfoo2_1.2-3_amd64}
-manifest = {}		# type: typing.Dict[typing.Tuple[str, str], Binary]
+	with open(os.path.join(args.output, 'version.txt'), 'w') as writer:
+		writer.write('%s\n' % name_version)
 
-binaries_by_arch = list_binaries(apt_sources)
+	if args.debug_url is None:
+		if args.suite in ('scout', 'scout_beta'):
+			args.debug_url = 'https://repo.steampowered.com/steamrt-images-scout/snapshots/'
 
-sources_from_apt, binaries_from_apt = expand_metapackages(
-	args.architectures,
-	binaries_by_arch,
-	args.metapackages,
-)
+	if args.debug_url:
+		# Note where people can get the debug version of this runtime
+		for base in ('README.txt', 'COPYING'):
+			with open(
+				os.path.join(args.templates, base)
+			) as reader:
+				with open(
+					os.path.join(args.output, base + '.new'), 'w'
+				) as writer:
+					for line in reader:
+						line = re.sub(
+							r'https?://repo\.steampowered\.com/PLACEHOLDER.*$',
+							args.debug_url, line)
+						writer.write(line)
+
+			os.rename(
+				os.path.join(args.output, base + '.new'),
+				os.path.join(args.output, base),
+			)
 
-if args.packages_from and args.metapackages:
-	check_consistency(binaries_from_apt, binaries_from_lists)
-
-binary_pkgs = {}
-source_pkgs = set(sources_from_lists)
-
-for arch in binaries_by_arch:
-	binary_pkgs[arch] = binaries_from_apt[arch] | binaries_from_lists
-	source_pkgs |= sources_from_apt
-
-install_binaries(args.architectures, binaries_by_arch, binary_pkgs, manifest)
-
-if args.source:
-	install_sources(apt_sources, source_pkgs)
-
-if args.symbols:
-	dbgsym_by_arch = list_binaries(apt_sources, dbgsym=True)
-	install_symbols(dbgsym_by_arch, binary_pkgs, manifest)
-	fix_debuglinks()
-
-fix_symlinks()
-
-write_manifests(manifest)
-
-print("Normalizing permissions...")
-subprocess.check_call([
-	'chmod', '--changes', 'u=rwX,go=rX', '--', args.output,
-])
-
-if args.archive is not None:
-	ext = '.tar.' + args.compression
-
-	if args.compression == 'none':
-		ext = '.tar'
-		compressor_args = ['cat']
-	elif args.compression == 'xz':
-		compressor_args = ['xz', '-v']
-	elif args.compression == 'gz':
-		compressor_args = ['gzip', '-nc']
-	elif args.compression == 'bz2':
-		compressor_args = ['bzip2', '-c']
-
-	if os.path.isdir(args.archive) or args.archive.endswith('/'):
-		archive_basename = name_version		# type: typing.Optional[str]
-		archive_dir = args.archive
-		archive = os.path.join(archive_dir, archive_basename + ext)
-		make_latest_symlink = (version != 'latest')
-	elif args.archive.endswith('.*'):
-		archive_basename = os.path.basename(args.archive[:-2])
-		archive_dir = os.path.dirname(args.archive)
-		archive = os.path.join(archive_dir, archive_basename + ext)
-		make_latest_symlink = False
+	print("Creating Steam Runtime in %s" % args.output)
+
+	# {('libfoo2', 'amd64'): Binary for libfoo2_1.2-3_amd64}
+	manifest = {}		# type: typing.Dict[typing.Tuple[str, str], Binary]
+
+	if lockfile is not None:
+		newest_by_arch = {
+			arch: NewestBinaries({
+				p: [binary] for p, binary in by_name.items()
+			})
+			for arch, by_name in lockfile.binaries.items()
+		}
+		binary_pkgs = {
+			arch: set(by_name)
+			for arch, by_name in lockfile.binaries.items()
+		}
 	else:
-		archive = args.archive
-		archive_basename = None
-		archive_dir = None
-		make_latest_symlink = False
+		newest_by_arch, binary_pkgs, source_pkgs, reasons = resolve_packages(
+			apt_sources, fetcher, snapshots)
+
+	downloader = PackageDownloader(pool)
+	prune = PruneRules()
+	unpacker = PackageUnpacker(
+		args.jobs,
+		prune=prune,
+		cache=UnpackCache(os.path.join(args.cache_dir, 'unpacked'), prune),
+		link_cached=args.link_unpacked,
+	)
+	install_binaries(
+		args.architectures, newest_by_arch, binary_pkgs, manifest,
+		downloader, unpacker)
+	# {'amd64': {'libfoo2': Binary for libfoo2_1.2-3_amd64}}
+	locked_binaries = {
+		arch: {} for arch in args.architectures
+	}		# type: typing.Dict[str, typing.Dict[str, Binary]]
 
-	try:
-		os.makedirs(os.path.dirname(archive) or '.', 0o755)
-	except OSError as e:
-		if e.errno != errno.EEXIST:
-			raise
+	for (p, arch), binary in manifest.items():
+		locked_binaries[arch][p] = binary
 
-	print("Creating archive %s..." % archive)
-
-	with open(archive, 'wb') as archive_writer, subprocess.Popen(
-		compressor_args,
-		stdin=subprocess.PIPE,
-		stdout=archive_writer,
-	) as compressor, tarfile.open(
-		archive,
-		mode='w|',
-		format=tarfile.GNU_FORMAT,
-		fileobj=compressor.stdin,
-	) as archiver:
-		members = []
-
-		for dir_path, dirs, files in os.walk(
-			args.output,
-			topdown=True,
-			followlinks=False,
-		):
-			rel_dir_path = os.path.relpath(
-				dir_path, args.output)
+	source_packages = None
 
-			if rel_dir_path != '.' and not rel_dir_path.startswith('./'):
-				rel_dir_path = './' + rel_dir_path
+	if args.source:
+		if lockfile is not None:
+			source_packages = lockfile.sources
+		else:
+			source_packages = list_sources(
+				apt_sources, source_pkgs, fetcher)
 
-			for member in dirs:
-				members.append(
-					os.path.join(rel_dir_path, member))
+		assert source_packages is not None
+		install_sources(source_packages, downloader)
 
-			for member in files:
-				members.append(
-					os.path.join(rel_dir_path, member))
+	locked_symbols = None
 
-		for member in sorted(members):
-			archiver.add(
-				os.path.join(args.output, member),
-				arcname=os.path.normpath(
-					os.path.join(
-						name,
-						member,
-					)),
-				recursive=False,
-				filter=normalize_tar_entry,
-			)
+	if args.symbols:
+		if lockfile is not None:
+			assert lockfile.symbols is not None
+			dbgsym_by_arch = {
+				arch: {
+					p: [binary] for p, binary in by_name.items()
+				}
+				for arch, by_name in lockfile.symbols.items()
+			}
+		else:
+			# All of them are listed, so that the list can be saved as
+			# a snapshot, but select_symbols() only looks up the ones
+			# for packages that we have installed
+			dbgsym_by_arch = list_binaries(
+				apt_sources, fetcher, dbgsym=True, snapshots=snapshots)
+
+		locked_symbols = {
+			arch: {} for arch in args.architectures
+		}		# type: typing.Optional[typing.Dict[str, typing.Dict[str, Binary]]]
+
+		for (p, arch), binary in install_symbols(
+			dbgsym_by_arch, binary_pkgs, manifest, downloader, unpacker
+		).items():
+			locked_symbols[arch][p] = binary
+
+		fix_debuglinks()
+
+	if args.write_lockfile is not None:
+		print("Writing lockfile %s..." % args.write_lockfile)
+		Lockfile(
+			apt_sources,
+			timestamps,
+			locked_binaries,
+			symbols=locked_symbols,
+			sources=source_packages,
+			architectures=args.architectures,
+		).save(args.write_lockfile)
+
+	unpacker.shutdown()
+	downloader.shutdown()
+	fetcher.shutdown()
+	http_pool.close()
+	http_pool.report()
+
+	if args.cache_size is not None:
+		# Never delete packages that this build used
+		removed, freed = pool.trim(args.cache_size, keep_since=pool.started)
+
+		if removed:
+			print("Removed %d file(s) (%s) from package pool." % (
+				removed, format_size(freed)))
+
+		assert unpacker.cache is not None
+		removed = unpacker.cache.trim(pool)
+
+		if removed:
+			print("Removed %d unpacked package(s) from cache." % removed)
+
+	if fetcher.reused > 0:
+		print("Reused %i unchanged index file(s) from cache." % fetcher.reused)
+
+	if unpacker.reused > 0:
+		print("Reused %i unpacked package(s) from cache." % unpacker.reused)
+
+	fix_symlinks()
+
+	write_manifests(manifest)
+
+	print("Normalizing permissions...")
+	subprocess.check_call([
+		'chmod', '--changes', 'u=rwX,go=rX', '--', args.output,
+	])
 
-	print("Creating archive checksum %s.checksum..." % archive)
-	archive_md5 = hashlib.md5()
+	if args.archive is not None:
+		ext = '.tar.' + args.compression
+
+		if args.compression == 'none':
+			ext = '.tar'
+			compressor_args = ['cat']
+		elif args.compression == 'xz':
+			compressor_args = ['xz', '-v']
+		elif args.compression == 'gz':
+			compressor_args = ['gzip', '-nc']
+		elif args.compression == 'bz2':
+			compressor_args = ['bzip2', '-c']
+
+		if os.path.isdir(args.archive) or args.archive.endswith('/'):
+			archive_basename = name_version		# type: typing.Optional[str]
+			archive_dir = args.archive
+			archive = os.path.join(archive_dir, archive_basename + ext)
+			make_latest_symlink = (version != 'latest')
+		elif args.archive.endswith('.*'):
+			archive_basename = os.path.basename(args.archive[:-2])
+			archive_dir = os.path.dirname(args.archive)
+			archive = os.path.join(archive_dir, archive_basename + ext)
+			make_latest_symlink = False
+		else:
+			archive = args.archive
+			archive_basename = None
+			archive_dir = None
+			make_latest_symlink = False
 
-	with open(archive, 'rb') as archive_reader:
-		while True:
-			blob = archive_reader.read(ONE_MEGABYTE)
+		try:
+			os.makedirs(os.path.dirname(archive) or '.', 0o755)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
 
-			if not blob:
-				break
+		print("Creating archive %s..." % archive)
+
+		with open(archive, 'wb') as archive_writer, subprocess.Popen(
+			compressor_args,
+			stdin=subprocess.PIPE,
+			stdout=archive_writer,
+		) as compressor, tarfile.open(
+			archive,
+			mode='w|',
+			format=tarfile.GNU_FORMAT,
+			fileobj=compressor.stdin,
+		) as archiver:
+			members = []
+
+			for dir_path, dirs, files in os.walk(
+				args.output,
+				topdown=True,
+				followlinks=False,
+			):
+				rel_dir_path = os.path.relpath(
+					dir_path, args.output)
+
+				if rel_dir_path != '.' and not rel_dir_path.startswith('./'):
+					rel_dir_path = './' + rel_dir_path
+
+				for member in dirs:
+					members.append(
+						os.path.join(rel_dir_path, member))
+
+				for member in files:
+					members.append(
+						os.path.join(rel_dir_path, member))
+
+			for member in sorted(members):
+				archiver.add(
+					os.path.join(args.output, member),
+					arcname=os.path.normpath(
+						os.path.join(
+							name,
+							member,
+						)),
+					recursive=False,
+					filter=normalize_tar_entry,
+				)
+
+		print("Creating archive checksum %s.checksum..." % archive)
+		archive_md5 = hashlib.md5()
+
+		with open(archive, 'rb') as archive_reader:
+			while True:
+				blob = archive_reader.read(ONE_MEGABYTE)
 
-			archive_md5.update(blob)
+				if not blob:
+					break
 
-	with open(archive + '.checksum', 'w') as writer:
-		writer.write('%s  %s\n' % (
-			archive_md5.hexdigest(), os.path.basename(archive)
-		))
+				archive_md5.update(blob)
 
-	if archive_dir is not None:
-		assert archive_basename is not None
-		print("Copying manifest files to %s..." % archive_dir)
+		with open(archive + '.checksum', 'w') as writer:
+			writer.write('%s  %s\n' % (
+				archive_md5.hexdigest(), os.path.basename(archive)
+			))
 
-		with open(
-			os.path.join(
-				archive_dir,
-				archive_basename + '.sources.list'),
-			'w'
-		) as writer:
-			for apt_source in apt_sources:
-				if timestamps[apt_source] > 0:
-					writer.write(
-						time.strftime(
-							'# as of %Y-%m-%d %H:%M:%S\n',
-							time.gmtime(
-								timestamps[apt_source]
+		if archive_dir is not None:
+			assert archive_basename is not None
+			print("Copying manifest files to %s..." % archive_dir)
+
+			with open(
+				os.path.join(
+					archive_dir,
+					archive_basename + '.sources.list'),
+				'w'
+			) as writer:
+				for apt_source in apt_sources:
+					if timestamps[apt_source] > 0:
+						writer.write(
+							time.strftime(
+								'# as of %Y-%m-%d %H:%M:%S\n',
+								time.gmtime(
+									timestamps[apt_source]
+								)
 							)
 						)
-					)
 
-				writer.write('%s\n' % apt_source)
+					writer.write('%s\n' % apt_source)
 
-		shutil.copy(
-			os.path.join(args.output, 'manifest.txt'),
-			os.path.join(
-				archive_dir, archive_basename + '.manifest.txt'),
-		)
-		shutil.copy(
-			os.path.join(args.output, 'built-using.txt'),
-			os.path.join(
-				archive_dir, archive_basename + '.built-using.txt'),
-		)
-		shutil.copy(
-			os.path.join(args.output, 'manifest.deb822.gz'),
-			os.path.join(
-				archive_dir,
-				archive_basename + '.manifest.deb822.gz'),
-		)
-		if args.source:
 			shutil.copy(
+				os.path.join(args.output, 'manifest.txt'),
 				os.path.join(
-					args.output,
-					'source',
-					'sources.txt'),
-				os.path.join(
-					archive_dir,
-					archive_basename + '.sources.txt'),
+					archive_dir, archive_basename + '.manifest.txt'),
 			)
 			shutil.copy(
+				os.path.join(args.output, 'built-using.txt'),
 				os.path.join(
-					args.output,
-					'source',
-					'sources.deb822.gz'),
+					archive_dir, archive_basename + '.built-using.txt'),
+			)
+			shutil.copy(
+				os.path.join(args.output, 'manifest.deb822.gz'),
 				os.path.join(
 					archive_dir,
-					archive_basename + '.sources.deb822.gz'),
+					archive_basename + '.manifest.deb822.gz'),
 			)
+			if args.source:
+				shutil.copy(
+					os.path.join(
+						args.output,
+						'source',
+						'sources.txt'),
+					os.path.join(
+						archive_dir,
+						archive_basename + '.sources.txt'),
+				)
+				shutil.copy(
+					os.path.join(
+						args.output,
+						'source',
+						'sources.deb822.gz'),
+					os.path.join(
+						archive_dir,
+						archive_basename + '.sources.deb822.gz'),
+				)
 
-		shutil.copy(
-			os.path.join(args.output, 'version.txt'),
-			os.path.join(
-				archive_dir, archive_basename + '.version.txt'),
-		)
-
-		script = os.path.join(args.output, 'scripts', 'switch-runtime.sh')
-
-		if os.path.exists(script):
 			shutil.copy(
-				script,
-				os.path.join(archive_dir, archive_basename + '.sh'),
+				os.path.join(args.output, 'version.txt'),
+				os.path.join(
+					archive_dir, archive_basename + '.version.txt'),
 			)
 
-	if make_latest_symlink:
-		print("Creating symlink %s_latest%s..." % (name, ext))
-		symlink = os.path.join(archive_dir, name + '_latest' + ext)
-
-		try:
-			os.remove(symlink)
-		except OSError as e:
-			if e.errno != errno.ENOENT:
-				raise
-
-		try:
-			os.remove(symlink + '.checksum')
-		except OSError as e:
-			if e.errno != errno.ENOENT:
-				raise
+			script = os.path.join(args.output, 'scripts', 'switch-runtime.sh')
 
-		os.symlink(os.path.basename(archive), symlink)
-		os.symlink(
-			os.path.basename(archive) + '.checksum',
-			symlink + '.checksum')
+			if os.path.exists(script):
+				shutil.copy(
+					script,
+					os.path.join(archive_dir, archive_basename + '.sh'),
+				)
 
-	if args.split:
-		with open(archive, 'rb') as archive_reader:
-			part = 0
-			position = 0
-			part_writer = open(args.split + ext + '.part0', 'wb')
+		if make_latest_symlink:
+			print("Creating symlink %s_latest%s..." % (name, ext))
+			symlink = os.path.join(archive_dir, name + '_latest' + ext)
+
+			try:
+				os.remove(symlink)
+			except OSError as e:
+				if e.errno != errno.ENOENT:
+					raise
+
+			try:
+				os.remove(symlink + '.checksum')
+			except OSError as e:
+				if e.errno != errno.ENOENT:
+					raise
+
+			os.symlink(os.path.basename(archive), symlink)
+			os.symlink(
+				os.path.basename(archive) + '.checksum',
+				symlink + '.checksum')
+
+		if args.split:
+			with open(archive, 'rb') as archive_reader:
+				part = 0
+				position = 0
+				part_writer = open(args.split + ext + '.part0', 'wb')
+
+				while True:
+					blob = archive_reader.read(ONE_MEGABYTE)
+
+					if not blob:
+						break
 
-			while True:
-				blob = archive_reader.read(ONE_MEGABYTE)
+					if position >= SPLIT_MEGABYTES:
+						part += 1
+						position -= SPLIT_MEGABYTES
+						part_writer.close()
+						part_writer = open(
+							'%s%s.part%d' % (
+								args.split, ext, part
+							),
+							'wb')
 
-				if not blob:
-					break
+					part_writer.write(blob)
+					position += 1
 
-				if position >= SPLIT_MEGABYTES:
+				while part < MIN_PARTS - 1:
 					part += 1
-					position -= SPLIT_MEGABYTES
 					part_writer.close()
 					part_writer = open(
 						'%s%s.part%d' % (
@@ -1706,27 +6009,19 @@ if args.archive is not None:
 						),
 						'wb')
 
-				part_writer.write(blob)
-				position += 1
-
-			while part < MIN_PARTS - 1:
-				part += 1
 				part_writer.close()
-				part_writer = open(
-					'%s%s.part%d' % (
-						args.split, ext, part
-					),
-					'wb')
 
-			part_writer.close()
+			with open(args.split + '.checksum', 'w') as writer:
+				writer.write('%s  %s%s\n' % (
+					archive_md5.hexdigest(),
+					os.path.basename(args.split),
+					ext,
+				))
+
+	shutil.rmtree(tmpdir)
 
-		with open(args.split + '.checksum', 'w') as writer:
-			writer.write('%s  %s%s\n' % (
-				archive_md5.hexdigest(),
-				os.path.basename(args.split),
-				ext,
-			))
 
-shutil.rmtree(tmpdir)
+if __name__ == '__main__':
+	main()
 
 # vi: set noexpandtab:
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Copyright (C) 2019 Collabora Ltd.
+#
+# SPDX-License-Identifier: MIT
+# (see COPYING)
+
+"""
+Compare the time taken to install synthetic .deb files by running
+dpkg-deb -c, md5sum and dpkg-deb -x for each one, as build-runtime.py
+used to, with the single-pass unpack_deb() in build-runtime.py.
+
+This is not run as part of the test suite. Usage:
+
+    python3 tests/benchmarks/deb-unpack.py [--debs N] [--files N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib.util
+import io
+import os
+import random
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+
+try:
+    import typing
+except ImportError:
+    pass
+else:
+    typing      # noqa
+
+BUILD_RUNTIME = os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, 'build-runtime.py',
+)
+
+
+def load_build_runtime():
+    spec = importlib.util.spec_from_file_location(
+        'build_runtime', BUILD_RUNTIME)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)     # type: ignore
+    return module
+
+
+def synthesize(path, index, files, compression):
+    # type: (str, int, int, str) -> None
+    """
+    Write a .deb resembling a shared library package, containing the
+    given number of regular files of random sizes and a symlink to each.
+    """
+    rng = random.Random(index)
+    data = io.BytesIO()
+    libdir = './usr/lib/x86_64-linux-gnu'
+
+    def add(name, type=tarfile.REGTYPE, blob=b'', linkname=''):
+        # type: (str, bytes, bytes, str) -> None
+        member = tarfile.TarInfo(name)
+        member.type = type
+        member.mode = 0o755 if type == tarfile.DIRTYPE else 0o644
+        member.mtime = 1500000000
+        member.uname = member.gname = 'root'
+        member.linkname = linkname
+        member.size = len(blob)
+        tar.addfile(member, io.BytesIO(blob))
+
+    mode = 'w:' + compression       # type: typing.Any
+
+    with tarfile.open(
+        fileobj=data, mode=mode, format=tarfile.GNU_FORMAT,
+    ) as tar:
+        for d in ('.', './usr', './usr/lib', libdir, './usr/share',
+                  './usr/share/doc', './usr/share/doc/lib%d' % index):
+            add(d, tarfile.DIRTYPE)
+
+        for i in range(files):
+            name = 'lib%d-%d.so.1' % (index, i)
+            add(
+                '%s/%s.0' % (libdir, name),
+                blob=rng.getrandbits(8 * 4096).to_bytes(4096, 'little')
+                * rng.randrange(1, 16))
+            add(
+                '%s/%s' % (libdir, name), tarfile.SYMTYPE,
+                linkname=name + '.0')
+
+        add('./usr/share/doc/lib%d/copyright' % index, blob=b'Free\n' * 100)
+
+    with open(path, 'wb') as writer:
+        writer.write(b'!<arch>\n')
+
+        for ar_name, blob in (
+            (b'debian-binary', b'2.0\n'),
+            (b'control.tar.xz', b''),
+            (b'data.tar.' + compression.encode('ascii'), data.getvalue()),
+        ):
+            writer.write(b'%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (
+                ar_name, 1500000000, 0, 0, b'100644', len(blob)))
+            writer.write(blob)
+
+            if len(blob) % 2:
+                writer.write(b'\n')
+
+
+def measure(label, function, repeat):
+    # type: (str, typing.Callable[[str], None], int) -> float
+    best = float('inf')
+
+    for _ in range(repeat):
+        dest = tempfile.mkdtemp(prefix='deb-unpack.')
+
+        try:
+            start = time.perf_counter()
+            function(dest)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            shutil.rmtree(dest)
+
+    print('%-40s %8.3fs' % (label, best))
+    return best
+
+
+def main():
+    # type: () -> None
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debs', type=int, default=200)
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument(
+        '--compression', choices=('gz', 'xz'), default='xz')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    build_runtime = load_build_runtime()
+    tmpdir = tempfile.mkdtemp(prefix='deb-unpack.')
+
+    try:
+        debs = []
+
+        for i in range(args.debs):
+            path = os.path.join(tmpdir, 'lib%d.deb' % i)
+            synthesize(path, i, args.files, args.compression)
+            debs.append(path)
+
+        print('%d .debs, %.1f MiB' % (
+            len(debs),
+            sum(os.path.getsize(p) for p in debs) / 1024 / 1024))
+
+        def subprocesses(dest):
+            # type: (str) -> None
+            for deb in debs:
+                with open(os.path.join(dest, 'listing'), 'w') as f:
+                    subprocess.check_call(['dpkg-deb', '-c', deb], stdout=f)
+
+                subprocess.check_call(
+                    ['md5sum', deb], stdout=subprocess.DEVNULL)
+                subprocess.check_call(['dpkg-deb', '-x', deb, dest])
+
+        def single_pass(dest):
+            # type: (str) -> None
+            for deb in debs:
+                listing, md5, _ = build_runtime.unpack_deb(
+                    deb, dest, 'md5')
+
+                with open(os.path.join(dest, 'listing'), 'w') as f:
+                    f.writelines(listing)
+
+        baseline = measure(
+            'dpkg-deb -c, md5sum, dpkg-deb -x', subprocesses, args.repeat)
+        native = measure('unpack_deb()', single_pass, args.repeat)
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('Speedup: %.1fx' % (baseline / native))
+
+
+if __name__ == '__main__':
+    main()
+
+# vi: set sw=4 sts=4 et:
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Copyright (C) 2019 Collabora Ltd.
+#
+# SPDX-License-Identifier: MIT
+# (see COPYING)
+
+"""
+Compare the time taken to find the packages we need in a large
+synthetic Packages file with deb822.Packages.iter_paragraphs(), and
+with the offset-based scanner in build-runtime.py.
+
+This is not run as part of the test suite. Usage:
+
+    python3 tests/benchmarks/packages-index.py [--stanzas N] [--wanted N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib.util
+import os
+import random
+import tempfile
+import time
+
+from debian import deb822
+
+try:
+    import typing
+except ImportError:
+    pass
+else:
+    typing      # noqa
+
+BUILD_RUNTIME = os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, 'build-runtime.py',
+)
+
+
+def load_build_runtime():
+    spec = importlib.util.spec_from_file_location(
+        'build_runtime', BUILD_RUNTIME)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)     # type: ignore
+    return module
+
+
+def synthesize(writer, count):
+    # type: (typing.IO[bytes], int) -> None
+    rng = random.Random(0)
+
+    for i in range(count):
+        stanza = (
+            'Package: lib%05d-%d\n'
+            'Source: src%05d (1.%d-1)\n'
+            'Version: 1.%d-1+b1\n'
+            'Architecture: amd64\n'
+            'Maintainer: Steam Runtime Maintainers <nobody@example.com>\n'
+            'Installed-Size: %d\n'
+            'Depends: libc6 (>= 2.15), lib%05d-1 | lib%05d-2\n'
+            'Multi-Arch: same\n'
+            'Section: libs\n'
+            'Priority: optional\n'
+            'Filename: pool/main/s/src%05d/lib%05d-%d_1.%d-1+b1_amd64.deb\n'
+            'Size: %d\n'
+            'MD5sum: %032x\n'
+            'SHA256: %064x\n'
+            'Description: Synthetic library %d\n'
+            ' This package exists only to make the Packages file\n'
+            ' realistically large.\n'
+            '\n'
+        ) % (
+            i, i % 3, i, i % 7, i % 7, rng.randrange(10, 10000),
+            rng.randrange(count), rng.randrange(count),
+            i, i, i % 3, i % 7, rng.randrange(1000, 10000000),
+            rng.getrandbits(128), rng.getrandbits(256), i,
+        )
+        writer.write(stanza.encode('ascii'))
+
+
+def measure(label, function, repeat):
+    # type: (str, typing.Callable[[], int], int) -> float
+    best = float('inf')
+    found = 0
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        found = function()
+        best = min(best, time.perf_counter() - start)
+
+    print('%-40s %8.3fs  (%d stanzas)' % (label, best, found))
+    return best
+
+
+def main():
+    # type: () -> None
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stanzas', type=int, default=60000)
+    parser.add_argument('--wanted', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    build_runtime = load_build_runtime()
+    wanted = set(
+        'lib%05d-%d' % (i, i % 3)
+        for i in random.Random(1).sample(range(args.stanzas), args.wanted)
+    )
+
+    with tempfile.NamedTemporaryFile(prefix='Packages.') as f:
+        synthesize(f, args.stanzas)
+        f.flush()
+        print('%s: %d stanzas, %.1f MiB' % (
+            f.name, args.stanzas, os.path.getsize(f.name) / 1024 / 1024))
+
+        def iter_paragraphs():
+            # type: () -> int
+            with open(f.name, 'rb') as reader:
+                return sum(
+                    1 for stanza in deb822.Packages.iter_paragraphs(
+                        reader, use_apt_pkg=False)
+                    if stanza['Package'] in wanted
+                )
+
+        def scan(wanted=None):
+            # type: (typing.Optional[typing.Set[str]]) -> int
+            with open(f.name, 'rb') as reader:
+                index = build_runtime.parse_packages_index(reader)
+
+            return sum(1 for _ in index.scan(wanted))
+
+        baseline = measure(
+            'deb822.Packages.iter_paragraphs()', iter_paragraphs,
+            args.repeat)
+        everything = measure(
+            'PackagesIndex.scan()', scan, args.repeat)
+        filtered = measure(
+            'PackagesIndex.scan(wanted)', lambda: scan(wanted), args.repeat)
+
+    print('Speedup: %.1fx (all stanzas), %.1fx (prefiltered)' % (
+        baseline / everything, baseline / filtered))
+
+
+if __name__ == '__main__':
+    main()
+
+# vi: set sw=4 sts=4 et:
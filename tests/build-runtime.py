@@ -6,11 +6,26 @@
 
 from __future__ import print_function
 
+import contextlib
+import errno
+import gzip
+import hashlib
+import importlib.util
+import io
 import json
+import lzma
+import multiprocessing
 import os
+import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import pathname2url
 
 try:
     import typing
@@ -26,6 +41,172 @@ BUILD_RUNTIME = os.path.join(
 )
 
 
+def load_build_runtime():
+    """
+    Load build-runtime.py as a module, without running main().
+    """
+    spec = importlib.util.spec_from_file_location(
+        'build_runtime', BUILD_RUNTIME)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)     # type: ignore
+    return module
+
+
+class MockRepository:
+    """
+    A local HTTP server standing in for an apt repository, serving
+    in-memory files and recording the requests it receives.
+    """
+
+    def __init__(self, files, delay=0.0):
+        # type: (typing.Dict[str, bytes], float) -> None
+        self.files = files
+        self.delay = delay
+        self.requests = []      # type: typing.List[str]
+        self.ranges = []        # type: typing.List[str]
+        # {path: n}: fail the next n requests for path
+        self.failures = {}      # type: typing.Dict[str, int]
+        # {path: n}: send only the first n bytes of path, once
+        self.truncate = {}      # type: typing.Dict[str, int]
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+        repo = self
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with repo.lock:
+                    repo.requests.append(self.path)
+                    repo.active += 1
+                    repo.max_active = max(repo.max_active, repo.active)
+
+                try:
+                    time.sleep(repo.delay)
+                    blob = repo.files.get(self.path)
+
+                    if blob is None:
+                        self.send_error(404)
+                        return
+
+                    if repo.failures.get(self.path, 0) > 0:
+                        repo.failures[self.path] -= 1
+                        self.send_error(503)
+                        return
+
+                    etag = '"%s"' % hashlib.sha256(blob).hexdigest()
+
+                    if self.headers.get('If-None-Match') == etag:
+                        self.send_response(304)
+                        self.end_headers()
+                        return
+
+                    length = len(blob)
+                    start = 0
+
+                    if self.headers.get('Range'):
+                        repo.ranges.append(self.headers['Range'])
+                        start = int(
+                            self.headers['Range'][len('bytes='):-1])
+                        self.send_response(206)
+                        self.send_header(
+                            'Content-Range',
+                            'bytes %d-%d/%d' % (start, length - 1, length))
+                        blob = blob[start:]
+                    else:
+                        self.send_response(200)
+
+                    self.send_header('Content-Length', str(len(blob)))
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+
+                    if self.path in repo.truncate:
+                        self.wfile.write(blob[:repo.truncate.pop(self.path)])
+                        self.wfile.flush()
+                        self.close_connection = True
+                        return
+
+                    self.wfile.write(blob)
+                finally:
+                    with repo.lock:
+                        repo.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        # Don't wait for clients to close keep-alive connections
+        self.server.block_on_close = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    @property
+    def url(self):
+        # type: () -> str
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def close(self):
+        # type: () -> None
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+def make_deb(path, compression='.gz', members=()):
+    # type: (str, str, typing.Iterable[tarfile.TarInfo]) -> None
+    """
+    Write a .deb containing members, with made-up contents for
+    regular files.
+    """
+    data = io.BytesIO()
+    mode = {
+        '': 'w', '.gz': 'w:gz', '.xz': 'w:xz',
+    }[compression]     # type: typing.Any
+
+    with tarfile.open(
+        fileobj=data, mode=mode, format=tarfile.GNU_FORMAT,
+    ) as tar:
+        for member in members:
+            if member.isreg():
+                blob = member.name.encode('utf-8') * 3
+                member.size = len(blob)
+                tar.addfile(member, io.BytesIO(blob))
+            else:
+                tar.addfile(member)
+
+    with open(path, 'wb') as writer:
+        writer.write(b'!<arch>\n')
+
+        for name, blob in (
+            (b'debian-binary', b'2.0\n'),
+            (b'control.tar.gz', gzip.compress(b'\0' * 1024)),
+            (b'data.tar' + compression.encode('ascii'), data.getvalue()),
+        ):
+            writer.write(b'%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (
+                name, 1500000000, 0, 0, b'100644', len(blob)))
+            writer.write(blob)
+
+            if len(blob) % 2:
+                writer.write(b'\n')
+
+
+def tar_member(name, type=tarfile.REGTYPE, mode=0o644, **kwargs):
+    # type: (str, bytes, int, typing.Any) -> tarfile.TarInfo
+    member = tarfile.TarInfo(name)
+    member.type = type
+    member.mode = mode
+    member.mtime = 1500000000
+    member.uname = 'root'
+    member.gname = 'root'
+
+    for k, v in kwargs.items():
+        setattr(member, k, v)
+
+    return member
+
+
 class TestBuildRuntime(unittest.TestCase):
     def setUp(self):
         # type: () -> None
@@ -79,6 +260,1622 @@ class TestBuildRuntime(unittest.TestCase):
         pass
 
 
+class TestBinary(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.build_runtime = load_build_runtime()
+
+    def test_lazy_parsing(self):
+        packages = (
+            b'Package: libfoo1\n'
+            b'Source: foo (1.2-1)\n'
+            b'Version: 1.2-1+b1\n'
+            b'Architecture: amd64\n'
+            b'Depends: libc6 (>= 2.15), libbar2 | libbar3\n'
+            b'Description: Foo library\n'
+            b' Version: not really a field\n'
+            b'\n'
+            b'\n'
+            b'Package: foo-data\n'
+            b'Version: 1.2-1\n'
+            b'Architecture: all\n'
+        )
+        stanzas = list(
+            self.build_runtime.parse_packages_index(
+                io.BytesIO(packages)).scan())
+        self.assertEqual(
+            [s[:4] for s in stanzas],
+            [
+                ('libfoo1', 'amd64', '1.2-1+b1', 'foo (1.2-1)'),
+                ('foo-data', 'all', '1.2-1', 'foo-data'),
+            ],
+        )
+
+        binary = self.build_runtime.Binary(None, *stanzas[0])
+        self.assertEqual(binary.source, 'foo')
+        self.assertEqual(binary.source_version, '1.2-1')
+        self.assertIsNone(binary._stanza)
+        self.assertEqual(binary.dependency_names, {'libc6', 'libbar2'})
+        self.assertEqual(binary.stanza['Description'].splitlines()[0],
+                         'Foo library')
+        self.assertFalse(hasattr(binary, '__dict__'))
+
+    def test_scan_mapped(self):
+        packages = b''.join(
+            b'Package: p%d\nArchitecture: all\nVersion: %d\n\n' % (i, i)
+            for i in range(100)
+        )
+
+        with tempfile.TemporaryFile() as f:
+            f.write(packages)
+            f.seek(0)
+            index = self.build_runtime.parse_packages_index(f)
+
+        self.assertNotIsInstance(index.buf, bytes)
+        self.assertEqual(len(list(index.paragraphs())), 100)
+
+        # A stream is not read into memory either, but mapped from a
+        # temporary copy
+        stream = self.build_runtime.parse_packages_index(
+            gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(packages))))
+        self.assertNotIsInstance(stream.buf, bytes)
+        self.assertEqual(stream.buf[:], packages)
+        self.assertEqual(
+            list(index.scan({'p3', 'p42', 'missing'})),
+            [
+                ('p3', 'all', '3', 'p3',
+                 b'Package: p3\nArchitecture: all\nVersion: 3\n'),
+                ('p42', 'all', '42', 'p42',
+                 b'Package: p42\nArchitecture: all\nVersion: 42\n'),
+            ],
+        )
+
+    def test_sources_index(self):
+        sources = (
+            b'Package: foo\nVersion: 1\nDirectory: pool/main/f/foo\n'
+            b'Files:\n 0123 4 foo_1.dsc\n\n'
+            b'Package: bar\nVersion: 1\n\n'
+            b'Package: foo\nVersion: 2\nExtra-Source-Only: yes\n'
+        )
+        index = self.build_runtime.parse_sources_index(io.BytesIO(sources))
+        stanzas = list(index.stanzas({'foo'}))
+        self.assertEqual([s['Version'] for s in stanzas], ['1', '2'])
+        self.assertEqual(stanzas[0]['Files'][0]['name'], 'foo_1.dsc')
+
+    def test_version_key(self):
+        from debian.debian_support import Version
+
+        versions = [
+            '0', '00', '1.0', '1.0-0', '1.0-1', '1.0-1~bpo1', '1.0-1+b1',
+            '1.0~rc1', '1.0~~', '1.0~', '1.0a', '1.0+', '1.0.0', '1:0.9',
+            '0:1.0', '2.15-0ubuntu10.18', '2.15-0ubuntu10.18+srt1',
+            '0~8', '1.2-1+srt4', '1.2-1+srt10', '1.0-a-b', '9',
+        ]
+
+        for a in versions:
+            for b in versions:
+                self.assertEqual(
+                    self.build_runtime.version_key(a)
+                    < self.build_runtime.version_key(b),
+                    Version(a) < Version(b),
+                    '%s < %s' % (a, b),
+                )
+                self.assertEqual(
+                    self.build_runtime.version_key(a)
+                    == self.build_runtime.version_key(b),
+                    Version(a) == Version(b),
+                    '%s == %s' % (a, b),
+                )
+
+    def test_newest(self):
+        br = self.build_runtime
+        by_name = {
+            'libfoo1': [
+                br.Binary(None, 'libfoo1', 'amd64', version, 'foo', b'')
+                for version in ('1.0-1', '1.0-1+b1', '1.0~rc1-1')
+            ],
+        }
+        newest = br.NewestBinaries(by_name)
+        self.assertIn('libfoo1', newest)
+        self.assertNotIn('libbar2', newest)
+        self.assertEqual(newest['libfoo1'].version, '1.0-1+b1')
+        self.assertIs(newest['libfoo1'], newest['libfoo1'])
+        self.assertEqual(list(newest), ['libfoo1'])
+
+    def test_share_arch_all(self):
+        br = self.build_runtime
+        apt_source = br.AptSource('deb', 'https://example.com', 'scout')
+        raw = b'Package: foo-data\nArchitecture: all\nVersion: 1\n'
+        shared = {}
+        first = br.share_binary(shared, br.Binary(
+            apt_source, 'foo-data', 'all', '1', 'foo', raw))
+        self.assertIs(
+            br.share_binary(shared, br.Binary(
+                apt_source, 'foo-data', 'all', '1', 'foo', raw)),
+            first)
+
+        # Architecture-specific packages are never shared
+        raw = b'Package: libfoo1\nArchitecture: amd64\nVersion: 1\n'
+        first = br.share_binary(shared, br.Binary(
+            apt_source, 'libfoo1', 'amd64', '1', 'foo', raw))
+        self.assertIsNot(
+            br.share_binary(shared, br.Binary(
+                apt_source, 'libfoo1', 'amd64', '1', 'foo', raw)),
+            first)
+
+    def test_snapshot(self):
+        br = self.build_runtime
+        apt_sources = [
+            br.AptSource('deb', 'https://example.com', 'scout'),
+            br.AptSource('deb', 'https://example.com/overlay', 'scout'),
+        ]
+        raw = b'Package: libfoo1\nVersion: 2\nArchitecture: amd64\n'
+        by_arch = {
+            'amd64': {
+                'libfoo1': [
+                    br.Binary(
+                        apt_sources[1], 'libfoo1', 'amd64', '2',
+                        'foo (1)', raw),
+                    br.Binary(
+                        apt_sources[0], 'libfoo1', 'amd64', '1',
+                        'foo', b'Package: libfoo1\n'),
+                ],
+                'libqux2': [
+                    br.Binary(
+                        apt_sources[0], 'libqux2', 'amd64', '1', 'qux',
+                        b'Package: libqux2\nProvides: libqux-abi (= 2)\n'),
+                ],
+                'libquux1': [
+                    br.Binary(
+                        apt_sources[0], 'libquux1', 'amd64', '1', 'quux',
+                        b'Package: libquux1\nDepends: libqux-abi\n'),
+                ],
+            },
+            'i386': {},
+        }
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            snapshots = br.BinarySnapshots(tmpdir)
+            self.assertFalse(snapshots.has('0123'))
+            snapshots.save('0123', by_arch, apt_sources)
+            self.assertTrue(snapshots.has('0123'))
+            loaded = snapshots.load('0123', apt_sources)
+
+            # Virtual packages are resolved by querying the snapshot,
+            # without loading packages that do not provide them
+            installset = {'libquux1', 'libqux2'}
+            resolver = br.DependencyResolver(
+                br.NewestBinaries(loaded['amd64']), installset, set(), {})
+            self.assertTrue(resolver.resolve(['libquux1']))
+            self.assertEqual(
+                sorted(loaded['amd64']._loaded), ['libquux1', 'libqux2'])
+            binary, provided = resolver.providers('libqux-abi')[0]
+            self.assertEqual(binary.name, 'libqux2')
+            self.assertEqual(provided, ('=', '2'))
+            self.assertEqual(resolver.providers('libfoo-abi'), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(sorted(loaded), ['amd64', 'i386'])
+        self.assertEqual(
+            list(loaded['amd64']), ['libfoo1', 'libquux1', 'libqux2'])
+        self.assertEqual(len(loaded['i386']), 0)
+        self.assertNotIn('libbar2', loaded['amd64'])
+        first, second = loaded['amd64']['libfoo1']
+        self.assertIs(first.apt_source, apt_sources[1])
+        self.assertEqual(first.version, '2')
+        self.assertEqual(first.source, 'foo')
+        self.assertEqual(first.source_version, '1')
+        self.assertEqual(first.stanza['Version'], '2')
+        self.assertIs(second.apt_source, apt_sources[0])
+
+    def test_select_symbols(self):
+        br = self.build_runtime
+
+        class Unlisted(dict):
+            def __iter__(self):
+                raise AssertionError('All packages were listed')
+
+            items = keys = values = __iter__
+
+        def binary(name, version):
+            return br.Binary(
+                None, name, 'amd64', version, name,
+                ('Package: %s\n' % name).encode('utf-8'))
+
+        manifest = {
+            ('libfoo1', 'amd64'): binary('libfoo1', '2'),
+            ('libbar2', 'amd64'): binary('libbar2', '1'),
+            ('libbaz3', 'amd64'): binary('libbaz3', '1'),
+        }
+        dbgsym_by_arch = {
+            'amd64': Unlisted({
+                'libfoo1-dbgsym': [
+                    binary('libfoo1-dbgsym', '1'),
+                    binary('libfoo1-dbgsym', '2'),
+                ],
+                'libbar2-dbgsym': [binary('libbar2-dbgsym', '2')],
+                'libunused0-dbgsym': [binary('libunused0-dbgsym', '1')],
+            }),
+        }
+
+        with contextlib.redirect_stderr(io.StringIO()) as output:
+            selected = br.select_symbols(dbgsym_by_arch, manifest)
+
+        self.assertEqual(list(selected), [('libfoo1-dbgsym', 'amd64')])
+        self.assertEqual(selected[('libfoo1-dbgsym', 'amd64')].version, '2')
+        self.assertIn(
+            'libbar2-dbgsym not found at version 1', output.getvalue())
+
+    def test_lockfile(self):
+        from debian.deb822 import Sources
+
+        br = self.build_runtime
+        apt_sources = [
+            br.AptSource('deb', 'https://example.com', 'scout'),
+            br.AptSource(
+                'deb-src', 'https://example.com/overlay', 'scout',
+                trusted=True),
+        ]
+        raw = (
+            b'Package: libfoo1\nSource: foo (1)\nVersion: 2\n'
+            b'Architecture: amd64\nFilename: pool/libfoo1_2_amd64.deb\n'
+            b'SHA256: 0123\n'
+        )
+        binary = br.Binary(
+            apt_sources[0], 'libfoo1', 'amd64', '2', 'foo (1)', raw)
+        source = br.SourcePackage(apt_sources[1], Sources(
+            'Package: foo\nVersion: 1\nDirectory: pool/f/foo\n'
+            'Files:\n 4567 3 foo_1.dsc\n'))
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            path = os.path.join(tmpdir, 'lock.json')
+            br.Lockfile(
+                apt_sources,
+                {apt_sources[0]: 123, apt_sources[1]: 456},
+                {'amd64': {'libfoo1': binary}, 'i386': {}},
+                sources={'foo': [source]},
+                architectures=['i386', 'amd64'],
+            ).save(path)
+
+            with open(path) as reader:
+                data = json.load(reader)
+
+            loaded = br.Lockfile.load(path)
+
+            # Lockfiles that did not record the order of architectures
+            # can still be loaded
+            del data['architectures']
+
+            with open(path, 'w') as writer:
+                json.dump(data, writer)
+
+            unordered = br.Lockfile.load(path)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(
+            data['binaries']['amd64']['libfoo1']['sha256'], '0123')
+        self.assertEqual(
+            data['sources']['foo'][0]['urls'],
+            ['https://example.com/overlay/pool/f/foo/foo_1.dsc'])
+        self.assertEqual(
+            [str(s) for s in loaded.apt_sources],
+            [str(s) for s in apt_sources])
+        self.assertEqual(
+            sorted(loaded.timestamps.values()), [123, 456])
+        self.assertEqual(loaded.architectures, ['i386', 'amd64'])
+        self.assertEqual(unordered.architectures, ['amd64', 'i386'])
+        self.assertIsNone(loaded.symbols)
+        copy = loaded.binaries['amd64']['libfoo1']
+        self.assertIs(copy.apt_source, loaded.apt_sources[0])
+        self.assertEqual(copy.raw, raw)
+        self.assertEqual(copy.source, 'foo')
+        self.assertEqual(copy.source_version, '1')
+        sp, = loaded.sources['foo']
+        self.assertIs(sp.apt_source, loaded.apt_sources[1])
+        self.assertEqual(sp.stanza['files'][0]['name'], 'foo_1.dsc')
+
+
+class TestDependencyResolver(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.build_runtime = load_build_runtime()
+
+    def resolve(self, stanzas, installset):
+        br = self.build_runtime
+        by_name = {}
+
+        for raw in stanzas:
+            fields = dict(
+                line.split(': ', 1) for line in raw.splitlines())
+            by_name.setdefault(fields['Package'], []).append(
+                br.Binary(
+                    None, fields['Package'], 'amd64',
+                    fields.get('Version', '1'), fields['Package'],
+                    raw.encode('utf-8')))
+
+        installset = set(installset)
+        sources = set()
+        reasons = {}
+        resolver = br.DependencyResolver(
+            br.NewestBinaries(by_name), installset, sources, reasons)
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            ok = resolver.resolve(sorted(installset))
+
+        return ok, installset, reasons, output.getvalue()
+
+    def test_satisfied(self):
+        ok, installset, reasons, output = self.resolve(
+            [
+                'Package: libfoo1\n'
+                'Depends: libc6 (>= 2.15), libbar2 (>= 2) | libbaz1, '
+                'libfoo-data\n'
+                'Pre-Depends: gcc-4.6-base',
+                'Package: libbar2\nVersion: 1',
+                'Package: libbaz1\nVersion: 1',
+                'Package: libfoo-data-1.0\nProvides: libfoo-data',
+                'Package: gcc-4.6-base\nDepends: libfoo1',
+            ],
+            ['libfoo1', 'libbar2', 'libbaz1', 'libfoo-data-1.0'],
+        )
+        self.assertTrue(ok, output)
+        self.assertEqual(output, '')
+        # gcc-4.6-base is accepted as a transitive dependency, and its
+        # circular dependency on libfoo1 is fine
+        self.assertIn('gcc-4.6-base', installset)
+        self.assertEqual(reasons, {'gcc-4.6-base': 'dependency of libfoo1'})
+
+    def test_errors(self):
+        ok, installset, reasons, output = self.resolve(
+            [
+                'Package: libfoo1\nDepends: libbar2 (>= 2), libqux1',
+                'Package: libbar2\nVersion: 1',
+                'Package: libqux1\nDepends: libmissing0',
+                'Package: libmissing0-dev\nDepends: libmissing0',
+                'Package: libvirtual\nProvides: libfoo-abi (= 1)',
+                'Package: libabi\nDepends: libfoo-abi (>= 2)',
+            ],
+            ['libfoo1', 'libbar2', 'libmissing0-dev', 'libvirtual',
+             'libabi'],
+        )
+        self.assertFalse(ok)
+        self.assertEqual(installset, {
+            'libfoo1', 'libbar2', 'libmissing0-dev', 'libvirtual',
+            'libabi',
+        })
+        self.assertEqual(output.splitlines(), [
+            'ERROR: libabi depends on libfoo-abi (>= 2) '
+            'but the metapackages do not',
+            'ERROR: libfoo1 depends on libbar2 (>= 2) but libbar2 is '
+            'version 1',
+            'ERROR: libfoo1 depends on libqux1 but the metapackages do not',
+            'ERROR: Package libfoo-abi not found in Packages files',
+            'ERROR: libqux1 depends on libmissing0 but the metapackages '
+            'do not',
+            'ERROR: Package libmissing0 not found in Packages files',
+        ])
+
+
+class TestInstall(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.build_runtime = load_build_runtime()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def test_unpack_deb(self):
+        br = self.build_runtime
+        members = [
+            tar_member('.', tarfile.DIRTYPE, 0o755),
+            tar_member('./usr', tarfile.DIRTYPE, 0o755),
+            tar_member('./usr/bin', tarfile.DIRTYPE, 0o755),
+            tar_member('./usr/bin/tool', mode=0o4755),
+            tar_member(
+                './usr/bin/link', tarfile.SYMTYPE, 0o777, linkname='tool'),
+            tar_member(
+                './usr/bin/hard', tarfile.LNKTYPE, 0o4755,
+                linkname='./usr/bin/tool'),
+            # Parent directories are created if necessary; a long
+            # owner widens the column for the rest of the listing
+            tar_member(
+                './usr/share/doc/p/copyright',
+                uname='a-rather-long-user-name'),
+            tar_member('./usr/share/doc/p/odd\\name\t'),
+        ]
+        expected = [
+            'drwxr-xr-x root/root         0 2017-07-14 02:40 ./\n',
+            'drwxr-xr-x root/root         0 2017-07-14 02:40 ./usr/\n',
+            'drwxr-xr-x root/root         0 2017-07-14 02:40 ./usr/bin/\n',
+            '-rwsr-xr-x root/root        42 2017-07-14 02:40 '
+            './usr/bin/tool\n',
+            'lrwxrwxrwx root/root         0 2017-07-14 02:40 '
+            './usr/bin/link -> tool\n',
+            'hrwsr-xr-x root/root         0 2017-07-14 02:40 '
+            './usr/bin/hard link to ./usr/bin/tool\n',
+            '-rw-r--r-- a-rather-long-user-name/root 81 2017-07-14 02:40 '
+            './usr/share/doc/p/copyright\n',
+            '-rw-r--r-- root/root                    81 2017-07-14 02:40 '
+            './usr/share/doc/p/odd\\\\name\\t\n',
+        ]
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'UTC'
+        time.tzset()
+
+        try:
+            for compression in ('', '.gz', '.xz'):
+                deb = os.path.join(self.tmpdir, 'p%s.deb' % compression)
+                dest = os.path.join(self.tmpdir, 'dest' + compression)
+                make_deb(deb, compression, members)
+
+                # Files are replaced, not overwritten, so that files
+                # hard-linked from elsewhere are not altered
+                other = os.path.join(self.tmpdir, 'other')
+                os.makedirs(os.path.join(dest, 'usr', 'bin'))
+
+                with open(other, 'w') as writer:
+                    writer.write('other')
+
+                os.link(other, os.path.join(dest, 'usr', 'bin', 'tool'))
+
+                with open(deb, 'rb') as reader:
+                    md5 = hashlib.md5(reader.read()).hexdigest()
+
+                listing, digest, pruned = br.unpack_deb(deb, dest, 'md5')
+                self.assertEqual(listing, expected)
+                self.assertEqual(digest, md5)
+                self.assertEqual(pruned, 0)
+                self.assertEqual(br.unpack_deb(deb, dest)[1], None)
+
+                with open(other) as reader:
+                    self.assertEqual(reader.read(), 'other')
+
+                os.unlink(other)
+                tool = os.path.join(dest, 'usr', 'bin', 'tool')
+
+                with open(tool, 'rb') as reader:
+                    self.assertEqual(reader.read(), b'./usr/bin/tool' * 3)
+
+                self.assertEqual(os.stat(tool).st_mode & 0o7777, 0o4755)
+                self.assertEqual(os.stat(tool).st_mtime, 1500000000)
+                self.assertEqual(os.stat(dest).st_mtime, 1500000000)
+                self.assertTrue(os.path.samefile(
+                    tool, os.path.join(dest, 'usr', 'bin', 'hard')))
+                self.assertEqual(
+                    os.readlink(os.path.join(dest, 'usr', 'bin', 'link')),
+                    'tool')
+
+                if shutil.which('dpkg-deb') is not None:
+                    self.assertEqual(
+                        subprocess.check_output(
+                            ['dpkg-deb', '-c', deb]).decode('utf-8'),
+                        ''.join(expected))
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+
+            time.tzset()
+
+        deb = os.path.join(self.tmpdir, 'evil.deb')
+        make_deb(deb, '.gz', [tar_member('./../evil')])
+
+        with self.assertRaises(ValueError):
+            br.unpack_deb(deb, os.path.join(self.tmpdir, 'evil'))
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'evil')))
+
+        # Members cannot be written through a symbolic link, or
+        # hard-linked to files, outside the destination
+        outside = os.path.join(self.tmpdir, 'outside')
+        os.mkdir(outside)
+
+        with open(os.path.join(outside, 'secret'), 'w') as writer:
+            writer.write('secret')
+
+        for i, members in enumerate([
+            [
+                tar_member('./esc', tarfile.SYMTYPE, linkname=outside),
+                tar_member('./esc/planted'),
+            ],
+            [
+                tar_member('./esc', tarfile.SYMTYPE, linkname='..'),
+                tar_member('./esc/outside/planted'),
+            ],
+            [
+                tar_member(
+                    './planted', tarfile.LNKTYPE,
+                    linkname=os.path.join(outside, 'secret')),
+            ],
+            [
+                tar_member(
+                    './planted', tarfile.LNKTYPE,
+                    linkname='../outside/secret'),
+            ],
+            [
+                tar_member('./esc', tarfile.SYMTYPE, linkname=outside),
+                tar_member(
+                    './planted', tarfile.LNKTYPE, linkname='./esc/secret'),
+            ],
+        ]):
+            make_deb(deb, '.gz', members)
+            dest = os.path.join(self.tmpdir, 'escape%d' % i)
+
+            with self.assertRaises(ValueError):
+                br.unpack_deb(deb, dest)
+
+            self.assertEqual(os.listdir(outside), ['secret'])
+            self.assertFalse(
+                os.path.exists(os.path.join(dest, 'planted')))
+
+        # Compressions that we cannot decompress are left to dpkg-deb
+        with open(deb, 'rb') as reader:
+            blob = reader.read().replace(b'data.tar.gz ', b'data.tar.lz ')
+
+        with open(deb, 'wb') as writer:
+            writer.write(blob)
+
+        with self.assertRaises(br.UnsupportedPackage):
+            br.unpack_deb(deb, os.path.join(self.tmpdir, 'lz'))
+
+    def test_prune(self):
+        br = self.build_runtime
+        prune = br.PruneRules()
+
+        for path in (
+            'usr/share/man',
+            'usr/share/man/man1/foo.1.gz',
+            'usr/share/doc/examples',
+            'usr/share/doc/foo/examples/a.c',
+            'usr/share/doc/foo/bar/examples',
+            'usr/share/doc/nvidia-cg-toolkit/html/index.html',
+            'usr/share/doc/nvidia-cg-toolkit/CgUsersManual.pdf.gz',
+            'usr/share/locale/de',
+            'usr/share/locale/locale.alias',
+            'usr/share/locale/en_GB/LC_MESSAGES/foo.mo',
+        ):
+            self.assertTrue(prune(path), path)
+
+        for path in (
+            '.',
+            'usr/share',
+            'usr/share/manual',
+            'usr/share/doc/foo/copyright',
+            'usr/share/doc/foo/examples.txt',
+            'usr/share/doc/nvidia-cg-toolkit/copyright',
+            'usr/share/locale',
+            'usr/share/locale/en',
+            'usr/share/locale/en/LC_MESSAGES/foo.mo',
+            'usr/local/share/man',
+        ):
+            self.assertFalse(prune(path), path)
+
+        deb = os.path.join(self.tmpdir, 'p.deb')
+        dest = os.path.join(self.tmpdir, 'dest')
+        make_deb(deb, '.xz', [
+            tar_member('./usr/share/man', tarfile.DIRTYPE, 0o755),
+            tar_member('./usr/share/man/man1', tarfile.DIRTYPE, 0o755),
+            tar_member('./usr/share/man/man1/tool.1.gz'),
+            tar_member(
+                './usr/share/man/man1/alias.1.gz', tarfile.SYMTYPE,
+                linkname='tool.1.gz'),
+            tar_member('./usr/share/doc/p/copyright'),
+        ])
+        listing, digest, pruned = br.unpack_deb(deb, dest, prune=prune)
+        self.assertEqual(len(listing), 5)
+        self.assertEqual(pruned, len('./usr/share/man/man1/tool.1.gz') * 3)
+        self.assertEqual(os.listdir(os.path.join(dest, 'usr', 'share')),
+                         ['doc'])
+
+        # Packages that dpkg-deb unpacked are pruned afterwards
+        os.makedirs(os.path.join(dest, 'usr', 'share', 'man', 'man1'))
+
+        with open(os.path.join(
+            dest, 'usr', 'share', 'man', 'man1', 'tool.1.gz'), 'w'
+        ) as writer:
+            writer.write('manual')
+
+        self.assertEqual(br.prune_tree(dest, prune), len('manual'))
+        self.assertEqual(os.listdir(os.path.join(dest, 'usr', 'share')),
+                         ['doc'])
+
+        # A hard link to a pruned file cannot be unpacked in one pass
+        make_deb(deb, '.gz', [
+            tar_member('./usr/share/man/man1/tool.1.gz'),
+            tar_member(
+                './usr/share/doc/p/tool.1.gz', tarfile.LNKTYPE,
+                linkname='./usr/share/man/man1/tool.1.gz'),
+        ])
+
+        with self.assertRaises(br.UnsupportedPackage):
+            br.unpack_deb(deb, os.path.join(self.tmpdir, 'hard'),
+                          prune=prune)
+
+    def test_link_tree(self):
+        source = os.path.join(self.tmpdir, 'source')
+        dest = os.path.join(self.tmpdir, 'dest')
+        os.makedirs(os.path.join(source, 'usr', 'share', 'foo'))
+        os.makedirs(os.path.join(dest, 'usr', 'share', 'foo'))
+
+        with open(os.path.join(source, 'usr', 'share', 'foo', 'a'), 'w'):
+            pass
+
+        os.symlink('a', os.path.join(source, 'usr', 'share', 'foo', 'b'))
+
+        for name in ('a', 'b'):
+            with open(os.path.join(dest, 'usr', 'share', 'foo', name), 'w'):
+                pass
+
+        self.build_runtime.link_tree(source, dest)
+
+        self.assertTrue(os.path.samefile(
+            os.path.join(source, 'usr', 'share', 'foo', 'a'),
+            os.path.join(dest, 'usr', 'share', 'foo', 'a')))
+        self.assertEqual(
+            os.readlink(os.path.join(dest, 'usr', 'share', 'foo', 'b')),
+            'a')
+
+    def test_merged_tree(self):
+        br = self.build_runtime
+        top = os.path.join(self.tmpdir, 'top')
+        packages = {
+            'all': ['usr/share/doc/common/copyright'],
+            'amd64': ['usr/bin/tool', 'usr/lib/x86_64-linux-gnu/libfoo.so',
+                      'usr/share/foo/data', 'lib/ld.so', 'installed/amd64'],
+            'i386': ['usr/bin/tool', 'usr/lib/i386-linux-gnu/libfoo.so',
+                     'usr/share/foo/data', 'installed/i386'],
+        }
+
+        for package, files in packages.items():
+            for name in files:
+                path = os.path.join(self.tmpdir, package, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+                with open(path, 'w') as writer:
+                    writer.write(package)
+
+        os.symlink('data', os.path.join(
+            self.tmpdir, 'amd64', 'usr', 'share', 'foo', 'link'))
+        os.symlink('data', os.path.join(
+            self.tmpdir, 'i386', 'usr', 'share', 'foo', 'link'))
+
+        different = []     # type: typing.List[typing.Tuple[str, str]]
+        br.warn_if_different = lambda *paths: different.append(paths)
+        merged = br.MergedTree(top)
+
+        for arch in ('amd64', 'i386'):
+            merged.link(arch, os.path.join(self.tmpdir, 'all'))
+            merged.link(arch, os.path.join(self.tmpdir, arch))
+            merged.finish(arch)
+
+        # The first architecture wins, with a warning
+        self.assertEqual(different, [(
+            os.path.join(self.tmpdir, 'i386', 'usr', 'share', 'foo', 'data'),
+            os.path.join(top, 'usr', 'share', 'foo', 'data'),
+        )])
+
+        with open(os.path.join(top, 'usr', 'share', 'foo', 'data')) as reader:
+            self.assertEqual(reader.read(), 'amd64')
+
+        for arch in ('amd64', 'i386'):
+            with open(os.path.join(top, arch, 'usr', 'bin', 'tool')) as reader:
+                self.assertEqual(reader.read(), arch)
+
+            self.assertTrue(os.path.exists(
+                os.path.join(top, arch, 'installed', arch)))
+            self.assertEqual(
+                os.readlink(os.path.join(top, arch, 'usr', 'lib')),
+                '../../usr/lib')
+            self.assertEqual(
+                os.readlink(os.path.join(top, arch, 'usr', 'share')),
+                '../../usr/share')
+
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(top, 'usr', 'lib'))),
+            ['i386-linux-gnu', 'x86_64-linux-gnu'])
+        self.assertEqual(os.readlink(os.path.join(top, 'amd64', 'lib')),
+                         '../lib')
+        self.assertFalse(os.path.lexists(os.path.join(top, 'i386', 'lib')))
+        self.assertFalse(os.path.lexists(os.path.join(top, 'usr', 'bin')))
+
+    def test_package_unpacker(self):
+        br = self.build_runtime
+        br.args.verbose = False
+        # Worker processes look up install_deb() by module name
+        sys.modules[br.__name__] = br
+        self.addCleanup(sys.modules.pop, br.__name__)
+        debs = {
+            'a': [
+                tar_member('./usr', tarfile.DIRTYPE, 0o755),
+                tar_member('./usr/lib', tarfile.SYMTYPE, linkname='lib64'),
+                tar_member('./usr/share/a'),
+                tar_member('./usr/share/both'),
+            ],
+            'b': [
+                tar_member('./usr', tarfile.DIRTYPE, 0o755),
+                tar_member('./usr/lib', tarfile.DIRTYPE, 0o755),
+                tar_member('./usr/lib/b'),
+                tar_member('./usr/share/both', mode=0o755),
+            ],
+            'c': [
+                tar_member('./usr/share/both', tarfile.SYMTYPE,
+                           linkname='a'),
+            ],
+        }
+
+        for name, members in debs.items():
+            make_deb(os.path.join(self.tmpdir, name + '.deb'), '.gz',
+                     members)
+
+        def tree(top):
+            # type: (str) -> typing.Dict[str, typing.Any]
+            result = {}     # type: typing.Dict[str, typing.Any]
+
+            for dirpath, dirnames, filenames in os.walk(top):
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+
+                    if os.path.islink(path):
+                        result[path[len(top):]] = os.readlink(path)
+                    elif os.path.isdir(path):
+                        result[path[len(top):]] = None
+                    else:
+                        with open(path) as reader:
+                            result[path[len(top):]] = (
+                                reader.read(),
+                                os.stat(path).st_mode,
+                            )
+
+            return result
+
+        # The reference result: unpack one at a time into the same place
+        sequential = os.path.join(self.tmpdir, 'sequential')
+
+        for name in sorted(debs):
+            br.install_deb(
+                name, os.path.join(self.tmpdir, name + '.deb'), sequential)
+
+        for unpacker in (
+            br.PackageUnpacker(1),
+            br.PackageUnpacker(
+                3, mp_context=multiprocessing.get_context('fork')),
+        ):
+            staging = tempfile.mkdtemp(dir=self.tmpdir)
+            merged = tempfile.mkdtemp(dir=self.tmpdir)
+            futures = {
+                name: unpacker.unpack(
+                    name, os.path.join(self.tmpdir, name + '.deb'),
+                    os.path.join(staging, name))
+                for name in sorted(debs)
+            }
+
+            for name in sorted(debs):
+                directory, pruned = futures[name].result()
+                self.assertEqual(directory, os.path.join(staging, name))
+                br.link_tree(directory, merged)
+
+            unpacker.shutdown()
+            self.assertEqual(tree(merged), tree(sequential))
+
+        self.assertEqual(tree(merged)['/usr/share/both'], 'a')
+        self.assertIsNone(tree(merged)['/usr/lib'])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(merged, 'installed'))),
+            ['a', 'a.md5', 'b', 'b.md5', 'c', 'c.md5'])
+
+        # Symlinks are replaced by directories unless told otherwise
+        dest = os.path.join(self.tmpdir, 'dest')
+        elsewhere = os.path.join(self.tmpdir, 'elsewhere')
+        os.makedirs(os.path.join(elsewhere, 'installed'))
+        os.makedirs(dest)
+
+        for name in ('installed', 'usr'):
+            os.symlink(
+                os.path.join(elsewhere, name), os.path.join(dest, name))
+
+        br.link_tree(
+            os.path.join(staging, 'a'), dest, follow_symlinks={'installed'})
+        self.assertTrue(os.path.islink(os.path.join(dest, 'installed')))
+        self.assertTrue(
+            os.path.exists(os.path.join(elsewhere, 'installed', 'a')))
+        self.assertFalse(os.path.islink(os.path.join(dest, 'usr')))
+
+    def test_unpack_cache(self):
+        br = self.build_runtime
+        br.args.verbose = False
+        deb = os.path.join(self.tmpdir, 'p.deb')
+        make_deb(deb, '.gz', [
+            tar_member('./usr/lib/libp.so.0'),
+            tar_member('./usr/share/man/man1/p.1.gz'),
+        ])
+
+        with open(deb, 'rb') as reader:
+            checksum = ('sha256', hashlib.sha256(reader.read()).hexdigest(),
+                        os.path.getsize(deb))
+
+        pool = br.PackagePool(os.path.join(self.tmpdir, 'pool'))
+        os.makedirs(os.path.dirname(pool.path_for(checksum)))
+        shutil.copyfile(deb, pool.path_for(checksum))
+        prune = br.PruneRules()
+        cache = br.UnpackCache(os.path.join(self.tmpdir, 'cache'), prune)
+        unpacker = br.PackageUnpacker(1, prune=prune, cache=cache)
+
+        directory, pruned = unpacker.unpack(
+            'p_1_amd64', deb, os.path.join(self.tmpdir, 'staging'),
+            checksum=checksum).result()
+        self.assertEqual(directory, cache.path_for(checksum, 'p_1_amd64'))
+        self.assertGreater(pruned, 0)
+        self.assertEqual(unpacker.reused, 0)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmpdir, 'staging')))
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(directory, 'installed'))),
+            ['p_1_amd64', 'p_1_amd64.md5'])
+
+        # Files are cloned or copied out of the cache, so that modifying
+        # the output cannot alter it, unless hard-links are requested
+        self.assertIs(unpacker.link_file, br.reflink_or_copy)
+        self.assertIs(
+            br.PackageUnpacker(1, cache=cache, link_cached=True).link_file,
+            br.hard_link_or_copy)
+        self.assertIs(br.PackageUnpacker(1).link_file, br.hard_link_or_copy)
+        output = os.path.join(self.tmpdir, 'output')
+        br.MergedTree(output, unpacker.link_file).link('amd64', directory)
+        library = os.path.join(output, 'usr', 'lib', 'libp.so.0')
+        self.assertFalse(os.path.samefile(
+            library, os.path.join(directory, 'usr', 'lib', 'libp.so.0')))
+
+        with open(library, 'r+b') as writer:
+            writer.write(b'modified')
+
+        with open(
+            os.path.join(directory, 'usr', 'lib', 'libp.so.0'), 'rb'
+        ) as reader:
+            self.assertEqual(reader.read(), b'./usr/lib/libp.so.0' * 3)
+
+        # The second time, the package is not unpacked at all
+        os.unlink(deb)
+        self.assertEqual(
+            unpacker.unpack(
+                'p_1_amd64', deb, os.path.join(self.tmpdir, 'staging'),
+                checksum=checksum).result(),
+            (directory, 0))
+        self.assertEqual(unpacker.reused, 1)
+
+        # Packages without a SHA256 are not cached
+        self.assertIsNone(cache.path_for(('md5', '00', 0), 'p_1_amd64'))
+
+        # Rules that prune differently need a different cache
+        self.assertNotEqual(
+            br.UnpackCache(cache.path, br.PruneRules(['usr/lib'])).path_for(
+                checksum, 'p_1_amd64'),
+            directory)
+
+        self.assertEqual(cache.trim(pool), 0)
+        self.assertTrue(os.path.isdir(directory))
+        pool.trim(0)
+        self.assertEqual(cache.trim(pool), 1)
+        self.assertFalse(os.path.exists(directory))
+
+    def test_package_downloader(self):
+        self.build_runtime.args.verbose = False
+        files = {
+            '/pool/a.deb': b'a',
+            '/pool/b.deb': b'bbb',
+            '/pool/c.deb': b'cc',
+            '/overlay/a.deb': b'a',
+            '/pool/d.deb': b'dddd',
+        }
+        checksums = {
+            path: ('sha256', hashlib.sha256(blob).hexdigest(), len(blob))
+            for path, blob in files.items()
+        }
+        repo = MockRepository(files)
+        pool = self.build_runtime.PackagePool(
+            os.path.join(self.tmpdir, 'pool'))
+        os.makedirs(os.path.dirname(
+            pool.path_for(checksums['/pool/d.deb'])))
+
+        with open(pool.path_for(checksums['/pool/d.deb']), 'wb') as writer:
+            writer.write(b'dddd')
+
+        try:
+            downloader = self.build_runtime.PackageDownloader(
+                pool, max_per_host=1, max_workers=1)
+            downloader.download([
+                (repo.url + path, checksums[path])
+                for path in ('/pool/a.deb', '/pool/b.deb', '/pool/c.deb',
+                             '/pool/d.deb')
+            ])
+            # Same content as /pool/a.deb, so not downloaded again
+            downloader.download([
+                (repo.url + '/overlay/a.deb', checksums['/overlay/a.deb']),
+            ])
+
+            for name in ('a', 'b', 'c'):
+                self.assertTrue(downloader.result(
+                    checksums['/pool/%s.deb' % name]))
+
+            self.assertFalse(downloader.result(checksums['/pool/d.deb']))
+            downloader.shutdown()
+        finally:
+            repo.close()
+
+        self.assertEqual(
+            repo.requests, ['/pool/b.deb', '/pool/c.deb', '/pool/a.deb'])
+
+        with open(pool.path_for(checksums['/pool/b.deb']), 'rb') as reader:
+            self.assertEqual(reader.read(), b'bbb')
+
+    def test_download_verification(self):
+        self.build_runtime.args.verbose = False
+        repo = MockRepository({
+            '/pool/good.deb': b'good',
+            '/pool/bad.deb': b'corrupted',
+        })
+        pool = self.build_runtime.PackagePool(
+            os.path.join(self.tmpdir, 'pool'))
+        good = ('md5', hashlib.md5(b'good').hexdigest(), 4)
+        bad = ('sha256', hashlib.sha256(b'bad').hexdigest(), 3)
+
+        try:
+            downloader = self.build_runtime.PackageDownloader(pool)
+            downloader.download([
+                (repo.url + '/pool/good.deb', good),
+                (repo.url + '/pool/bad.deb', bad),
+            ])
+            self.assertTrue(downloader.result(good))
+
+            with contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(ValueError):
+                    downloader.result(bad)
+
+            downloader.shutdown()
+        finally:
+            repo.close()
+
+        self.assertTrue(pool.has(good))
+        self.assertFalse(pool.has(bad))
+        self.assertFalse(os.path.exists(pool.path_for(bad) + '.part'))
+
+    def test_resume_download(self):
+        br = self.build_runtime
+        br.args.verbose = False
+        br.DOWNLOAD_BACKOFF = 0
+        blob = bytes(range(256)) * 1000
+        checksum = ('sha256', hashlib.sha256(blob).hexdigest(), len(blob))
+        repo = MockRepository({
+            '/pool/big.deb': blob,
+            '/pool/flaky.deb': blob,
+            '/pool/gone.deb': blob,
+        })
+        repo.truncate['/pool/big.deb'] = 1000
+        repo.failures['/pool/flaky.deb'] = 2
+        repo.failures['/pool/gone.deb'] = 100
+
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                # Interrupted after 1000 bytes, then resumed
+                path = os.path.join(self.tmpdir, 'big.deb')
+                self.assertTrue(br.download_file(
+                    repo.url + '/pool/big.deb', path, checksum))
+
+                # A partial file left by an earlier run is resumed
+                path = os.path.join(self.tmpdir, 'flaky.deb')
+
+                with open(path + '.part', 'wb') as writer:
+                    writer.write(blob[:5000])
+
+                self.assertTrue(br.download_file(
+                    repo.url + '/pool/flaky.deb', path, checksum))
+
+                with self.assertRaises(Exception):
+                    br.download_file(
+                        repo.url + '/pool/gone.deb',
+                        os.path.join(self.tmpdir, 'gone.deb'),
+                        checksum)
+        finally:
+            repo.close()
+
+        for name in ('big.deb', 'flaky.deb'):
+            with open(os.path.join(self.tmpdir, name), 'rb') as reader:
+                self.assertEqual(reader.read(), blob)
+
+            self.assertFalse(
+                os.path.exists(os.path.join(self.tmpdir, name + '.part')))
+
+        self.assertEqual(repo.ranges, ['bytes=1000-', 'bytes=5000-'])
+        self.assertEqual(
+            repo.requests.count('/pool/gone.deb'), br.DOWNLOAD_RETRIES + 1)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, 'gone.deb.part')))
+
+    def test_transient_errors(self):
+        import http.client
+        import socket
+        from urllib.error import HTTPError, URLError
+
+        br = self.build_runtime
+        br.args.verbose = False
+        br.DOWNLOAD_BACKOFF = 0
+
+        for e in (
+            HTTPError('http://a', 503, 'Unavailable', {}, None),
+            URLError(socket.timeout('timed out')),
+            URLError(http.client.RemoteDisconnected('closed')),
+            ConnectionResetError(),
+            http.client.IncompleteRead(b'', 10),
+        ):
+            self.assertTrue(br.is_transient_error(e), e)
+
+        for e in (
+            HTTPError('http://a', 404, 'Not Found', {}, None),
+            URLError(socket.gaierror(-2, 'Name or service not known')),
+            URLError(ConnectionRefusedError()),
+            FileNotFoundError(),
+            OSError(errno.ENOSPC, 'No space left on device'),
+        ):
+            self.assertFalse(br.is_transient_error(e), e)
+
+        # ... but another mirror is tried if one cannot be reached
+        self.assertTrue(
+            br.is_mirror_failure(URLError(ConnectionRefusedError())))
+        self.assertFalse(br.is_mirror_failure(
+            HTTPError('http://a', 404, 'Not Found', {}, None)))
+
+        # A wrong --repo fails immediately instead of being retried
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            port = listener.getsockname()[1]
+
+        with contextlib.redirect_stderr(io.StringIO()) as output:
+            with self.assertRaises(URLError):
+                br.download_file(
+                    'http://127.0.0.1:%d/pool/p.deb' % port,
+                    os.path.join(self.tmpdir, 'p.deb'))
+
+        self.assertNotIn('Retrying', output.getvalue())
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmpdir, 'p.deb.part')))
+
+    def test_local_mirror(self):
+        br = self.build_runtime
+        br.args.verbose = False
+        mirror = os.path.join(self.tmpdir, 'mirror')
+        index = os.path.join(mirror, 'dists', 'scout', 'Packages')
+        deb = os.path.join(mirror, 'pool', 'p.deb')
+        os.makedirs(os.path.dirname(index))
+        os.makedirs(os.path.dirname(deb))
+
+        with open(index, 'wb') as writer:
+            writer.write(b'Package: p\nVersion: 1\nArchitecture: all\n')
+
+        with open(deb, 'wb') as writer:
+            writer.write(b'deb')
+
+        url = 'file://' + pathname2url(mirror)
+        self.assertEqual(br.local_path(url), mirror)
+        self.assertIsNone(br.local_path('http://localhost' + mirror))
+
+        # The index is used in-place, even without a cache
+        fetcher = br.IndexFetcher()
+        fetcher.submit(
+            url + '/dists/scout/Packages', br.parse_packages_index, '.gz')
+        packages = fetcher.result(url + '/dists/scout/Packages')
+        fetcher.shutdown()
+        self.assertNotIsInstance(packages.buf, bytes)
+        self.assertEqual([s[0] for s in packages.scan()], ['p'])
+
+        # If the Release file lists it, it is verified first
+        with open(index, 'rb') as reader:
+            blob = reader.read()
+
+        fetcher = br.IndexFetcher()
+        fetcher.checksums[url + '/dists/scout/Packages'] = (
+            'sha256', hashlib.sha256(blob).hexdigest(), len(blob))
+        fetcher.submit(
+            url + '/dists/scout/Packages', br.parse_packages_index, '.gz')
+        packages = fetcher.result(url + '/dists/scout/Packages')
+        fetcher.shutdown()
+        self.assertEqual([s[0] for s in packages.scan()], ['p'])
+
+        fetcher = br.IndexFetcher()
+        fetcher.checksums[url + '/dists/scout/Packages'] = (
+            'sha256', hashlib.sha256(blob.upper()).hexdigest(), len(blob))
+        fetcher.submit(
+            url + '/dists/scout/Packages', br.parse_packages_index, '.gz')
+
+        with self.assertRaises(ValueError):
+            fetcher.result(url + '/dists/scout/Packages')
+
+        fetcher.shutdown()
+
+        # Packages are cloned or copied rather than hard-linked, so
+        # that changing the mirror does not change them, and verified
+        good = ('sha256', hashlib.sha256(b'deb').hexdigest(), 3)
+        bad = ('sha256', hashlib.sha256(b'bad').hexdigest(), 3)
+        path = os.path.join(self.tmpdir, 'p.deb')
+        self.assertTrue(
+            br.download_file(url + '/pool/p.deb', path, good))
+        self.assertFalse(os.path.samefile(path, deb))
+        self.assertFalse(
+            br.download_file(url + '/pool/p.deb', path, good))
+
+        with open(deb, 'r+b') as writer:
+            writer.write(b'new')
+
+        with open(path, 'rb') as reader:
+            self.assertEqual(reader.read(), b'deb')
+
+        with self.assertRaises(ValueError):
+            br.download_file(
+                url + '/pool/p.deb', os.path.join(self.tmpdir, 'q'), bad)
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'q')))
+
+    def test_package_pool(self):
+        pool = self.build_runtime.PackagePool(
+            os.path.join(self.tmpdir, 'pool'))
+        checksums = []
+
+        for i, blob in enumerate((b'old', b'older', b'new', b'newer')):
+            checksum = ('sha256', hashlib.sha256(blob).hexdigest(), len(blob))
+            path = pool.path_for(checksum)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, 'wb') as writer:
+                writer.write(blob)
+
+            checksums.append(checksum)
+
+        with open(pool.path_for(checksums[0]) + '.part', 'wb') as writer:
+            writer.write(b'partial')
+
+        # Pretend that the first two were last used one and two days ago
+        for days, checksum in enumerate(checksums[:2], start=1):
+            os.utime(
+                pool.path_for(checksum),
+                (time.time() - days * 86400, time.time()))
+
+        with self.assertRaises(ValueError):
+            pool.path_for(('sha256', '../../etc/passwd', 0))
+
+        self.assertEqual(pool.trim(100), (1, 7))
+        self.assertTrue(all(pool.has(c) for c in checksums))
+
+        # 'older' is removed first, then 'old'; the others have been
+        # used since pool was created, so they are kept even though
+        # that leaves the pool larger than requested
+        self.assertEqual(pool.trim(12, keep_since=pool.started), (1, 5))
+        self.assertEqual(
+            [pool.has(c) for c in checksums], [True, False, True, True])
+        self.assertEqual(pool.trim(0, keep_since=pool.started), (1, 3))
+        self.assertEqual(
+            [pool.has(c) for c in checksums], [False, False, True, True])
+
+    def test_plan(self):
+        packages = (
+            b'Package: steamrt-libs\nVersion: 1\nArchitecture: amd64\n'
+            b'Depends: libfoo1\nFilename: pool/steamrt-libs_1_amd64.deb\n'
+            b'Size: 100\nInstalled-Size: 1\nSHA256: aaaa\n\n'
+            b'Package: libfoo1\nVersion: 2\nArchitecture: amd64\n'
+            b'Filename: pool/libfoo1_2_amd64.deb\n'
+            b'Size: 200\nInstalled-Size: 3\nSHA256: bbbb\n'
+        )
+        repo = MockRepository({
+            '/dists/scout/Release': b'Date: Thu, 01 Jan 2015 00:00:00 UTC\n',
+            '/dists/scout/main/binary-amd64/Packages.gz': (
+                gzip.compress(packages)
+            ),
+        })
+        cached = os.path.join(
+            self.tmpdir, 'cache', 'pool', 'sha256', 'bb', 'bbbb')
+        os.makedirs(os.path.dirname(cached))
+
+        with open(cached, 'wb') as writer:
+            writer.write(b'x' * 200)
+
+        try:
+            j = subprocess.check_output([
+                BUILD_RUNTIME,
+                '--repo', repo.url,
+                '--arch', 'amd64',
+                '--metapackage', 'steamrt-libs',
+                '--cache-dir', os.path.join(self.tmpdir, 'cache'),
+                '--plan', '-',
+            ]).decode('utf-8')
+        finally:
+            repo.close()
+
+        plan = json.loads(j)
+        self.assertEqual(
+            [(b['package'], b['version'], b['sha256'], b['cached'])
+             for b in plan['binaries']],
+            [
+                ('libfoo1', '2', 'bbbb', True),
+                ('steamrt-libs', '1', 'aaaa', False),
+            ],
+        )
+        self.assertEqual(
+            plan['binaries'][0]['reason'], 'dependency of steamrt-libs')
+        self.assertEqual(plan['download_size'], 100)
+        self.assertEqual(plan['cached_size'], 200)
+        self.assertEqual(plan['installed_size'], 4096)
+
+    def tearDown(self):
+        # type: () -> None
+        shutil.rmtree(self.tmpdir)
+
+
+class TestIndexFetcher(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.build_runtime = load_build_runtime()
+        self.build_runtime.args.verbose = False
+        self.tmpdir = tempfile.mkdtemp()
+
+    def test_concurrent_fetch(self):
+        files = {}
+        for i in range(8):
+            files['/dists/scout/main/binary-%d/Packages.gz' % i] = (
+                gzip.compress(
+                    b'Package: p%d\nVersion: 1\nArchitecture: all\n' % i
+                )
+            )
+
+        repo = MockRepository(files, delay=0.2)
+
+        try:
+            fetcher = self.build_runtime.IndexFetcher(max_per_host=2)
+            urls = [repo.url + path[:-len('.gz')] for path in sorted(files)]
+
+            for url in urls:
+                fetcher.submit(
+                    url, self.build_runtime.parse_packages_index, '.gz')
+
+            for i, url in enumerate(urls):
+                stanzas = fetcher.result(url).scan()
+                self.assertEqual(
+                    [s[0] for s in stanzas], ['p%d' % i])
+
+            fetcher.shutdown()
+        finally:
+            repo.close()
+
+        self.assertEqual(len(repo.requests), len(files))
+        self.assertGreater(repo.max_active, 1)
+        self.assertLessEqual(repo.max_active, 2)
+
+    def test_connection_pool(self):
+        from urllib.error import HTTPError
+
+        repo = MockRepository({
+            '/a': b'a',
+            '/b': b'b' * 1000,
+        })
+
+        try:
+            pool = self.build_runtime.ConnectionPool()
+
+            for path in ('/a', '/b', '/a'):
+                with pool.urlopen(repo.url + path) as response:
+                    self.assertEqual(
+                        len(response.read()), len(repo.files[path]))
+
+            with self.assertRaises(HTTPError) as raised:
+                pool.urlopen(repo.url + '/missing')
+
+            self.assertEqual(raised.exception.code, 404)
+            # http.server closes the connection after an error, so
+            # the next request needs a new connection
+
+            # A response that was not read completely cannot be
+            # followed by another request on the same connection
+            with pool.urlopen(repo.url + '/b') as response:
+                response.read(1)
+
+            with pool.urlopen(repo.url + '/a') as response:
+                self.assertEqual(response.read(), b'a')
+
+            pool.close()
+        finally:
+            repo.close()
+
+        host = repo.url[len('http://'):]
+        self.assertEqual(pool.stats, {host: [6, 3]})
+
+    def test_mirrors(self):
+        from urllib.error import HTTPError
+
+        br = self.build_runtime
+        sources = br.parse_apt_source('both http://a|http://b/ scout main')
+        self.assertEqual([s.url for s in sources], ['http://a'] * 2)
+        self.assertEqual(sources[0].mirrors, ['http://a', 'http://b'])
+        self.assertEqual(
+            sources[0].release_url, 'http://a/dists/scout/Release')
+
+        # --mirror applies to --repo however it is spelled
+        sources = [
+            br.AptSource('deb', 'http://a/', 'scout'),
+            br.AptSource('deb', 'http://c', 'scout'),
+        ]
+        self.assertEqual(sources[0].url, 'http://a')
+        br.add_repo_mirrors(sources, 'http://a/', ['http://b/'])
+        self.assertEqual(sources[0].mirrors, ['http://a', 'http://b'])
+        self.assertEqual(sources[1].mirrors, ['http://c'])
+
+        files = {'/a': b'a'}
+        down = MockRepository(files)
+        down.failures['/a'] = 100
+        slow = MockRepository(files, delay=0.2)
+        fast = MockRepository(files)
+
+        try:
+            pool = br.ConnectionPool()
+            group = pool.add_mirrors([down.url, slow.url, fast.url])
+            self.assertIs(pool.add_mirrors([down.url, fast.url]), group)
+            self.assertEqual(pool.mirror_count(down.url + '/a'), 3)
+            self.assertEqual(pool.mirror_count(slow.url + '/a'), 1)
+
+            for i in range(6):
+                with pool.urlopen(down.url + '/a') as response:
+                    self.assertEqual(response.read(), b'a')
+
+            # Not found is an answer, not a reason to fail over
+            with self.assertRaises(HTTPError) as raised:
+                pool.urlopen(down.url + '/missing')
+
+            self.assertEqual(raised.exception.code, 404)
+            pool.close()
+        finally:
+            down.close()
+            slow.close()
+            fast.close()
+
+        # The first mirror is tried first, fails and is avoided; the
+        # others are each tried once, then the faster one is used
+        self.assertEqual(
+            [(m.requests, m.failures) for m in group.mirrors],
+            [(1, 1), (1, 0), (6, 0)])
+        self.assertEqual(down.requests, ['/a'])
+        self.assertEqual(slow.requests, ['/a'])
+        self.assertEqual(fast.requests, ['/a'] * 5 + ['/missing'])
+        self.assertLess(group.mirrors[2].latency, group.mirrors[1].latency)
+
+    def test_mirror_race(self):
+        files = {'/a': b'a' * 1000}
+        slow = MockRepository(files, delay=2)
+        fast = MockRepository(files)
+
+        try:
+            pool = self.build_runtime.ConnectionPool()
+            pool.race_after = 0.1
+            pool.add_mirrors([slow.url, fast.url])
+            start = time.monotonic()
+
+            with pool.urlopen(slow.url + '/a') as response:
+                self.assertEqual(response.read(), files['/a'])
+
+            self.assertLess(time.monotonic() - start, 1)
+            pool.close()
+        finally:
+            slow.close()
+            fast.close()
+
+        # The request was sent to both, and the fast mirror won
+        self.assertEqual(slow.requests, ['/a'])
+        self.assertEqual(fast.requests, ['/a'])
+
+    def test_fetch_error(self):
+        repo = MockRepository({})
+
+        try:
+            fetcher = self.build_runtime.IndexFetcher()
+            url = repo.url + '/dists/scout/Release'
+            fetcher.submit(url, lambda reader: reader.read())
+
+            with self.assertRaises(Exception):
+                fetcher.result(url)
+
+            fetcher.shutdown()
+        finally:
+            repo.close()
+
+    def test_cache(self):
+        from debian.deb822 import Release
+
+        uncompressed = b'Package: libfoo1\nVersion: 1\nArchitecture: all\n'
+        packages = gzip.compress(uncompressed)
+        packages_path = '/dists/scout/main/binary-amd64/Packages.gz'
+        release = Release(
+            'SHA256:\n %s %d main/binary-amd64/Packages.gz\n' % (
+                hashlib.sha256(packages).hexdigest(), len(packages)))
+        repo = MockRepository({
+            '/dists/scout/Release': release.dump().encode('utf-8'),
+            packages_path: packages,
+        })
+        release_url = repo.url + '/dists/scout/Release'
+        packages_url = repo.url + '/dists/scout/main/binary-amd64/Packages'
+        cache_dir = os.path.join(self.tmpdir, 'indices')
+
+        try:
+            for _ in range(2):
+                fetcher = self.build_runtime.IndexFetcher(
+                    cache=self.build_runtime.IndexCache(cache_dir))
+                fetcher.add_release(release_url, release)
+
+                for url in (release_url, packages_url):
+                    fetcher.submit(url, lambda reader: reader.read())
+
+                self.assertEqual(
+                    fetcher.result(release_url),
+                    repo.files['/dists/scout/Release'],
+                )
+                self.assertEqual(fetcher.result(packages_url), uncompressed)
+                fetcher.shutdown()
+        finally:
+            repo.close()
+
+        # The Release file was revalidated, but the Packages file was
+        # not downloaded a second time because its checksum matched
+        self.assertEqual(
+            sorted(repo.requests),
+            sorted([
+                '/dists/scout/Release',
+                packages_path,
+                '/dists/scout/Release',
+            ]),
+        )
+        self.assertEqual(fetcher.reused, 2)
+
+        # The cache directory is only created when something is cached
+        self.build_runtime.IndexCache(os.path.join(self.tmpdir, 'unused'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'unused')))
+
+    def test_by_hash_and_pdiff(self):
+        from debian.deb822 import Release
+
+        old = b'Package: libfoo1\nVersion: 1\n\nPackage: libbar1\nVersion: 1\n'
+        new = b'Package: libfoo1\nVersion: 2\n\nPackage: libbar1\nVersion: 1\n'
+        patch = b'2c\nVersion: 2\n.\n'
+
+        def sha256(blob):
+            return hashlib.sha256(blob).hexdigest()
+
+        def make_release(content, diff_index=None):
+            xz = lzma.compress(content)
+            gz = gzip.compress(content)
+            files = {
+                '/dists/scout/main/binary-amd64/by-hash/SHA256/'
+                + sha256(blob): blob
+                for blob in (gz, xz)
+            }
+            lines = [
+                ' %s %d main/binary-amd64/Packages.gz' % (
+                    sha256(gz), len(gz)),
+                ' %s %d main/binary-amd64/Packages.xz' % (
+                    sha256(xz), len(xz)),
+            ]
+
+            if diff_index is not None:
+                files['/dists/scout/main/binary-amd64/Packages.diff/Index'] = (
+                    diff_index)
+                files[
+                    '/dists/scout/main/binary-amd64/Packages.diff/'
+                    'T-1.gz'
+                ] = gzip.compress(patch)
+                lines.append(' %s %d main/binary-amd64/Packages.diff/Index' % (
+                    sha256(diff_index), len(diff_index)))
+
+            release = Release(
+                'Acquire-By-Hash: yes\nSHA256:\n' + '\n'.join(lines) + '\n')
+            files['/dists/scout/Release'] = release.dump().encode('utf-8')
+            return release, files
+
+        diff_index = (
+            'SHA256-Current: %s %d\n'
+            'SHA256-History:\n %s %d T-1\n'
+            'SHA256-Patches:\n %s %d T-1\n'
+            'X-Patch-Precedence: merged\n' % (
+                sha256(new), len(new),
+                sha256(old), len(old),
+                sha256(patch), len(patch),
+            )
+        ).encode('utf-8')
+
+        packages_url_path = '/dists/scout/main/binary-amd64/Packages'
+        requests = []
+        repo = MockRepository({})
+
+        try:
+            for content, index in ((old, None), (new, diff_index)):
+                release, repo.files = make_release(content, index)
+                repo.requests = []
+                fetcher = self.build_runtime.IndexFetcher(
+                    cache=self.build_runtime.IndexCache(self.tmpdir))
+                fetcher.add_release(repo.url + '/dists/scout/Release', release)
+                fetcher.submit(
+                    repo.url + packages_url_path,
+                    lambda reader: reader.read())
+                self.assertEqual(
+                    fetcher.result(repo.url + packages_url_path), content)
+                fetcher.shutdown()
+                requests.append(repo.requests)
+        finally:
+            repo.close()
+
+        # The smaller compressed file was downloaded by hash
+        self.assertEqual(len(requests[0]), 1)
+        self.assertIn('/by-hash/SHA256/', requests[0][0])
+        # The second time, only the PDiff was downloaded
+        self.assertEqual(requests[1], [
+            packages_url_path + '.diff/Index',
+            packages_url_path + '.diff/T-1.gz',
+        ])
+        self.assertEqual(fetcher.patched, 1)
+
+    def test_verification(self):
+        from debian.deb822 import Release
+
+        content = b'Package: libfoo1\nVersion: 1\n'
+        xz = lzma.compress(content)
+        digest = hashlib.sha256(xz).hexdigest()
+        release = Release(
+            'Acquire-By-Hash: yes\nSHA256:\n %s %d main/binary-amd64/'
+            'Packages.xz\n' % (digest, len(xz)))
+        path = '/dists/scout/main/binary-amd64/Packages'
+        by_hash = '/dists/scout/main/binary-amd64/by-hash/SHA256/' + digest
+        repo = MockRepository({
+            # A corrupt by-hash object, and a truncated Packages.xz
+            by_hash: xz[:-8] + b'\0' * 8,
+            path + '.xz': xz,
+        })
+        cache = self.build_runtime.IndexCache(self.tmpdir)
+
+        try:
+            fetcher = self.build_runtime.IndexFetcher(cache=cache)
+            fetcher.add_release(repo.url + '/dists/scout/Release', release)
+            fetcher.submit(repo.url + path, lambda reader: reader.read())
+            self.assertEqual(fetcher.result(repo.url + path), content)
+            fetcher.shutdown()
+            self.assertEqual(repo.requests, [by_hash, path + '.xz'])
+
+            # If no candidate can be verified, nothing is returned
+            os.unlink(cache.filename(repo.url + path))
+            repo.files[path + '.xz'] = xz[:len(xz) // 2]
+            fetcher = self.build_runtime.IndexFetcher(cache=cache)
+            fetcher.add_release(repo.url + '/dists/scout/Release', release)
+            fetcher.submit(repo.url + path, lambda reader: reader.read())
+
+            with self.assertRaises(Exception):
+                fetcher.result(repo.url + path)
+
+            fetcher.shutdown()
+        finally:
+            repo.close()
+
+        self.assertFalse(os.path.exists(cache.filename(repo.url + path)))
+
+    def test_apply_ed_script(self):
+        lines = [b'a\n', b'b\n', b'c\n', b'd\n']
+        self.build_runtime.apply_ed_script(lines, [
+            b'4a\n', b'e\n', b'.\n',
+            b'2,3c\n', b'B\n', b'.\n',
+            b'1d\n',
+        ])
+        self.assertEqual(lines, [b'B\n', b'd\n', b'e\n'])
+
+        with self.assertRaises(ValueError):
+            self.build_runtime.apply_ed_script(lines, [b'1x\n'])
+
+    def tearDown(self):
+        # type: () -> None
+        shutil.rmtree(self.tmpdir)
+
+
 if __name__ == '__main__':
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'third-party'))
     from pycotap import TAPTestRunner
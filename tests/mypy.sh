@@ -14,6 +14,7 @@ i=0
 for script in \
     build-runtime.py \
     tests/*.py \
+    tests/benchmarks/*.py \
 ; do
     i=$((i + 1))
     if [ "${MYPY:="$(command -v mypy || echo false)"}" = false ]; then
@@ -34,6 +34,7 @@ fi
 
 if "${PYCODESTYLE}" \
     tests/*.py \
+    tests/benchmarks/*.py \
     >&2; then
     echo "ok 2 - $PYCODESTYLE reported no issues"
 else
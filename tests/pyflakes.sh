@@ -14,6 +14,7 @@ if [ "${PYFLAKES:=pyflakes3}" = false ] || \
 elif "${PYFLAKES}" \
     ./*.py \
     tests/*.py \
+    tests/benchmarks/*.py \
     >&2; then
     echo "1..1"
     echo "ok 1 - $PYFLAKES reported no issues"
@@ -7,6 +7,8 @@
 
 from __future__ import print_function
 
+import importlib.util
+import os
 import sys
 from gzip import GzipFile
 
@@ -20,6 +22,23 @@ except ImportError:
     pass
 
 
+BUILD_RUNTIME = os.path.join(
+    os.path.dirname(__file__), os.pardir, 'build-runtime.py',
+)
+
+
+def load_version_key():
+    """
+    Return build-runtime.py's version_key(), so that versions are
+    compared in the same way as when the runtime was built.
+    """
+    spec = importlib.util.spec_from_file_location(
+        'build_runtime', BUILD_RUNTIME)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)     # type: ignore
+    return module.version_key
+
+
 class Source:
     def __init__(
         self,
@@ -134,7 +153,9 @@ if __name__ == '__main__':
         else:
             runtime_package_lists.add(f)
 
-    sources = {}    # type: typing.Dict[str, typing.Dict[str, Version]]
+    version_key = load_version_key()
+    # {source name: {version_key(version): Source}}
+    sources = {}    # type: typing.Dict[str, typing.Dict[typing.Any, Source]]
 
     for f in source_lists:
         with GzipFile(f, 'rb') as gzip_reader:
@@ -147,7 +168,9 @@ if __name__ == '__main__':
                     Version(source_stanza['version']),
                     stanza=source_stanza,
                 )
-                sources.setdefault(source.name, {})[source.version] = source
+                sources.setdefault(source.name, {})[
+                    version_key(str(source.version))
+                ] = source
 
     for f in runtime_package_lists:
         test.diag('Examining runtime %s...' % f)
@@ -160,7 +183,8 @@ if __name__ == '__main__':
 
                 if (
                     binary.source not in sources
-                    or binary.source_version not in sources[binary.source]
+                    or version_key(str(binary.source_version))
+                    not in sources[binary.source]
                 ):
                     test.not_ok(
                         'source package %s_%s for %s not found'